@@ -6,6 +6,7 @@ import subprocess
 import time
 
 import yaml
+
 from radio.utils.aws import create_client
 
 # AWS
@@ -49,24 +50,45 @@ if __name__ == "__main__":
                 print(e)
 
         alert_interval = int(input("Alert interval in minute: "))
+        single_process = input(
+            "Do you want to run all channels in one container: (y/n) "
+        )
 
         build_cmd = f"""docker build -f Dockerfile.radio . \
                                 -t radio"""
         run_cmd(cmd=build_cmd)
 
-        for channel in channels["channels"].keys():
-            url = channels["channels"][channel]["M3U8_URL"]
-
-            remove_cmd = f"docker rm -f radio-{channel}"
+        if single_process.lower() == "y":
+            # Run all channels as asyncio tasks in one container
+            remove_cmd = "docker rm -f radio-ingest"
             docker_run_cmd = f"""docker run --detach -it --restart=always \
                                 --add-host=seaweedfs:10.10.0.1 \
-                                -e OUTPUT_DIR='{channel}' \
-                                -e M3U8_URL='{url}' \
+                                -v radio-state:/home/radio/state \
                                 -e ALERT={alert_interval} \
                                 --log-driver json-file \
                                 --log-opt max-size=1M \
                                 --log-opt max-file=5 \
-                                --name=radio-{channel} radio:latest"""
+                                --entrypoint python \
+                                --name=radio-ingest radio:latest \
+                                -m ingest --channels radio_channels.yaml"""
 
             run_cmd(cmd=remove_cmd)
             run_cmd(cmd=docker_run_cmd)
+        else:
+            for channel in channels["channels"].keys():
+                url = channels["channels"][channel]["M3U8_URL"]
+
+                remove_cmd = f"docker rm -f radio-{channel}"
+                docker_run_cmd = f"""docker run --detach -it --restart=always \
+                                    --add-host=seaweedfs:10.10.0.1 \
+                                    -v radio-state:/home/radio/state \
+                                    -e OUTPUT_DIR='{channel}' \
+                                    -e M3U8_URL='{url}' \
+                                    -e ALERT={alert_interval} \
+                                    --log-driver json-file \
+                                    --log-opt max-size=1M \
+                                    --log-opt max-file=5 \
+                                    --name=radio-{channel} radio:latest"""
+
+                run_cmd(cmd=remove_cmd)
+                run_cmd(cmd=docker_run_cmd)
@@ -0,0 +1,136 @@
+"""
+Benchmark of the archive codecs of compaction on a sample hour block:
+compression ratio, CPU time and wall time of each codec.
+"""
+
+import gzip
+import io
+import os
+import sys
+import tarfile
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import BinaryIO, Iterator
+
+import click
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+sys.path.append(
+    Path(__file__).parent.parent.absolute().as_posix()
+)  # Add radio/ to root path
+
+from benchmarks.transcode import cpu_seconds
+from utils.archive import SeekableArchive
+from utils.codec import ArchiveCodec
+
+CODECS = [
+    "none",
+    "gz:1",
+    "gz:6",
+    "gz:9",
+    "zstd:1",
+    "zstd:3",
+    "zstd:3:-1",
+    "zstd:19:-1",
+]
+
+
+class CountingWriter:
+    """Sink counting the bytes of the archive, so the disk is not measured."""
+
+    def __init__(self):
+        self.size = 0
+
+    def write(self, data: bytes) -> int:
+        self.size += len(data)
+        return len(data)
+
+
+@contextmanager
+def open_archive(fileobj: BinaryIO, codec: ArchiveCodec) -> Iterator[tarfile.TarFile]:
+    """Opens a tar file writing one compressed stream to fileobj with the codec,
+    the layout before the seekable archives. fileobj is not closed."""
+    if codec.name == "none":
+        with tarfile.open(fileobj=fileobj, mode="w|") as archive:
+            yield archive
+    elif codec.name == "gz":
+        with gzip.GzipFile(fileobj=fileobj, mode="wb", compresslevel=codec.level) as f:
+            with tarfile.open(fileobj=f, mode="w|") as archive:
+                yield archive
+    elif codec.name == "zstd":
+        if zstandard is None:
+            raise ImportError("The zstd archive codec requires zstandard")
+        compressor = zstandard.ZstdCompressor(level=codec.level, threads=codec.threads)
+        with compressor.stream_writer(fileobj, closefd=False) as writer:
+            with tarfile.open(fileobj=writer, mode="w|") as archive:
+                yield archive
+    else:
+        raise NotImplementedError(f"Unknown archive codec {codec.name}")
+
+
+def parse_codec(spec: str) -> ArchiveCodec:
+    """Parses name[:level[:threads]]."""
+    name, *args = spec.split(":")
+    return ArchiveCodec(name, *[int(arg) for arg in args])
+
+
+def archive(files: list, codec: ArchiveCodec, seekable: bool) -> int:
+    sink = CountingWriter()
+    if seekable:
+        # Layout of compaction, one frame per segment
+        with SeekableArchive(sink, codec) as tar:
+            for name, data in files:
+                tar.add(name, data, timestamp=0, duration=0)
+        return sink.size
+
+    with open_archive(sink, codec) as tar:
+        for name, data in files:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return sink.size
+
+
+@click.command()
+@click.argument("audio_files", nargs=-1, required=True)
+@click.option(
+    "--codec",
+    "codecs",
+    multiple=True,
+    default=CODECS,
+    help="Codec as name[:level[:threads]], e.g. zstd:3:-1",
+)
+@click.option(
+    "--seekable/--stream",
+    default=True,
+    help="One compressed frame per segment as compaction, or one stream",
+)
+@click.option("--repeat", default=3, help="Number of runs of each codec")
+def benchmark(audio_files, codecs, seekable, repeat):
+    """Archives the AUDIO_FILES (e.g. the segments of one hour block) with each
+    codec and reports the compression ratio, CPU time and wall time."""
+    files = [(os.path.basename(f), open(f, "rb").read()) for f in audio_files]
+    input_size = sum(len(data) for _, data in files)
+    print(f"{len(files)} files, {input_size / 2**20:.1f} MiB")
+
+    for spec in codecs:
+        codec = parse_codec(spec)
+        cpu_start, wall_start = cpu_seconds(), time.perf_counter()
+        for _ in range(repeat):
+            size = archive(files, codec, seekable)
+        cpu = (cpu_seconds() - cpu_start) / repeat
+        wall = (time.perf_counter() - wall_start) / repeat
+        print(
+            "{:>12}: ratio {:6.4f}, {:7.3f} CPU-s, {:7.3f}s wall, {:7.1f} MiB/s".format(
+                spec, size / input_size, cpu, wall, input_size / 2**20 / wall
+            )
+        )
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,373 @@
+"""
+End-to-end benchmark of the collectors without any network: fetch_hls_stream
+on synthetic channels of a fake HLS origin, then compaction of one hour block
+per channel, then a milkrun sync to R2, all against a fake S3. Reports
+segments/sec, ingest latency percentiles, CPU per channel and bytes moved.
+"""
+
+import datetime
+import json
+import os
+import re
+import shutil
+import signal
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import List
+
+import click
+
+sys.path.append(
+    Path(__file__).parent.parent.absolute().as_posix()
+)  # Add radio/ to root path
+
+from benchmarks.fakes import FakeHLSOrigin, FakeS3, make_segments
+
+RADIO_DIR = Path(__file__).parent.parent.absolute()
+MILKRUN_DIR = Path(__file__).parents[3].absolute() / "milkrun"
+
+BUCKET_NAME = "radio-project"
+
+# Access keys of the backends, the fake S3 keeps their buckets apart
+KEY_IDS = {"seaweedfs": "seaweedfs", "aws": "aws", "r2": "r2"}
+
+SEGMENT_KEY = re.compile(r"^(bench\d+)/.*_(\d+)_mono_16khz\.aac$")
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def stage_env(tmp: str, s3: FakeS3, ffmpeg: str) -> dict:
+    """Environment of the stages, every backend points to the fake S3."""
+    env = dict(os.environ)
+    env.update(
+        {
+            "S3_ENDPOINT_URL": s3.url,
+            "AWS_SEAWEEDFS_KEY_ID": KEY_IDS["seaweedfs"],
+            "AWS_SEAWEEDFS_SECRET": "secret",
+            "AWS_KEY_ID": KEY_IDS["aws"],
+            "AWS_SECRET": "secret",
+            "AWS_R2_ACCOUNT_ID": "benchmark",
+            "AWS_R2_KEY_ID": KEY_IDS["r2"],
+            "AWS_R2_SECRET": "secret",
+            "AWS_DEFAULT_REGION": "us-east-1",
+            "BOT_TOKEN": "benchmark",
+            "BOT_CHATID": "benchmark",
+            "FFMPEG_CMD": ffmpeg,
+            "RUNNING_HOURS": "0-24",
+            "STATE_DIR": os.path.join(tmp, "state"),
+            "CATALOG_PATH": os.path.join(tmp, "state", "catalog.db"),
+            "COMPACTION_INTERVAL": str(10**6),
+        }
+    )
+    return env
+
+
+def reap(process: subprocess.Popen, timeout: float) -> float:
+    """Waits for a stage process, killed after timeout seconds, and returns
+    its CPU seconds with the ones of its children (ffmpeg, pool workers)."""
+    deadline = time.monotonic() + timeout
+    while True:
+        pid, _, rusage = os.wait4(process.pid, os.WNOHANG)
+        if pid:
+            process.returncode = 0
+            return rusage.ru_utime + rusage.ru_stime
+        if time.monotonic() > deadline:
+            process.kill()
+            deadline = float("inf")
+        time.sleep(0.05)
+
+
+def run_stage(args: List[str], env: dict, cwd: str, log: str) -> dict:
+    start = time.perf_counter()
+    with open(log, "ab") as fp:
+        process = subprocess.Popen(args, env=env, cwd=cwd, stdout=fp, stderr=fp)
+        cpu = reap(process, timeout=3600)
+    return {"wall_s": time.perf_counter() - start, "cpu_s": cpu}
+
+
+def bench_fetch(
+    tmp: str,
+    env: dict,
+    origin: FakeHLSOrigin,
+    s3: FakeS3,
+    channels: List[str],
+    duration: float,
+    workers: int,
+    chunk_seconds: int,
+    persistent_ffmpeg: bool,
+) -> dict:
+    """Runs one fetch_hls_stream process per channel for duration seconds."""
+    processes = []
+    start = time.perf_counter()
+    for channel in channels:
+        log = open(os.path.join(tmp, f"fetch_{channel}.log"), "ab")
+        processes.append(
+            subprocess.Popen(
+                [
+                    sys.executable,
+                    str(RADIO_DIR / "fetch_hls_stream.py"),
+                    "--url",
+                    origin.url_of(channel),
+                    "--output",
+                    channel,
+                    "--freq",
+                    str(max(int(origin.duration), 1)),
+                    "--workers",
+                    str(workers),
+                    "--chunk-seconds",
+                    str(chunk_seconds),
+                    "--alert",
+                    "60",
+                    (
+                        "--persistent-ffmpeg"
+                        if persistent_ffmpeg
+                        else "--no-persistent-ffmpeg"
+                    ),
+                ],
+                env=env,
+                cwd=tmp,
+                stdout=log,
+                stderr=log,
+            )
+        )
+    time.sleep(duration)
+
+    # Stopped as a container, the pending chunks are flushed
+    for process in processes:
+        os.kill(process.pid, signal.SIGTERM)
+    cpu = [reap(process, timeout=60) for process in processes]
+    wall = time.perf_counter() - start
+
+    latencies = []
+    for (namespace, key), written_at in list(s3.written_at.items()):
+        match = SEGMENT_KEY.match(key)
+        if namespace == KEY_IDS["seaweedfs"] and match:
+            latencies.append(written_at - origin.published_at(int(match.group(2))))
+    counters = s3.counters[KEY_IDS["seaweedfs"]]
+    return {
+        "channels": len(channels),
+        "wall_s": wall,
+        "segments": origin.served,
+        "segments_per_s": origin.served / wall,
+        "objects": len(latencies),
+        "latency_p50_s": percentile(latencies, 0.5),
+        "latency_p95_s": percentile(latencies, 0.95),
+        "latency_p99_s": percentile(latencies, 0.99),
+        "cpu_s_per_channel": sum(cpu) / len(cpu),
+        "cpu_s_per_audio_hour": sum(cpu)
+        / max(origin.served * origin.duration, 1)
+        * 3600,
+        "origin_bytes": origin.bytes_out,
+        "s3_bytes_in": counters["bytes_in"],
+        "s3_puts": counters["put"],
+    }
+
+
+def seed_blocks(s3: FakeS3, channels: List[str], segments: int, duration: float) -> int:
+    """Writes an hour block of 3 hours ago per channel from the audio uploaded
+    by the fetchers, so compaction has a complete block to archive."""
+    bucket = s3.bucket(KEY_IDS["seaweedfs"], BUCKET_NAME)
+    hour = (datetime.datetime.utcnow() - datetime.timedelta(hours=3)).replace(
+        minute=0, second=0, microsecond=0
+    )
+    size = 0
+    for channel in channels:
+        audio = [obj for key, obj in bucket.items() if key.startswith(f"{channel}/")]
+        if not audio:
+            continue
+        for i in range(segments):
+            date = hour + datetime.timedelta(seconds=i * duration)
+            key = "{}/{}_{}_mono_16khz.aac".format(
+                channel, date.strftime("%Y/%m/%d/%H_%M_%S"), i
+            )
+            s3.store(KEY_IDS["seaweedfs"], BUCKET_NAME, key, audio[i % len(audio)])
+            size += len(audio[i % len(audio)].data)
+    return size
+
+
+def bench_compaction(tmp: str, env: dict, s3: FakeS3, channels: List[str]) -> dict:
+    """Runs compaction of all channels in a process."""
+    before = {name: dict(s3.counters[key]) for name, key in KEY_IDS.items()}
+    args = [sys.executable, str(Path(__file__).absolute()), "compact"]
+    for channel in channels:
+        args += ["--channel", channel]
+    result = run_stage(args, env, tmp, os.path.join(tmp, "compaction.log"))
+
+    def delta(name: str, counter: str) -> int:
+        return s3.counters[KEY_IDS[name]][counter] - before[name].get(counter, 0)
+
+    archives = [
+        key
+        for key in s3.bucket(KEY_IDS["aws"], BUCKET_NAME)
+        if not key.endswith(".index.json")
+    ]
+    result.update(
+        {
+            "archives": len(archives),
+            "seaweedfs_bytes_out": delta("seaweedfs", "bytes_out"),
+            "seaweedfs_bytes_in": delta("seaweedfs", "bytes_in"),
+            "aws_bytes_in": delta("aws", "bytes_in"),
+        }
+    )
+    result["read_mb_per_s"] = result["seaweedfs_bytes_out"] / 2**20 / result["wall_s"]
+    return result
+
+
+def bench_milkrun(tmp: str, env: dict, s3: FakeS3, sync_segments: int) -> dict:
+    """Requests the archives and the latest segments, then runs one sync of
+    milkrun to R2 in a process."""
+    bucket = s3.bucket(KEY_IDS["seaweedfs"], BUCKET_NAME)
+    keys = [key for key in bucket if ".tar" in key and not key.endswith(".json")]
+    segments = sorted(key for key in bucket if SEGMENT_KEY.match(key))
+    keys += segments[-sync_segments:] if sync_segments else []
+
+    workdir = os.path.join(tmp, "milkrun")
+    os.makedirs(workdir, exist_ok=True)
+    keys_file = os.path.join(workdir, "keys.txt")
+    with open(keys_file, "w") as fp:
+        fp.write("\n".join(keys))
+
+    args = [sys.executable, str(Path(__file__).absolute()), "sync", keys_file]
+    result = run_stage(args, env, workdir, os.path.join(tmp, "milkrun.log"))
+    counters = s3.counters[KEY_IDS["r2"]]
+    result.update(
+        {
+            "requested": len(keys),
+            "objects": len(s3.bucket(KEY_IDS["r2"], BUCKET_NAME)),
+            "r2_bytes_in": counters["bytes_in"],
+        }
+    )
+    result["objects_per_s"] = result["objects"] / result["wall_s"]
+    result["mb_per_s"] = result["r2_bytes_in"] / 2**20 / result["wall_s"]
+    return result
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.option("--channels", default=4, help="Number of synthetic channels")
+@click.option("--duration", default=60.0, help="Seconds of fetching")
+@click.option("--segment-duration", default=2.0, help="Seconds of each segment")
+@click.option("--workers", default=4, help="Concurrent downloads per channel")
+@click.option("--chunk-seconds", default=0, help="Rolling chunks of the fetchers")
+@click.option("--persistent-ffmpeg/--no-persistent-ffmpeg", default=True)
+@click.option(
+    "--container",
+    type=click.Choice(["ts", "aac"]),
+    default="ts",
+    help="Segments of the origin, MPEG-TS or packed ADTS audio",
+)
+@click.option("--block-segments", default=1800, help="Segments of the hour blocks")
+@click.option("--sync-segments", default=100, help="Segments requested on R2")
+@click.option(
+    "--ffmpeg",
+    default=os.getenv("FFMPEG_CMD") or shutil.which("ffmpeg"),
+    help="ffmpeg binary",
+)
+@click.option("--json", "json_path", default=None, help="Writes the metrics to a file")
+@click.option("--keep", is_flag=True, help="Keeps the working directory and logs")
+def run(
+    channels,
+    duration,
+    segment_duration,
+    workers,
+    chunk_seconds,
+    persistent_ffmpeg,
+    container,
+    block_segments,
+    sync_segments,
+    ffmpeg,
+    json_path,
+    keep,
+):
+    """Benchmarks fetch_hls_stream, compaction and milkrun against in-process
+    stand-ins of the radio CDNs and of S3."""
+    if not ffmpeg:
+        raise click.UsageError("ffmpeg is not found, set --ffmpeg")
+    names = [f"bench{i}" for i in range(channels)]
+    tmp = tempfile.mkdtemp(prefix="radio-e2e-")
+    segments = make_segments(
+        ffmpeg,
+        count=int(duration / segment_duration) + 10,
+        duration=segment_duration,
+        extension=container,
+    )
+
+    metrics = {}
+    origin = FakeHLSOrigin(segments, names, segment_duration, extension=container)
+    with FakeS3() as s3, origin:
+        env = stage_env(tmp, s3, ffmpeg)
+        metrics["fetch"] = bench_fetch(
+            tmp,
+            env,
+            origin,
+            s3,
+            names,
+            duration,
+            workers,
+            chunk_seconds,
+            persistent_ffmpeg,
+        )
+        metrics["fetch"]["seeded_bytes"] = seed_blocks(
+            s3, names, block_segments, segment_duration
+        )
+        metrics["compaction"] = bench_compaction(tmp, env, s3, names)
+        metrics["milkrun"] = bench_milkrun(tmp, env, s3, sync_segments)
+
+    for stage, values in metrics.items():
+        print(stage)
+        for name, value in values.items():
+            print(
+                "  {:>22}: {}".format(
+                    name, f"{value:.3f}" if isinstance(value, float) else value
+                )
+            )
+    if json_path:
+        with open(json_path, "w") as fp:
+            json.dump(metrics, fp, indent=2)
+    if keep:
+        print(f"Logs in {tmp}")
+    else:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+@cli.command(hidden=True)
+@click.option("--channel", "channels", multiple=True)
+def compact(channels):
+    """Compaction stage, in its own process for its CPU time."""
+    import compaction
+
+    compaction.run(channels=list(channels), running_hours=range(0, 24))
+
+
+@cli.command(hidden=True)
+@click.argument("keys_file")
+def sync(keys_file):
+    """Milkrun stage, milkrun has its own configs module."""
+    sys.path.insert(0, MILKRUN_DIR.as_posix())
+    import r2_syncer
+
+    r2_syncer.setuplog(verbose=False)
+    r2_syncer.init_db()
+    with open(keys_file) as fp, sqlite3.connect("objects.db") as con:
+        con.executemany(
+            "INSERT INTO objects(src, dst, active) VALUES ('seaweedfs', ?, 1)",
+            [(key,) for key in fp.read().split("\n") if key],
+        )
+    r2_syncer.seaweedfs_to_r2()
+
+
+if __name__ == "__main__":
+    cli()
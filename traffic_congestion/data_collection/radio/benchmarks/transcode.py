@@ -0,0 +1,68 @@
+"""
+Benchmark of the CPU cost per hour of audio of the transcoding step:
+one ffmpeg process per segment against one warm ffmpeg process per channel.
+"""
+
+import resource
+import sys
+import time
+from pathlib import Path
+
+import click
+
+sys.path.append(
+    Path(__file__).parent.parent.absolute().as_posix()
+)  # Add radio/ to root path
+
+from utils.transcode import FFMPEG_CMD, ChannelTranscoder, transcode_stream
+
+
+def cpu_seconds() -> float:
+    """Returns the user and system CPU time of this process and its waited
+    children."""
+    usage = 0.0
+    for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN):
+        ru = resource.getrusage(who)
+        usage += ru.ru_utime + ru.ru_stime
+    return usage
+
+
+def run_process_per_segment(segments: list, cmd: str) -> None:
+    for data in segments:
+        transcode_stream([data], cmd=cmd)
+
+
+def run_persistent(segments: list, duration: float, cmd: str) -> None:
+    transcoder = ChannelTranscoder(name="benchmark", cmd=cmd)
+    for sequence, data in enumerate(segments):
+        transcoder.transcode(sequence, data, duration)
+    transcoder.close()
+
+
+@click.command()
+@click.argument("segment_files", nargs=-1, required=True)
+@click.option("--duration", default=10.0, help="Duration of each segment in seconds")
+@click.option("--repeat", default=30, help="Number of times the segments are played")
+@click.option("--cmd", default=FFMPEG_CMD, help="ffmpeg binary")
+def benchmark(segment_files, duration, repeat, cmd):
+    """Transcodes the SEGMENT_FILES (consecutive MPEG-TS segments of a channel)
+    with both approaches and reports the CPU-seconds per hour of audio."""
+    segments = [open(f, "rb").read() for f in segment_files] * repeat
+    audio_hours = len(segments) * duration / 3600
+
+    for name, run in [
+        ("process per segment", lambda: run_process_per_segment(segments, cmd)),
+        ("persistent process", lambda: run_persistent(segments, duration, cmd)),
+    ]:
+        cpu_start, wall_start = cpu_seconds(), time.perf_counter()
+        run()
+        cpu, wall = cpu_seconds() - cpu_start, time.perf_counter() - wall_start
+        print(
+            "{:>20}: {:8.2f} CPU-s per hour of audio, {:6.2f}s wall for {} segments".format(
+                name, cpu / audio_hours, wall, len(segments)
+            )
+        )
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -3,149 +3,383 @@ Simple program to remove unused audio files and zip them to block.
 """
 
 import datetime
-import io
 import logging
+import multiprocessing
 import os
 import sys
-import tarfile
-from collections import defaultdict
-from concurrent.futures import ThreadPoolExecutor
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from contextlib import closing, nullcontext
 from pathlib import Path
-from typing import List
+from typing import ContextManager, Dict, List, Optional, Tuple
 
 import yaml
 
 sys.path.append(Path(__file__).parent.absolute().as_posix())  # Add radio/ to root path
 
-from utils.aws import delete_blob, download_blob, list_blob, write_file_to_s3
+from utils.archive import INDEX_SUFFIX, SeekableArchive, parse_timestamp
+from utils.aws import (
+    MultipartWriter,
+    delete_blobs,
+    download_blob,
+    iter_blobs,
+    iter_blobs_partitioned,
+    list_prefixes,
+    open_blob,
+    s3_targets,
+    write_buf_to_s3,
+    write_file_to_s3,
+)
+from utils.catalog import SegmentCatalog
+from utils.codec import ARCHIVE_CODEC, ArchiveCodec, strip_extension
+from utils.transcode import adts_duration
 
 # AWS
 BUCKET_NAME = "radio-project"
 TTL = 3  # days
 
-# SeaweedFS Cluster
+# SeaweedFS Cluster, replicas written before an upload returns (all by default)
 SEAWEEDFS_HOSTS = ["11.11.1.89", "11.11.1.90"]
+WRITE_QUORUM = int(os.getenv("SEAWEEDFS_WRITE_QUORUM", len(SEAWEEDFS_HOSTS)))
+
+# Stream the hour blocks from S3 to S3, without local files
+STREAMING = bool(int(os.getenv("COMPACTION_STREAMING", 1)))
+
+# Only log the garbage files which would be deleted
+DRY_RUN = bool(int(os.getenv("COMPACTION_DRY_RUN", 0)))
+
+# Smallest tar file worth archiving
+MIN_ARCHIVE_SIZE = 10**7
+
+# Processes compressing hour blocks, and downloads and uploads of all of them
+WORKERS = int(os.getenv("COMPACTION_WORKERS", os.cpu_count() or 1))
+MAX_TRANSFERS = int(os.getenv("COMPACTION_MAX_TRANSFERS", 16))
+
+# Incremental compaction of the collectors: seconds between runs, processes
+INTERVAL = int(os.getenv("COMPACTION_INTERVAL", 600))
+BACKGROUND_WORKERS = int(os.getenv("COMPACTION_BACKGROUND_WORKERS", 1))
+
+# Semaphore of the transfers, set in the worker processes
+transfer_slots = None
 
 # Logger
 logger = logging.getLogger("fetch_hls_stream")
 
 
-def compress(output: str, file_paths: List[str]) -> None:
-    """Compresses files into tar file."""
+def add_segment(archive: SeekableArchive, file_path: str, data: bytes) -> None:
+    """Adds a segment to an archive with its timestamp and duration."""
+    archive.add(
+        name=os.path.basename(file_path),
+        data=data,
+        timestamp=parse_timestamp(file_path),
+        duration=adts_duration(data),
+    )
+
+
+def upload_index(output: str, archive: SeekableArchive) -> None:
+    """Uploads the sidecar index of an archive next to it on SeaweedFS Cluster
+    S3, where segments are read with Range GETs."""
+    with transfer_slot():
+        write_buf_to_s3(
+            contents=archive.index(),
+            bucket_name=BUCKET_NAME,
+            object_name=output + INDEX_SUFFIX,
+            backend="seaweedfs_cluster",
+            s3_hosts=SEAWEEDFS_HOSTS,
+            quorum=WRITE_QUORUM,
+        )
+
+
+def compress(
+    output: str, file_paths: List[str], codec: ArchiveCodec = ARCHIVE_CODEC
+) -> Optional[int]:
+    """Compresses files into tar file. Returns its size, or None if it is too
+    small to be uploaded."""
 
     def delete_file(file_path: str):
         os.remove(file_path)
 
     # Compress to tar file
     file_paths = [file_path for file_path in file_paths if os.path.exists(file_path)]
-    with tarfile.open(output, "w:gz") as archive:
+    with open(output, "wb") as fp, SeekableArchive(fp, codec) as archive:
         for file_path in file_paths:
-            with io.BytesIO(open(file_path, "rb").read()) as f:
-                info = tarfile.TarInfo(os.path.basename(file_path))
-                f.seek(0, io.SEEK_END)
-                info.size = f.tell()
-                f.seek(0, io.SEEK_SET)
-                archive.addfile(info, f)
+            with open(file_path, "rb") as f:
+                add_segment(archive, file_path, f.read())
 
     # Check the size of tar file
-    if os.path.getsize(output) < 1e7:
+    size = os.path.getsize(output)
+    if size < MIN_ARCHIVE_SIZE:
         logger.warning(f"This tar file {output} is less than 10 MB.")
+        size = None
+        delete_file(file_path=output)
     else:
         # Upload to AWS S3
-        write_file_to_s3(
-            bucket_name=BUCKET_NAME,
-            file_name=output,
-            object_name=output,
-            backend="aws",
-            ExtraArgs={"StorageClass": "DEEP_ARCHIVE"},
+        with transfer_slot():
+            write_file_to_s3(
+                bucket_name=BUCKET_NAME,
+                file_name=output,
+                object_name=output,
+                backend="aws",
+                ExtraArgs={"StorageClass": "DEEP_ARCHIVE"},
+            )
+
+        # Upload SeaweedFS Cluster S3, the tar file is removed once the
+        # stragglers of the quorum finished
+        with transfer_slot():
+            write_file_to_s3(
+                bucket_name=BUCKET_NAME,
+                file_name=output,
+                object_name=output,
+                backend="seaweedfs_cluster",
+                s3_hosts=SEAWEEDFS_HOSTS,
+                quorum=WRITE_QUORUM,
+                on_done=lambda: delete_file(file_path=output),
+            )
+        upload_index(output, archive)
+
+    # Clean up
+    with ThreadPoolExecutor(100) as p:
+        _ = [p.submit(delete_file, file_path) for file_path in file_paths]
+    return size
+
+
+def compress_stream(
+    output: str, file_paths: List[str], codec: ArchiveCodec = ARCHIVE_CODEC
+) -> Optional[int]:
+    """Streams files from SeaweedFS S3 into a tar file which is written with
+    multipart uploads to AWS S3 and SeaweedFS Cluster S3, so the memory stays
+    bounded and nothing is staged on local disk. Returns its size, or None if
+    it is too small to be uploaded."""
+    writer = MultipartWriter(
+        bucket_name=BUCKET_NAME,
+        object_name=output,
+        targets=s3_targets(backend="aws", StorageClass="DEEP_ARCHIVE")
+        + s3_targets(backend="seaweedfs_cluster", s3_hosts=SEAWEEDFS_HOSTS),
+        min_size=MIN_ARCHIVE_SIZE,
+        slots=transfer_slot(),
+    )
+    try:
+        with SeekableArchive(writer, codec) as archive:
+            for file_path in file_paths:
+                # A segment is read at once so no slot is held while the
+                # archive uploads its parts
+                try:
+                    with transfer_slot():
+                        _, body = open_blob(BUCKET_NAME, file_path)
+                        with closing(body):
+                            data = body.read()
+                except Exception as ex:
+                    # Same as a failed download, the file is left out
+                    logger.exception(ex)
+                    continue
+                add_segment(archive, file_path, data)
+        uploaded = writer.close()
+    except Exception:
+        writer.abort()
+        raise
+
+    if not uploaded:
+        logger.warning(f"This tar file {output} is less than 10 MB.")
+        return None
+    upload_index(output, archive)
+    return writer.size
+
+
+def transfer_slot() -> ContextManager:
+    """Returns the semaphore of the transfers shared by the workers, held by
+    each download and upload."""
+    return transfer_slots if transfer_slots is not None else nullcontext()
+
+
+def init_worker(slots: ContextManager, level: int) -> None:
+    """Sets up a compaction worker process."""
+    global transfer_slots
+    transfer_slots = slots
+    logging.basicConfig(
+        format="%(asctime)s :: %(levelname)5s ::  %(name)10s :: %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+    )
+    logger.setLevel(level)
+
+
+def compress_block(
+    key: str,
+    file_paths: List[str],
+    streaming=STREAMING,
+    codec: ArchiveCodec = ARCHIVE_CODEC,
+) -> Tuple[str, Optional[int]]:
+    """Compresses the files of an hour block (channel|YYYY|MM|DD|HH). Returns
+    the name and the size of the archive, None if it was not uploaded."""
+    logger.info(key)
+    output = "/".join(key.split("|")) + codec.extension
+    if streaming:
+        return output, compress_stream(
+            output=output, file_paths=file_paths, codec=codec
+        )
+
+    # Get files to local disk
+    def download(file_path: str) -> None:
+        with transfer_slot():
+            download_blob(BUCKET_NAME, file_path, "seaweedfs")
+
+    with ThreadPoolExecutor(10) as p:
+        _ = list(p.map(download, file_paths))
+
+    # Compress files to 1 hour block
+    return output, compress(output=output, file_paths=file_paths, codec=codec)
+
+
+def plan(channel: str, running_hours=range(6, 22)) -> Tuple[Dict[str, list], list]:
+    """Returns the hour blocks of a channel to compress and its garbage files."""
+    # Rebuild the catalog of the channel from SeaweedFS S3 if it is missing,
+    # streaming one day per listing
+    catalog = SegmentCatalog()
+    if not catalog.rebuilt(channel):
+        catalog.rebuild(
+            channel,
+            iter_blobs_partitioned(
+                bucket_name=BUCKET_NAME,
+                prefixes=list_prefixes(
+                    bucket_name=BUCKET_NAME, prefix=f"{channel}/", depth=3
+                ),
+            ),
         )
 
-        # Upload SeaweedFS Cluster S3
-        write_file_to_s3(
+    s3_compress = {}
+    s3_garbage = []
+    # Hour blocks of the channel from the catalog
+    for block in catalog.hours(channel):
+        year, month, day, hour = block.split("/")
+        ymdh = datetime.datetime(int(year), int(month), int(day), int(hour))
+        # Local hour of the block (UTC+7), as is_running_hours
+        if (ymdh + datetime.timedelta(hours=7)).hour in running_hours:
+            if (datetime.datetime.utcnow() - ymdh).total_seconds() > 2 * 3600:
+                s3_compress["|".join([channel, year, month, day, hour])] = catalog.keys(
+                    channel, block
+                )
+            if (datetime.datetime.utcnow() - ymdh).total_seconds() > TTL * 24 * 3600:
+                s3_garbage.extend(catalog.keys(channel, block))
+        else:
+            s3_garbage.extend(catalog.keys(channel, block))
+
+    archived = catalog.archived(channel)
+    if s3_compress and not archived:
+        # Seed the manifest from the archives on SeaweedFS Cluster S3
+        for blob in iter_blobs(
             bucket_name=BUCKET_NAME,
-            file_name=output,
-            object_name=output,
+            prefix=f"{channel}/",
             backend="seaweedfs_cluster",
-            s3_hosts=SEAWEEDFS_HOSTS,
+        ):
+            if blob.key.endswith(INDEX_SUFFIX):
+                continue
+            catalog.add_archive(
+                strip_extension(blob.key).replace("/", "|"), blob.key, blob.size
+            )
+        archived = catalog.archived(channel)
+
+    s3_compress = {
+        key: file_paths
+        for key, file_paths in s3_compress.items()
+        if key not in archived
+    }  # compressed and uploaded to SeaweedFS Cluster S3 or not?
+
+    return s3_compress, s3_garbage
+
+
+def run(
+    channels: List[str],
+    running_hours=range(6, 22),
+    streaming=STREAMING,
+    codec: ArchiveCodec = ARCHIVE_CODEC,
+    workers: int = WORKERS,
+    max_transfers: int = MAX_TRANSFERS,
+    dry_run: bool = DRY_RUN,
+) -> None:
+    """Compresses the hour blocks of all channels in a pool of processes, with
+    at most max_transfers downloads and uploads at once, then removes the
+    garbage files, or only logs them with dry_run."""
+    # Nothing is removed if the blocks cannot be archived
+    codec.validate()
+    catalog = SegmentCatalog()
+    plans = {channel: plan(channel, running_hours) for channel in channels}
+    blocks = [
+        (key, file_paths)
+        for s3_compress, _ in plans.values()
+        for key, file_paths in s3_compress.items()
+    ]
+
+    if blocks:
+        # Spawned workers do not inherit the S3 clients and threads of the parent
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(
+            max_workers=min(workers, len(blocks)),
+            mp_context=context,
+            initializer=init_worker,
+            initargs=(context.BoundedSemaphore(max_transfers), logger.level),
+        ) as p:
+            futures = {
+                p.submit(compress_block, key, file_paths, streaming, codec): key
+                for key, file_paths in blocks
+            }
+            for future in as_completed(futures):
+                try:
+                    output, size = future.result()
+                except Exception as ex:
+                    # Retried on the next run
+                    logger.exception(ex)
+                    continue
+                # Checkpoint the block so it is not compacted again, a block
+                # too small to be archived is planned again until its TTL
+                if size is not None:
+                    catalog.add_archive(futures[future], output, size)
+
+    for channel, (_, s3_garbage) in plans.items():
+        logger.info(
+            "Need to clean {} garbage files of {}".format(len(s3_garbage), channel)
         )
+        if not s3_garbage:
+            continue
 
-    # Clean up
-    with ThreadPoolExecutor(100) as p:
-        _ = [p.submit(delete_file, file_path) for file_path in file_paths]
-    delete_file(file_path=output)
+        # Remove garbage files, 1000 keys per DeleteObjects request
+        failures = delete_blobs(BUCKET_NAME, s3_garbage, dry_run=dry_run)
+        if dry_run:
+            continue
+        catalog.remove(key for key in s3_garbage if key not in failures)
+        if failures:
+            logger.warning(
+                "{} garbage files are left for the next run".format(len(failures))
+            )
 
 
-def main(channel: str, running_hours=range(6, 22)) -> None:
+def main(channel: str, running_hours=range(6, 22), streaming=STREAMING) -> None:
     """Compresses files into 1 hour block and upload to AWS S3 Glacier
     and SeaweedFS Cluster S3."""
-    # Get list of all files from SeaweedFS S3
-    blobs = list_blob(bucket_name=BUCKET_NAME, prefix=f"{channel}/")
-
-    if blobs:
-        s3_compress = defaultdict(list)
-        s3_garbage = []
-        # Parsing channel and datetime from file
-        for blob in blobs:
-            _, year, month, day, filename = blob.key.split("/")
-            hour = filename.split("_")[0]
-            ymdh = datetime.datetime(int(year), int(month), int(day), int(hour))
-            if int(hour) + 7 in running_hours:
-                if (datetime.datetime.utcnow() - ymdh).total_seconds() > 2 * 3600:
-                    s3_compress["|".join([channel, year, month, day, hour])].append(
-                        blob.key
-                    )
-                if (
-                    datetime.datetime.utcnow() - ymdh
-                ).total_seconds() > TTL * 24 * 3600:
-                    s3_garbage.append(blob.key)
-            else:
-                s3_garbage.append(blob.key)
-        logger.info("Need to clean {} garbage files".format(len(s3_garbage)))
-
-        # Get list of all files from SeaweedFS Cluster S3
-        seaweedfs_cluster_blobs = list_blob(
-            bucket_name=BUCKET_NAME, prefix=f"{channel}/", backend="seaweedfs_cluster"
-        )
-        if seaweedfs_cluster_blobs:
-            seaweedfs_cluster_keys = set(
-                [
-                    blob.key.replace(".tar.gz", "").replace("/", "|")
-                    for blob in seaweedfs_cluster_blobs
-                ]
-            )
-        else:
-            seaweedfs_cluster_keys = set([])
-
-        s3_compress = {
-            key: file_paths
-            for key, file_paths in s3_compress.items()
-            if key not in seaweedfs_cluster_keys
-        }  # compressed and uploaded to SeaweedFS Cluster S3 or not?
-
-        # Get files to local disk
-        for key, file_paths in s3_compress.items():
-            logger.info(key)
-            with ThreadPoolExecutor(10) as p:
-                _ = [
-                    p.submit(download_blob, BUCKET_NAME, file_path, "seaweedfs")
-                    for file_path in file_paths
-                ]
-
-        # Compress files to 1 hour block
-        for key, file_paths in s3_compress.items():
+    run(channels=[channel], running_hours=running_hours, streaming=streaming)
+
+
+def start_incremental(
+    channels: List[str],
+    running_hours=range(6, 22),
+    interval: int = INTERVAL,
+    workers: int = BACKGROUND_WORKERS,
+) -> threading.Event:
+    """Compacts the hour blocks of the channels as soon as they are older than
+    2 hours, by repeating run() every interval seconds in a background thread
+    with few workers, so the load is steady instead of a daily burst. The
+    manifest lets a restarted collector resume where it stopped. Returns the
+    event stopping the thread."""
+    ARCHIVE_CODEC.validate()
+    stopped = threading.Event()
+
+    def loop() -> None:
+        while not stopped.wait(interval):
             try:
-                compress(
-                    output="/".join(key.split("|")) + ".tar.gz", file_paths=file_paths
-                )
+                run(channels=channels, running_hours=running_hours, workers=workers)
             except Exception as ex:
                 logger.exception(ex)
 
-        # Remove garbage files
-        with ThreadPoolExecutor(10) as p:
-            _ = [
-                p.submit(delete_blob, BUCKET_NAME, file_path)
-                for file_path in s3_garbage
-            ]
+    threading.Thread(target=loop, name="compaction", daemon=True).start()
+    return stopped
 
 
 if __name__ == "__main__":
@@ -155,5 +389,4 @@ if __name__ == "__main__":
         except yaml.YAMLError as e:
             print(e)
 
-    for channel in channels["channels"].keys():
-        main(channel=channel)
+    run(channels=list(channels["channels"].keys()))
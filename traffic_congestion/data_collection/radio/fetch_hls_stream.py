@@ -1,29 +1,34 @@
 import datetime
-import json
 import logging
 import os
+import signal
 import sys
 import time
-from concurrent.futures import ThreadPoolExecutor
-from copy import deepcopy
+from concurrent.futures import Future
+from functools import partial
 from pathlib import Path
+from typing import List, Optional
 
 import click
-import ffmpeg
-import m3u8
-from requests import get
 
 sys.path.append(Path(__file__).parent.absolute().as_posix())  # Add radio/ to root path
 
-from compaction import main as compaction_main
-from utils.aws import list_blob, write_buf_to_s3
-from utils.notification import telebot_send_message
-
-# Set representing chunks that we have already downloaded
-dlset = set()
-
-# Download Pool
-dlpool = ThreadPoolExecutor(max_workers=4)
+from compaction import start_incremental
+from utils.aws import write_buf_to_s3
+from utils.catalog import SegmentCatalog, parse_key
+from utils.coalesce import SegmentCoalescer
+from utils.freshness import FreshnessTracker
+from utils.hls import PlaylistPoller, Segment
+from utils.http import get_session, log_connection_stats, set_pool_maxsize
+from utils.notification import AlertSender
+from utils.pipeline import DownloadPipeline
+from utils.segment_index import SegmentIndex
+from utils.transcode import (
+    ChannelTranscoder,
+    TranscoderPool,
+    is_mpegts,
+    transcode_stream,
+)
 
 # Logger
 logger = logging.getLogger("fetch_hls_stream")
@@ -31,8 +36,28 @@ logger = logging.getLogger("fetch_hls_stream")
 # AWS
 BUCKET_NAME = "radio-project"
 
-# Running hours
-RUNNING_HOURS = range(6, 22)
+# Checkpoints of the downloaded segments
+STATE_DIR = os.getenv("STATE_DIR", "/home/radio/state")
+
+# Rolling chunks of audio uploaded to S3, 0 to upload every segment
+CHUNK_SECONDS = int(os.getenv("CHUNK_SECONDS", 60))
+
+# Interval of the HTTP connection stats in seconds
+STATS_INTERVAL = 3600
+
+# Running hours (UTC+7), e.g. RUNNING_HOURS=0-24 to run all day
+RUNNING_HOURS = range(
+    *[int(hour) for hour in os.getenv("RUNNING_HOURS", "6-22").split("-")]
+)
+
+# Uploaded segments, queried by compaction
+catalog = SegmentCatalog()
+
+# Last upload of each channel, queried by the alert check
+freshness = FreshnessTracker()
+
+# Telegram alerts, delivered in the background
+alerts = AlertSender()
 
 
 def setuplog(verbose):
@@ -46,32 +71,92 @@ def setuplog(verbose):
         logger.setLevel(logging.INFO)
 
 
-def to_alert(
-    bucket_name: str, output_dir: str, interval: int, running_hours=range(6, 22)
-) -> bool:
-    """Fetches the latest timestamp of data and decides to
-    alert or not."""
-    date = datetime.datetime.utcnow().strftime("%Y/%m/%d")
-    prefix = os.path.join(output_dir, date)
-    blobs = list_blob(bucket_name=bucket_name, prefix=prefix)
-    if blobs:
-        latest_timestamp = max(
-            [
-                blob.last_modified
-                for blob in list_blob(bucket_name=bucket_name, prefix=prefix)
-            ]
-        )
-    else:
-        latest_timestamp = datetime.datetime(2000, 1, 1)
+def to_alert(output_dir: str, interval: int, running_hours=range(6, 22)) -> bool:
+    """Decides to alert or not from the heartbeat of the channel, without any
+    S3 call."""
+    return freshness.is_stale(output_dir, interval) and is_running_hours(running_hours)
+
+
+def is_running_hours(running_hours=RUNNING_HOURS) -> bool:
+    """Checks whether the current hour (UTC+7) is in the running hours."""
     return (
-        (datetime.datetime.utcnow().timestamp() - latest_timestamp.timestamp())
-        > interval
-    ) & (datetime.datetime.utcnow().hour + 7 in running_hours)
+        datetime.datetime.utcnow() + datetime.timedelta(hours=7)
+    ).hour in running_hours
+
+
+def list_new_segments(poller: PlaylistPoller, index: SegmentIndex) -> List[Segment]:
+    """Polls the m3u8 playlists and returns the segments which are not
+    downloaded yet. The returned segments are claimed in the index until their
+    download is done."""
+    new_segments = []
+    for playlist_key, playlist_data, sep in poller.poll():
+        if len(playlist_data.segments) == 0:
+            continue
+
+        # Segments are identified by their EXT-X-MEDIA-SEQUENCE
+        first = playlist_data.media_sequence or 0
+        index.observe(playlist_key, first, first + len(playlist_data.segments) - 1)
+        for i, audio_segment in enumerate(playlist_data.segments):
+            if index.claim(playlist_key, first + i):
+                audio_uri = audio_segment.absolute_uri
+                new_segments.append(
+                    Segment(
+                        uri=audio_uri,
+                        filename=audio_uri.split(sep)[-1],
+                        playlist=playlist_key,
+                        sequence=first + i,
+                        duration=audio_segment.duration or 0.0,
+                    )
+                )
+    return new_segments
+
+
+def alert_if_stale(output: str, alert: int, ex: Exception) -> None:
+    """Queues a Telegram message if the channel has no data in the last alert
+    minutes, the message is sent in the background."""
+    if to_alert(
+        output_dir=output, interval=int(alert) * 60, running_hours=RUNNING_HOURS
+    ):
+        alerts.send(
+            output, f"Channel *{output}*: {ex} !!! No data in the last {alert} minutes."
+        )
+
+
+def seed_freshness(channel: str) -> None:
+    """Seeds the heartbeat of a channel with its latest segment in the catalog,
+    so a restarted collector of an already dead stream alerts at once."""
+    try:
+        latest = catalog.latest(channel)
+    except Exception as ex:
+        logger.exception(ex)
+        return
+    if latest is not None:
+        freshness.beat(channel, latest.timestamp())
 
 
-def download_file_and_upload_to_aws(uri, output_dir, filename) -> None:
+def upload_audio(audio: bytes, object_name: str) -> None:
+    """Uploads audio to SeaweedFS and records it in the segment catalog. A
+    failed write raises, so the channel is neither fresh nor catalogued."""
+    write_buf_to_s3(contents=audio, bucket_name=BUCKET_NAME, object_name=object_name)
+    freshness.beat(parse_key(object_name)[0])
+    try:
+        catalog.add(object_name, len(audio))
+    except Exception as ex:
+        # The catalog is rebuilt from a listing if it is lost
+        logger.exception(ex)
+
+
+def download_file_and_upload_to_aws(
+    segment: Segment,
+    output_dir: str,
+    verify_ssl: bool = True,
+    transcoder: Optional[ChannelTranscoder] = None,
+    coalescer: Optional[SegmentCoalescer] = None,
+) -> Optional[Future]:
     """Download a ts audio and save on the output_dir as the following file:
-    output_dir/date_filename"""
+    output_dir/date_filename. With a coalescer, the audio is appended to the
+    rolling chunk of the playlist and the future of its upload is returned."""
+    uri, filename, sequence = segment.uri, segment.filename, segment.sequence
     try:
         date = datetime.datetime.utcnow().strftime("%Y/%m/%d/%H_%M_%S")
         fpath = os.path.join(
@@ -79,23 +164,45 @@ def download_file_and_upload_to_aws(uri, output_dir, filename) -> None:
         )
 
         logger.info("DOWNLOADING FILE: " + uri)
-        response = get(uri, verify=VERIFY_SSL)
-
-        # Convert audio to mono channel and 16 kHz
-        if not os.path.exists("/home/radio/tmp"):
-            os.makedirs("/home/radio/tmp")
-        with open(os.path.join("/home/radio/tmp", filename), "wb") as fp:
-            fp.write(response.content)
-
-        audio, _ = (
-            ffmpeg.input(os.path.join("/home/radio/tmp", filename))
-            .output("-", format="adts", ar=16000, ac=1)
-            .run(cmd="/home/radio/johnvansickle/ffmpeg", capture_stdout=True)
-        )
-
-        write_buf_to_s3(contents=audio, bucket_name=BUCKET_NAME, object_name=fpath)
+        if transcoder is None:
+            with get_session(uri).get(
+                uri, verify=verify_ssl, timeout=30, stream=True
+            ) as response:
+                response.raise_for_status()
+
+                # Convert audio to mono channel and 16 kHz, streaming the
+                # response body through ffmpeg pipes
+                audio = transcode_stream(response.iter_content(chunk_size=2**16))
+        else:
+            response = get_session(uri).get(uri, verify=verify_ssl, timeout=30)
+            response.raise_for_status()
+
+            # Convert audio to mono channel and 16 kHz with the warm ffmpeg
+            # process of the playlist, other containers than MPEG-TS cannot be
+            # concatenated and use their own process
+            if is_mpegts(response.content):
+                audio = transcoder.transcode(
+                    sequence, response.content, segment.duration
+                )
+            else:
+                transcoder.skip(sequence)
+                audio = transcode_stream([response.content])
+
+        if not audio:
+            # The audio is returned with the next segment
+            logger.debug("NO AUDIO YET FOR " + uri)
+            return
+
+        if coalescer is not None:
+            return coalescer.add(
+                key=os.path.join(output_dir, segment.playlist),
+                object_name=fpath,
+                sequence=sequence,
+                audio=audio,
+                duration=segment.duration,
+            )
 
-        os.remove(os.path.join("/home/radio/tmp", filename))
+        upload_audio(audio, fpath)
 
         logger.debug("FINISHED WRITING " + uri + " TO S3: " + fpath)
 
@@ -104,131 +211,148 @@ def download_file_and_upload_to_aws(uri, output_dir, filename) -> None:
         # raise Exception("Fake exception!")
     except Exception as ex:
         logger.exception(ex)
+        if transcoder is not None:
+            transcoder.skip(sequence)
 
         # Re-raise exception to catch it from outside
         raise Exception(f"Cannot download file and upload to S3 due to: {ex}")
 
 
+def make_coalescer(chunk_seconds: int) -> Optional[SegmentCoalescer]:
+    """Returns the coalescer uploading rolling chunks to SeaweedFS, or None if
+    every segment is uploaded on its own."""
+    if chunk_seconds <= 0:
+        return None
+    return SegmentCoalescer(upload=upload_audio, chunk_seconds=chunk_seconds)
+
+
+def exit_on_sigterm() -> None:
+    """Exits on SIGTERM, sent by docker stop, as on SIGINT so the cleanup of
+    the pending chunks runs."""
+
+    def handler(signum, frame):
+        raise SystemExit(128 + signum)
+
+    signal.signal(signal.SIGTERM, handler)
+
+
 @click.command()
 @click.option("--url", default=os.getenv("M3U8_URL"), help="URL to HLS m3u8 playlist")
 @click.option(
-    "--freq", default=10, help="Frequency for downloading the HLS m3u8 stream"
+    "--freq",
+    default=10,
+    help="Frequency for downloading the HLS m3u8 stream without EXT-X-TARGETDURATION",
 )
 @click.option(
     "--output", default=os.getenv("OUTPUT_DIR"), help="Output directory for audio files"
 )
+@click.option("--workers", default=4, help="Number of concurrent downloads")
+@click.option(
+    "--persistent-ffmpeg/--no-persistent-ffmpeg",
+    default=True,
+    help="Transcode with one warm ffmpeg process per playlist",
+)
+@click.option(
+    "--chunk-seconds",
+    default=CHUNK_SECONDS,
+    help="Seconds of audio coalesced into one object, 0 to upload every segment",
+)
 @click.option("--verbose", is_flag=True, help="Verbose")
 @click.option("--alert", default=os.getenv("ALERT"), help="Alert interval in minute")
-def fetch_hls_stream(url, freq, output, verbose, alert):
+def fetch_hls_stream(
+    url, freq, output, workers, persistent_ffmpeg, chunk_seconds, verbose, alert
+):
     """Fetches a HLS stream by periodically retrieving the m3u8 url for new
-    playlist audio files every freq seconds. For each segment that exists,
-    it downloads them to the output directory as a AAC audio file."""
+    playlist audio files every half target duration. For each segment that
+    exists, it downloads them to the output directory as a AAC audio file."""
+    # Playlists of the HLS stream
+    poller = PlaylistPoller(url=url, freq=freq)
 
-    global VERIFY_SSL
-    VERIFY_SSL = True
+    # Download Pool, at most 2 segments per worker are in flight
+    dlpool = DownloadPipeline(max_workers=workers)
+    set_pool_maxsize(workers + 1)
 
+    # Segments that we have already downloaded
+    index = SegmentIndex(path=os.path.join(STATE_DIR, f"{output}.index.json"))
+
+    # Warm ffmpeg processes of the playlists
+    transcoders = TranscoderPool() if persistent_ffmpeg else None
+
+    # Rolling chunks of the playlists
+    coalescer = make_coalescer(chunk_seconds=chunk_seconds)
+
+    # Compact the hour blocks to reduce size and upload to AWS S3
+    stop_compaction = start_incremental(channels=[output], running_hours=RUNNING_HOURS)
+
+    exit_on_sigterm()
     try:
         setuplog(verbose)
+        seed_freshness(output)
 
         if not os.path.exists(output):
             os.makedirs(output)
 
+        last_stats = time.time()
         while True:
-            if (
-                datetime.datetime.utcnow() + datetime.timedelta(hours=7)
-            ).hour in RUNNING_HOURS:
-                # Retrieve the main m3u8 dynamic playlist file
-                try:
-                    dynamic_playlist = m3u8.load(url, verify_ssl=VERIFY_SSL)
-                except Exception as ex:
-                    logger.exception(ex)
-                    VERIFY_SSL = False
-                if len(dynamic_playlist.playlists) > 0:
-                    # Retrieve the real m3u8 playlist file from the dynamic one
-                    for playlist in dynamic_playlist.playlists:
-                        # Check if we have each segment in the playlist file
-                        playlist_data = m3u8.load(
-                            playlist.absolute_uri, verify_ssl=VERIFY_SSL
-                        )
-
-                        for audio_segment in playlist_data.segments:
-                            # Since the playlist changes names dynamically we use the
-                            # last part of the uri (vfname) to identify segments
-                            audio_uri = audio_segment.absolute_uri
-                            audio_fname = audio_uri.split("_")[-1]
-
-                            if audio_fname not in dlset:
-                                dlset.add(audio_fname)
-                                task = dlpool.submit(
-                                    download_file_and_upload_to_aws,
-                                    audio_uri,
-                                    output,
-                                    audio_fname,
-                                )
-
-                                # Exception handling outside the task submit()
-                                # => the task has to raise Exception first.
-                                _ = task.result()
-                elif len(dynamic_playlist.segments) > 0:
-                    # Dynamic playlist file is also a playlist
-                    playlist_data = deepcopy(dynamic_playlist)
-
-                    for audio_segment in playlist_data.segments:
-                        # Since the playlist changes names dynamically we use the
-                        # last part of the uri (vfname) to identify segments
-                        audio_uri = audio_segment.absolute_uri
-                        audio_fname = audio_uri.split("/")[-1]
-
-                        if audio_fname not in dlset:
-                            dlset.add(audio_fname)
-                            task = dlpool.submit(
-                                download_file_and_upload_to_aws,
-                                audio_uri,
-                                output,
-                                audio_fname,
-                            )
-
-                            # Exception handling outside the task submit()
-                            # => the task has to raise Exception first.
-                            _ = task.result()
-            else:
-                # Run compaction to reduce size and upload to AWS S3
-                today = datetime.datetime.utcnow().strftime("%Y%m%d")
-                if not os.path.exists(f"/tmp/{output}.cache.json"):
-                    with open(f"/tmp/{output}.cache.json", "w", encoding="utf-8") as f:
-                        json.dump(
-                            {today: False},
-                            f,
-                            ensure_ascii=False,
-                            indent=4,
+            try:
+                if time.time() - last_stats > STATS_INTERVAL:
+                    log_connection_stats()
+                    last_stats = time.time()
+
+                if is_running_hours():
+                    new_segments = list_new_segments(poller=poller, index=index)
+                    if transcoders is not None:
+                        transcoders.check()
+                    if coalescer is not None:
+                        coalescer.flush_expired()
+
+                    # The transcoders feed the segments from the lowest one
+                    if transcoders is not None:
+                        for segment in new_segments:
+                            transcoders.get(segment.playlist).schedule(segment.sequence)
+
+                    # Blocks only when the download pool is saturated
+                    for segment in new_segments:
+                        task = dlpool.submit(
+                            download_file_and_upload_to_aws,
+                            segment,
+                            output,
+                            poller.verify_ssl,
+                            transcoders.get(segment.playlist) if transcoders else None,
+                            coalescer,
                         )
-                completion_flag = json.load(open(f"/tmp/{output}.cache.json", "r"))
-                if not completion_flag.get(today, False):
-                    compaction_main(channel=output, running_hours=RUNNING_HOURS)
-                    completion_flag[today] = True
-                    with open(f"/tmp/{output}.cache.json", "w", encoding="utf-8") as f:
-                        json.dump(
-                            completion_flag,
-                            f,
-                            ensure_ascii=False,
-                            indent=4,
+                        task.add_done_callback(
+                            partial(index.on_done, segment.playlist, segment.sequence)
                         )
-                else:
-                    logger.info("SLEEPING")
 
-            # Sleep until next check
-            time.sleep(freq)
-    except Exception as ex:
-        logger.exception(ex)
-        if to_alert(
-            bucket_name=BUCKET_NAME,
-            output_dir=output,
-            interval=int(alert) * 60,
-            running_hours=RUNNING_HOURS,
-        ):
-            telebot_send_message(
-                f"Channel *{output}*: {ex} !!! No data in the last {alert} minutes."
-            )
+                    # Alert on the failed downloads without waiting for the
+                    # in-flight ones
+                    errors = dlpool.collect_errors()
+                    if errors:
+                        alert_if_stale(output=output, alert=alert, ex=errors[-1])
+
+                    # Sleep until the playlists are expected to change
+                    time.sleep(poller.next_delay())
+                else:
+                    if transcoders is not None:
+                        transcoders.close()
+                    if coalescer is not None:
+                        coalescer.flush()
+
+                    # Sleep until next check
+                    time.sleep(freq)
+            except Exception as ex:
+                # Failures are alerted, the channel keeps being fetched
+                logger.exception(ex)
+                alert_if_stale(output=output, alert=alert, ex=ex)
+                time.sleep(freq)
+    finally:
+        stop_compaction.set()
+        dlpool.shutdown(wait=True)
+        if transcoders is not None:
+            transcoders.close()
+        if coalescer is not None:
+            coalescer.flush()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,301 @@
+"""
+Single-process ingest engine which runs every channel of radio_channels.yaml
+as an asyncio task, sharing one interpreter and one download pool.
+"""
+
+import asyncio
+import logging
+import os
+import signal
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from pathlib import Path
+from typing import Optional
+
+import click
+import yaml
+
+sys.path.append(Path(__file__).parent.absolute().as_posix())  # Add radio/ to root path
+
+from compaction import start_incremental
+from fetch_hls_stream import (
+    CHUNK_SECONDS,
+    RUNNING_HOURS,
+    STATE_DIR,
+    STATS_INTERVAL,
+    alert_if_stale,
+    download_file_and_upload_to_aws,
+    is_running_hours,
+    list_new_segments,
+    make_coalescer,
+    seed_freshness,
+    setuplog,
+)
+from utils.coalesce import SegmentCoalescer
+from utils.hls import PlaylistPoller
+from utils.http import log_connection_stats, set_pool_maxsize
+from utils.segment_index import SegmentIndex
+from utils.transcode import TranscoderPool
+
+# Logger
+logger = logging.getLogger("fetch_hls_stream")
+
+
+def load_channels(channels_file: str) -> dict:
+    """Reads the channels and their M3U8 url from radio_channels.yaml."""
+    with open(channels_file, "r") as fp:
+        channels = yaml.safe_load(fp)
+    return {
+        channel: config["M3U8_URL"] for channel, config in channels["channels"].items()
+    }
+
+
+async def run_channel(
+    channel: str,
+    url: str,
+    freq: int,
+    alert: int,
+    executor: ThreadPoolExecutor,
+    poll_executor: ThreadPoolExecutor,
+    inflight: asyncio.Semaphore,
+    channel_workers: int = 4,
+    transcoders: Optional[TranscoderPool] = None,
+    coalescer: Optional[SegmentCoalescer] = None,
+) -> None:
+    """Polls the playlist of one channel forever. Polls run on their own
+    executor and the blocking downloads (requests, ffmpeg and boto3) on the
+    shared one, with at most channel_workers in flight for the channel, so a
+    slow channel never holds every download thread nor delays the polls of
+    the others. Any failure is logged and alerted without stopping the channel
+    or the other channels."""
+    loop = asyncio.get_running_loop()
+    # Segments of this channel that we have already downloaded
+    index = SegmentIndex(path=os.path.join(STATE_DIR, f"{channel}.index.json"))
+    # Playlists of this channel
+    poller = PlaylistPoller(url=url, freq=freq)
+    pending = set()
+    channel_inflight = asyncio.Semaphore(channel_workers)
+    await loop.run_in_executor(poll_executor, seed_freshness, channel)
+
+    def release(future: asyncio.Future) -> None:
+        channel_inflight.release()
+        inflight.release()
+
+    def fail(ex: Exception) -> None:
+        logger.error(f"Channel {channel}: {ex}", exc_info=ex)
+        # Only queued, the alerts are sent in the background
+        try:
+            alert_if_stale(channel, alert, ex)
+        except Exception as alert_ex:
+            logger.exception(alert_ex)
+
+    while True:
+        delay = freq
+        try:
+            if is_running_hours():
+                new_segments = await loop.run_in_executor(
+                    poll_executor, list_new_segments, poller, index
+                )
+
+                # The transcoders feed the segments from the lowest one
+                if transcoders is not None:
+                    for segment in new_segments:
+                        transcoders.get(f"{channel}/{segment.playlist}").schedule(
+                            segment.sequence
+                        )
+
+                for segment in new_segments:
+                    # Limits of downloads of the channel and of all channels
+                    await channel_inflight.acquire()
+                    await inflight.acquire()
+                    task = loop.run_in_executor(
+                        executor,
+                        download_file_and_upload_to_aws,
+                        segment,
+                        channel,
+                        poller.verify_ssl,
+                        (
+                            transcoders.get(f"{channel}/{segment.playlist}")
+                            if transcoders
+                            else None
+                        ),
+                        coalescer,
+                    )
+                    task.add_done_callback(release)
+                    task.add_done_callback(
+                        partial(index.on_done, segment.playlist, segment.sequence)
+                    )
+                    pending.add(task)
+
+                # Surface the errors of every finished download
+                done = {task for task in pending if task.done()}
+                pending -= done
+                for task in done:
+                    if task.exception() is not None:
+                        fail(task.exception())
+
+                # Sleep until the playlists are expected to change
+                delay = poller.next_delay()
+        except Exception as ex:
+            fail(ex)
+
+        # Sleep until next check
+        await asyncio.sleep(delay)
+
+
+async def log_stats(interval: int) -> None:
+    """Logs the HTTP connection reuse of all channels every interval seconds."""
+    while True:
+        await asyncio.sleep(interval)
+        log_connection_stats()
+
+
+async def check_transcoders(transcoders: TranscoderPool, interval: int) -> None:
+    """Restarts the dead ffmpeg processes every interval seconds, and stops them
+    outside the running hours."""
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(interval)
+        if is_running_hours():
+            await loop.run_in_executor(None, transcoders.check)
+        else:
+            await loop.run_in_executor(None, transcoders.close)
+
+
+async def flush_chunks(coalescer: SegmentCoalescer, interval: int) -> None:
+    """Uploads the chunks of the stalled playlists every interval seconds."""
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(interval)
+        await loop.run_in_executor(None, coalescer.flush_expired)
+
+
+async def run_all_channels(
+    channels: dict,
+    freq: int,
+    alert: int,
+    workers: int,
+    channel_workers: int = 4,
+    persistent_ffmpeg: bool = True,
+    chunk_seconds: int = CHUNK_SECONDS,
+) -> None:
+    """Runs all the channels concurrently on one event loop."""
+    executor = ThreadPoolExecutor(max_workers=workers)
+    # One poll per channel at a time, never behind the downloads
+    poll_executor = ThreadPoolExecutor(max_workers=len(channels))
+    inflight = asyncio.Semaphore(workers)
+    # Every download and poll thread may fetch from the same host
+    set_pool_maxsize(workers + len(channels))
+    # A channel keeps download threads free for the others
+    channel_workers = max(1, min(channel_workers, workers - 1))
+    transcoders = TranscoderPool() if persistent_ffmpeg else None
+    coalescer = make_coalescer(chunk_seconds=chunk_seconds)
+    background = [log_stats(interval=STATS_INTERVAL)]
+    if transcoders is not None:
+        background.append(check_transcoders(transcoders=transcoders, interval=freq))
+    if coalescer is not None:
+        background.append(flush_chunks(coalescer=coalescer, interval=freq))
+
+    # Compact the hour blocks to reduce size and upload to AWS S3
+    stop_compaction = start_incremental(
+        channels=list(channels.keys()), running_hours=RUNNING_HOURS
+    )
+
+    # docker stop sends SIGTERM, the channels are cancelled and the pending
+    # chunks flushed
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    try:
+        await asyncio.gather(
+            *[
+                run_channel(
+                    channel=channel,
+                    url=url,
+                    freq=freq,
+                    alert=alert,
+                    executor=executor,
+                    poll_executor=poll_executor,
+                    inflight=inflight,
+                    channel_workers=channel_workers,
+                    transcoders=transcoders,
+                    coalescer=coalescer,
+                )
+                for channel, url in channels.items()
+            ],
+            *background,
+        )
+    except asyncio.CancelledError:
+        logger.info("Stopping on SIGTERM")
+    finally:
+        loop.remove_signal_handler(signal.SIGTERM)
+        stop_compaction.set()
+        poll_executor.shutdown(wait=True)
+        executor.shutdown(wait=True)
+        if transcoders is not None:
+            transcoders.close()
+        if coalescer is not None:
+            coalescer.flush()
+
+
+@click.command()
+@click.option(
+    "--channels",
+    default=os.getenv("CHANNELS_FILE", "radio_channels.yaml"),
+    help="YAML file of the channels",
+)
+@click.option(
+    "--freq",
+    default=10,
+    help="Frequency for downloading the HLS m3u8 stream without EXT-X-TARGETDURATION",
+)
+@click.option(
+    "--workers", default=16, help="Number of concurrent downloads of all channels"
+)
+@click.option(
+    "--channel-workers",
+    default=4,
+    help="Number of concurrent downloads of one channel, lower than --workers",
+)
+@click.option(
+    "--persistent-ffmpeg/--no-persistent-ffmpeg",
+    default=True,
+    help="Transcode with one warm ffmpeg process per playlist",
+)
+@click.option(
+    "--chunk-seconds",
+    default=CHUNK_SECONDS,
+    help="Seconds of audio coalesced into one object, 0 to upload every segment",
+)
+@click.option("--verbose", is_flag=True, help="Verbose")
+@click.option("--alert", default=os.getenv("ALERT"), help="Alert interval in minute")
+def ingest(
+    channels,
+    freq,
+    workers,
+    channel_workers,
+    persistent_ffmpeg,
+    chunk_seconds,
+    verbose,
+    alert,
+):
+    """Fetches the HLS streams of all channels in a single process."""
+    setuplog(verbose)
+
+    channels = load_channels(channels)
+    logger.info("Ingesting {} channels".format(len(channels)))
+    asyncio.run(
+        run_all_channels(
+            channels=channels,
+            freq=freq,
+            alert=alert,
+            workers=workers,
+            channel_workers=channel_workers,
+            persistent_ffmpeg=persistent_ffmpeg,
+            chunk_seconds=chunk_seconds,
+        )
+    )
+
+
+if __name__ == "__main__":
+    ingest()
@@ -0,0 +1,23 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.append(
+    Path(__file__).parent.parent.absolute().as_posix()
+)  # Add radio/ to root path
+
+from benchmarks.fakes import FakeS3
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    """In-memory S3 behind every backend of utils.aws."""
+    from utils import aws
+
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    with FakeS3() as fake:
+        monkeypatch.setattr(aws, "S3_ENDPOINT_URL", fake.url)
+        monkeypatch.setattr(aws, "clients", {})
+        monkeypatch.setattr(aws, "resources", type(aws.resources)())
+        yield fake
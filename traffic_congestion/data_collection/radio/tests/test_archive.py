@@ -0,0 +1,41 @@
+import io
+import sys
+from pathlib import Path
+
+sys.path.append(
+    Path(__file__).parent.parent.absolute().as_posix()
+)  # Add radio/ to root path
+
+from benchmarks.fakes import S3Object
+from configs import S3Configuration
+from utils.archive import INDEX_SUFFIX, ArchiveReader, SeekableArchive
+from utils.codec import ArchiveCodec
+
+
+def test_archive_reader_fetches_clips_with_range_gets(s3):
+    segments = [bytes([i]) * (1000 + i) for i in range(6)]
+    fp = io.BytesIO()
+    with SeekableArchive(fp, ArchiveCodec("gz", 1)) as archive:
+        for i, data in enumerate(segments):
+            archive.add(f"{i}.aac", data, timestamp=1000.0 + 10 * i, duration=10.0)
+    namespace = S3Configuration.AWS_SEAWEEDFS_KEY_ID
+    block, index = fp.getvalue(), archive.index()
+    s3.store(namespace, "radio-project", "voh/03.tar.gz", S3Object(block))
+    s3.store(
+        namespace, "radio-project", "voh/03.tar.gz" + INDEX_SUFFIX, S3Object(index)
+    )
+
+    reader = ArchiveReader("radio-project", "voh/03.tar.gz")
+    counters = s3.counters[namespace]
+    gets, bytes_out = counters["get"], counters["bytes_out"]
+
+    # Segments 2 to 4 overlap the clip, their frames are fetched at once
+    assert reader.clip(1025.0, 1045.0) == b"".join(segments[2:5])
+    assert counters["get"] - gets == 2  # the index, then one Range GET
+    frames = sum(segment["length"] for segment in reader.segments()[2:5])
+    assert counters["bytes_out"] - bytes_out == len(index) + frames
+
+    # Disjoint segments cost a Range GET each, the index is cached
+    first, last = reader.segments()[0], reader.segments()[5]
+    assert list(reader.read([last, first])) == [segments[0], segments[5]]
+    assert counters["get"] - gets == 4
@@ -0,0 +1,175 @@
+import sys
+import threading
+from pathlib import Path
+
+import pytest
+from botocore.exceptions import ClientError
+
+sys.path.append(
+    Path(__file__).parent.parent.absolute().as_posix()
+)  # Add radio/ to root path
+
+from benchmarks.fakes import S3Object
+from configs import S3Configuration
+from utils import aws
+
+
+def test_replicate_raises_when_quorum_is_not_met(monkeypatch):
+    monkeypatch.setattr(aws, "create_client", lambda backend, s3_host: s3_host)
+    denied = ClientError({"Error": {"Code": "AccessDenied"}}, "PutObject")
+    release = threading.Event()
+    done = threading.Event()
+
+    def upload(host):
+        if host == "slow":
+            release.wait()
+        elif host == "denied":
+            raise denied
+
+    # The straggler completes in the background
+    reports = aws.replicate(
+        upload,
+        "voh/a.aac",
+        backend="seaweedfs_cluster",
+        s3_hosts=["ok", "denied", "slow"],
+        quorum=1,
+        on_done=done.set,
+    )
+    assert [report["host"] for report in reports if report["ok"]] == ["ok"]
+    assert not done.is_set()
+    release.set()
+    assert done.wait(1)
+
+    with pytest.raises(ClientError):
+        aws.replicate(
+            upload, "voh/a.aac", backend="seaweedfs_cluster", s3_hosts=["ok", "denied"]
+        )
+
+
+def test_multipart_writer_streams_parts_of_minimum_size(s3):
+    targets = aws.s3_targets(backend="aws") + aws.s3_targets(backend="seaweedfs")
+    writer = aws.MultipartWriter("radio-project", "voh/03.tar", targets, part_size=1)
+    data = bytes(range(256)) * (12 * 2**12)  # 12 MiB
+
+    # Parts are at least 5 MiB, at most one is buffered
+    for i in range(0, len(data), 2**20):
+        writer.write(data[i : i + 2**20])
+        assert len(writer.buf) < 5 * 2**20
+    assert [len(upload["parts"]) for upload in writer.uploads] == [2, 2]
+    assert writer.close()
+
+    for namespace in [S3Configuration.AWS_KEY_ID, S3Configuration.AWS_SEAWEEDFS_KEY_ID]:
+        obj = s3.bucket(namespace, "radio-project")["voh/03.tar"]
+        assert obj.data == data and obj.etag.endswith('-3"')
+
+
+def test_multipart_writer_aborts_and_skips_small_objects(s3):
+    targets = aws.s3_targets(backend="seaweedfs")
+    bucket = s3.bucket(S3Configuration.AWS_SEAWEEDFS_KEY_ID, "radio-project")
+
+    # Less than min_size is never uploaded
+    writer = aws.MultipartWriter("radio-project", "voh/03.tar", targets, min_size=100)
+    writer.write(b"a" * 99)
+    assert not writer.close()
+    assert writer.uploads is None and "voh/03.tar" not in bucket
+
+    # Aborted uploads discard their parts
+    writer = aws.MultipartWriter(
+        "radio-project", "voh/04.tar", targets, part_size=5 * 2**20
+    )
+    writer.write(b"a" * 6 * 2**20)
+    assert len(s3.uploads) == 1
+    writer.abort()
+    assert s3.uploads == {} and "voh/04.tar" not in bucket
+
+
+def test_delete_blobs_sends_batches_of_1000_keys(s3):
+    namespace = S3Configuration.AWS_SEAWEEDFS_KEY_ID
+    keys = ["voh/{:04d}.aac".format(i) for i in range(2500)]
+    for key in keys:
+        s3.store(namespace, "radio-project", key, S3Object(b"a"))
+
+    # A dry run only logs the batches
+    assert aws.delete_blobs("radio-project", keys, batch_size=5000, dry_run=True) == {}
+    assert len(s3.bucket(namespace, "radio-project")) == 2500
+    assert s3.counters[namespace]["delete_objects"] == 0
+
+    assert aws.delete_blobs("radio-project", keys[:-1], batch_size=5000) == {}
+    assert list(s3.bucket(namespace, "radio-project")) == ["voh/2499.aac"]
+    assert s3.counters[namespace]["delete_objects"] == 3
+    assert s3.counters[namespace]["delete"] == 2499
+
+
+def store_hours(s3, keys) -> None:
+    for key in keys:
+        s3.store(
+            S3Configuration.AWS_SEAWEEDFS_KEY_ID,
+            "radio-project",
+            key,
+            S3Object(key.encode()),
+        )
+
+
+def test_iter_blobs_lists_pages_in_key_order(s3):
+    keys = [f"voh/2024/01/0{day}/0{hour}/a.aac" for day in (1, 2) for hour in (0, 1)]
+    store_hours(s3, keys + ["vov1/2024/01/01/00/a.aac"])
+    namespace = S3Configuration.AWS_SEAWEEDFS_KEY_ID
+
+    blobs = list(aws.iter_blobs("radio-project", "voh/", page_size=3))
+    assert [blob.key for blob in blobs] == keys
+    assert blobs[0].size == len(keys[0])
+    assert s3.counters[namespace]["list"] == 2
+
+    # The listing resumes after a key
+    blobs = aws.iter_blobs("radio-project", "voh/", start_after=keys[1])
+    assert [blob.key for blob in blobs] == keys[2:]
+
+    # The replicas of the cluster are listed once
+    blobs = aws.iter_blobs(
+        "radio-project", "voh/", backend="seaweedfs_cluster", s3_hosts=["a", "b"]
+    )
+    assert [blob.key for blob in blobs] == keys
+
+
+def test_partitioned_listing_of_the_days(s3):
+    keys = [f"voh/2024/0{month}/0{day}/00/a.aac" for month in (1, 2) for day in (1, 2)]
+    store_hours(s3, keys)
+
+    prefixes = aws.list_prefixes("radio-project", "voh", depth=3)
+    assert prefixes == [key[: len("voh/2024/01/01/")] for key in keys]
+
+    blobs = aws.iter_blobs_partitioned("radio-project", prefixes, max_workers=2)
+    assert sorted(blob.key for blob in blobs) == keys
+
+
+def test_clients_are_cached_per_backend_and_host(monkeypatch):
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    monkeypatch.setattr(aws, "S3_ENDPOINT_URL", None)
+    monkeypatch.setattr(aws, "clients", {})
+    monkeypatch.setattr(aws, "resources", threading.local())
+
+    client = aws.create_client(backend="seaweedfs", s3_host="11.11.1.89")
+    assert aws.create_client(backend="seaweedfs", s3_host="11.11.1.89") is client
+    assert client.meta.endpoint_url == "http://11.11.1.89:8333"
+    other = aws.create_client(backend="seaweedfs", s3_host="11.11.1.90")
+    assert other is not client
+    assert aws.create_client(backend="aws") not in (client, other)
+
+    # Resources are cached per thread
+    resource = aws.create_client(service_type="resource", backend="aws")
+    assert aws.create_client(service_type="resource", backend="aws") is resource
+    resources = []
+    thread = threading.Thread(
+        target=lambda: resources.append(
+            aws.create_client(service_type="resource", backend="aws")
+        )
+    )
+    thread.start()
+    thread.join()
+    assert resources[0] is not resource
+
+
+def test_endpoint_override_of_every_backend(s3):
+    for backend, s3_host in [("seaweedfs", "11.11.1.89"), ("aws", None)]:
+        client = aws.create_client(backend=backend, s3_host=s3_host)
+        assert client.meta.endpoint_url == s3.url
@@ -0,0 +1,60 @@
+import datetime
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+sys.path.append(
+    Path(__file__).parent.parent.absolute().as_posix()
+)  # Add radio/ to root path
+
+from utils.catalog import SegmentCatalog
+
+
+def test_catalog_hour_blocks(tmp_path):
+    catalog = SegmentCatalog(path=str(tmp_path / "catalog.db"))
+    assert not catalog.has("voh")
+    assert catalog.latest("voh") is None
+
+    catalog.add("voh/2024/05/01/03_00_10_media_1_mono_16khz.aac", 10, 100.0)
+    catalog.add("voh/2024/05/01/03_01_10_media_2_mono_16khz.aac", 10, 160.0)
+    catalog.add("voh/2024/05/01/04_00_05_media_3_mono_16khz.aac", 10, 3700.0)
+    catalog.add("vov/2024/05/01/05_00_05_media_1_mono_16khz.aac", 10, 9000.0)
+
+    assert catalog.has("voh") and not catalog.rebuilt("voh")
+    assert catalog.hours("voh") == ["2024/05/01/03", "2024/05/01/04"]
+    assert catalog.keys("voh", "2024/05/01/03") == [
+        "voh/2024/05/01/03_00_10_media_1_mono_16khz.aac",
+        "voh/2024/05/01/03_01_10_media_2_mono_16khz.aac",
+    ]
+    assert catalog.latest("voh").timestamp() == 3700.0
+
+    catalog.remove(catalog.keys("voh", "2024/05/01/03"))
+    assert catalog.hours("voh") == ["2024/05/01/04"]
+
+
+def test_catalog_rebuild_from_listing(tmp_path):
+    catalog = SegmentCatalog(path=str(tmp_path / "catalog.db"))
+    last_modified = datetime.datetime(2024, 5, 1, 3, tzinfo=datetime.timezone.utc)
+    blobs = [
+        SimpleNamespace(
+            key="voh/2024/05/01/03_00_10_media_1_mono_16khz.aac",
+            size=10,
+            last_modified=last_modified,
+        ),
+        SimpleNamespace(key="voh/unexpected.aac", size=10, last_modified=None),
+    ]
+
+    assert catalog.rebuild("voh", blobs) == 1
+    assert catalog.rebuilt("voh")
+    assert catalog.latest("voh") == last_modified
+
+
+def test_catalog_archive_manifest(tmp_path):
+    catalog = SegmentCatalog(path=str(tmp_path / "catalog.db"))
+    catalog.add_archive("voh|2024|05|01|03", "voh/2024/05/01/03.tar.gz", 10**8)
+    catalog.add_archive("voh|2024|05|01|04", None, 0)
+    catalog.add_archive("vov|2024|05|01|03", "vov/2024/05/01/03.tar.gz", 10**8)
+
+    # Restarted collectors read the manifest back
+    catalog = SegmentCatalog(path=str(tmp_path / "catalog.db"))
+    assert catalog.archived("voh") == {"voh|2024|05|01|03", "voh|2024|05|01|04"}
@@ -0,0 +1,47 @@
+import sys
+from concurrent.futures import Future
+from pathlib import Path
+
+sys.path.append(
+    Path(__file__).parent.parent.absolute().as_posix()
+)  # Add radio/ to root path
+
+from utils.coalesce import SegmentCoalescer
+from utils.segment_index import SegmentIndex
+
+
+def test_coalescer_uploads_rolling_chunks():
+    uploads = []
+    coalescer = SegmentCoalescer(
+        upload=lambda audio, object_name: uploads.append((object_name, audio)),
+        chunk_seconds=30,
+    )
+
+    # Segments finishing out of order are appended by media sequence
+    futures = [
+        coalescer.add("voh/0", f"voh/{seq}.aac", seq, bytes([seq]), 10.0)
+        for seq in (1, 0, 2, 3)
+    ]
+    assert uploads == [("voh/1.aac", bytes([0, 1, 2]))]
+    assert all(future.done() for future in futures[:3])
+    assert not futures[3].done()
+
+    coalescer.flush()
+    assert uploads[1] == ("voh/3.aac", bytes([3]))
+    assert futures[3].done()
+
+
+def test_segments_are_completed_when_their_chunk_is_uploaded():
+    coalescer = SegmentCoalescer(upload=lambda audio, object_name: None)
+    index = SegmentIndex()
+    index.observe("0", 0, 0)
+    index.claim("0", 0)
+
+    download = Future()
+    download.set_result(coalescer.add("voh/0", "voh/0.aac", 0, b"audio", 10.0))
+    index.on_done("0", 0, download)
+    assert ("0", 0) in index.inflight
+
+    coalescer.flush()
+    assert ("0", 0) not in index.inflight
+    assert not index.claim("0", 0)
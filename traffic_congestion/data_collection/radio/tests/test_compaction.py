@@ -0,0 +1,100 @@
+import datetime
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.append(
+    Path(__file__).parent.parent.absolute().as_posix()
+)  # Add radio/ to root path
+
+import compaction
+from benchmarks.fakes import S3Object
+from configs import S3Configuration
+from utils import aws, codec
+from utils.catalog import SegmentCatalog
+from utils.codec import ArchiveCodec
+
+
+def test_plan_wraps_local_hours(tmp_path, monkeypatch):
+    catalog = SegmentCatalog(path=str(tmp_path / "catalog.db"))
+    monkeypatch.setattr(compaction, "SegmentCatalog", lambda: catalog)
+    catalog.rebuild("voh", [])
+    catalog.add_archive("voh|2024|05|01|00", None, 0)
+
+    # 18h UTC is 01h local time, inside the running hours of the whole day
+    catalog.add("voh/2024/05/01/18_00_10_media_1_mono_16khz.aac", 10)
+    s3_compress, _ = compaction.plan("voh", running_hours=range(0, 24))
+    assert list(s3_compress) == ["voh|2024|05|01|18"]
+
+    # and outside of the daytime ones
+    s3_compress, s3_garbage = compaction.plan("voh", running_hours=range(6, 22))
+    assert s3_compress == {}
+    assert s3_garbage == ["voh/2024/05/01/18_00_10_media_1_mono_16khz.aac"]
+
+
+def test_run_refuses_missing_codecs(monkeypatch):
+    monkeypatch.setattr(codec, "zstandard", None)
+    monkeypatch.setattr(compaction, "plan", pytest.fail)
+
+    with pytest.raises(ImportError):
+        compaction.run(channels=["voh"], codec=ArchiveCodec("zstd", 3))
+    with pytest.raises(NotImplementedError):
+        compaction.run(channels=["voh"], codec=ArchiveCodec("xz"))
+
+
+def test_dry_run_keeps_the_garbage(tmp_path, monkeypatch):
+    catalog = SegmentCatalog(path=str(tmp_path / "catalog.db"))
+    monkeypatch.setattr(compaction, "SegmentCatalog", lambda: catalog)
+    monkeypatch.setattr(aws, "create_client", lambda backend: pytest.fail)
+    catalog.rebuild("voh", [])
+    # 23h local time, only garbage
+    catalog.add("voh/2024/05/01/16_00_10_media_1_mono_16khz.aac", 10)
+
+    compaction.run(channels=["voh"], dry_run=True)
+    assert catalog.hours("voh") == ["2024/05/01/16"]
+
+
+def test_small_blocks_are_planned_again(tmp_path, monkeypatch, s3):
+    catalog = SegmentCatalog(path=str(tmp_path / "catalog.db"))
+    monkeypatch.setattr(compaction, "SegmentCatalog", lambda: catalog)
+    # The spawned workers reach the fake S3 through the environment
+    monkeypatch.setenv("S3_ENDPOINT_URL", s3.url)
+    catalog.rebuild("voh", [])
+    hour = datetime.datetime.utcnow() - datetime.timedelta(hours=3)
+    block = hour.strftime("voh|%Y|%m|%d|%H")
+    key = hour.strftime("voh/%Y/%m/%d/%H_00_10_media_1_mono_16khz.aac")
+    s3.store(S3Configuration.AWS_SEAWEEDFS_KEY_ID, "radio-project", key, S3Object(b"a"))
+    catalog.add(key, 1)
+
+    # Less than 10 MB, nothing is uploaded and the block is kept for next run
+    compaction.run(channels=["voh"], running_hours=range(0, 24), workers=1)
+    assert block not in catalog.archived("voh")
+    s3_compress, _ = compaction.plan("voh", running_hours=range(0, 24))
+    assert list(s3_compress) == [block]
+
+
+def test_run_compacts_blocks_in_worker_processes(tmp_path, monkeypatch, s3):
+    catalog = SegmentCatalog(path=str(tmp_path / "catalog.db"))
+    monkeypatch.setattr(compaction, "SegmentCatalog", lambda: catalog)
+    monkeypatch.setenv("S3_ENDPOINT_URL", s3.url)
+    catalog.rebuild("voh", [])
+    blocks = []
+    for hours in (3, 4):
+        hour = datetime.datetime.utcnow() - datetime.timedelta(hours=hours)
+        blocks.append(hour.strftime("voh|%Y|%m|%d|%H"))
+        key = hour.strftime("voh/%Y/%m/%d/%H_00_10_media_1_mono_16khz.aac")
+        data = os.urandom(compaction.MIN_ARCHIVE_SIZE + 2**20)
+        s3.store(
+            S3Configuration.AWS_SEAWEEDFS_KEY_ID, "radio-project", key, S3Object(data)
+        )
+        catalog.add(key, len(data))
+
+    compaction.run(channels=["voh"], running_hours=range(0, 24), workers=2)
+    assert set(blocks) <= catalog.archived("voh")
+    bucket = s3.bucket(S3Configuration.AWS_KEY_ID, "radio-project")
+    for block in blocks:
+        output = block.replace("|", "/") + compaction.ARCHIVE_CODEC.extension
+        assert len(bucket[output].data) > compaction.MIN_ARCHIVE_SIZE
+        assert output + compaction.INDEX_SUFFIX in bucket
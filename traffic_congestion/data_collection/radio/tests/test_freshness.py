@@ -0,0 +1,106 @@
+import sys
+import time
+from pathlib import Path
+
+import pytest
+from botocore.exceptions import ClientError
+
+sys.path.append(
+    Path(__file__).parent.parent.absolute().as_posix()
+)  # Add radio/ to root path
+
+import fetch_hls_stream
+from utils import aws, notification
+from utils.catalog import SegmentCatalog
+from utils.freshness import FreshnessTracker
+from utils.notification import AlertSender
+
+
+def test_freshness_heartbeats():
+    freshness = FreshnessTracker(started_at=1000.0)
+    # Channels which never uploaded are measured from the start
+    assert not freshness.is_stale("voh", interval=60, now=1030.0)
+    assert freshness.is_stale("voh", interval=60, now=1100.0)
+
+    freshness.beat("voh", 1090.0)
+    freshness.beat("voh", 1050.0)  # late upload of an older chunk
+    assert freshness.last("voh") == 1090.0
+    assert not freshness.is_stale("voh", interval=60, now=1100.0)
+    assert freshness.is_stale("vov", interval=60, now=1100.0)
+
+
+def test_alert_sender_batches_and_deduplicates():
+    sent = []
+    alerts = AlertSender(send=sent.append, interval=0.2, dedup_seconds=60)
+
+    alerts.send("voh", "voh is stale")
+    alerts.send("vov", "vov is stale")
+    alerts.send("voh", "voh is still stale")
+    time.sleep(0.5)
+    assert sent == ["voh is still stale\nvov is stale"]
+
+    # Already alerted keys are dropped until dedup_seconds
+    alerts.send("voh", "voh is stale again")
+    alerts.send("vtv", "vtv is stale")
+    time.sleep(0.5)
+    assert sent[1:] == ["vtv is stale"]
+
+
+def test_alert_sender_does_not_block_on_failures():
+    def send(message):
+        time.sleep(1)
+        raise ConnectionError("Telegram is down")
+
+    alerts = AlertSender(send=send, interval=0)
+    start = time.perf_counter()
+    for i in range(100):
+        alerts.send(f"channel{i}", "stale")
+    assert time.perf_counter() - start < 0.5
+
+
+def test_failed_uploads_are_not_heartbeats(tmp_path, monkeypatch):
+    class DeniedClient:
+        def upload_fileobj(self, *args):
+            raise ClientError({"Error": {"Code": "AccessDenied"}}, "PutObject")
+
+    catalog = SegmentCatalog(path=str(tmp_path / "catalog.db"))
+    freshness = FreshnessTracker(started_at=1000.0)
+    monkeypatch.setattr(aws, "create_client", lambda backend: DeniedClient())
+    monkeypatch.setattr(fetch_hls_stream, "catalog", catalog)
+    monkeypatch.setattr(fetch_hls_stream, "freshness", freshness)
+
+    with pytest.raises(ClientError):
+        fetch_hls_stream.upload_audio(
+            b"audio", "voh/2024/05/01/03_00_10_media_1_mono_16khz.aac"
+        )
+    assert freshness.last("voh") == 1000.0
+    assert not catalog.has("voh")
+
+    # A restarted collector starts from the latest catalogued segment
+    catalog.add("voh/2024/05/01/03_00_10_media_1_mono_16khz.aac", 10, 900.0)
+    fetch_hls_stream.seed_freshness("voh")
+    assert freshness.last("voh") == 900.0
+
+
+def test_alerts_are_sent_as_query_parameters(monkeypatch):
+    requests = []
+
+    class Response:
+        def __init__(self, ok):
+            self.ok = ok
+
+        def json(self):
+            return {"ok": self.ok, "description": "Bad Request"}
+
+    def get(url, params, timeout):
+        requests.append(params["text"])
+        return Response(ok=len(requests) == 1)
+
+    monkeypatch.setattr(notification.requests, "get", get)
+    assert notification.send_alert("Channel *voh* #1 & *vov*")["ok"]
+    assert requests == ["Channel *voh* #1 & *vov*"]
+
+    # Only the alerts accepted by Telegram are deduplicated
+    alerts = AlertSender(send=notification.send_alert, interval=0)
+    alerts.deliver({"voh": "voh is stale"})
+    assert "voh" not in alerts.sent
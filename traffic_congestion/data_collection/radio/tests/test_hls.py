@@ -0,0 +1,67 @@
+import sys
+from pathlib import Path
+
+import pytest
+from requests.exceptions import HTTPError, RetryError
+
+sys.path.append(
+    Path(__file__).parent.parent.absolute().as_posix()
+)  # Add radio/ to root path
+
+from benchmarks.fakes import FakeHLSOrigin
+from utils import http
+from utils.hls import PlaylistPoller
+
+
+def test_poller_backs_off_on_unchanged_playlists():
+    with FakeHLSOrigin([b"audio"], ["voh"], duration=4.0) as origin:
+        origin.last_sequence = lambda: 9
+        poller = PlaylistPoller(url=origin.url_of("voh"), max_delay=10)
+
+        # The master playlist is resolved, then its variant is fetched
+        ((key, playlist, sep),) = poller.poll()
+        assert (key, sep) == ("0", "_")
+        assert playlist.media_sequence == 5 and len(playlist.segments) == 5
+        assert 1.8 <= poller.next_delay() <= 2.2  # half the target duration
+
+        # Unchanged playlists are 304s, the delay doubles after 2 of them up
+        # to max_delay
+        delays = []
+        for _ in range(6):
+            assert poller.poll() == []
+            delays.append(poller.next_delay())
+        assert [round(delay / 2) for delay in delays[:4]] == [1, 1, 2, 4]
+        assert 9 <= delays[-1] <= 11
+
+        # A new segment resets the cadence
+        origin.last_sequence = lambda: 10
+        ((_, playlist, _),) = poller.poll()
+        assert playlist.media_sequence == 6
+        assert 1.8 <= poller.next_delay() <= 2.2
+
+        # A failed variant resolves the master playlist again
+        origin.channels.clear()
+        with pytest.raises(HTTPError):
+            poller.poll()
+        assert poller.variants is None
+
+
+def test_poller_resolves_again_after_the_retries(monkeypatch):
+    monkeypatch.setattr(http, "sessions", {})
+    monkeypatch.setattr(http, "BACKOFF_FACTOR", 0)
+    with FakeHLSOrigin([b"audio"], ["voh"], duration=4.0) as origin:
+        origin.last_sequence = lambda: 9
+        poller = PlaylistPoller(url=origin.url_of("voh"))
+        poller.poll()
+        assert poller.state["0"]["etag"] == '"9"'
+
+        # 503s until the retries run out, the variants and their ETags are
+        # dropped
+        origin.unavailable = True
+        with pytest.raises(RetryError):
+            poller.poll()
+        assert poller.variants is None and poller.state == {}
+
+        origin.unavailable = False
+        ((_, playlist, _),) = poller.poll()
+        assert playlist.media_sequence == 5
@@ -0,0 +1,57 @@
+import sys
+from pathlib import Path
+
+sys.path.append(
+    Path(__file__).parent.parent.absolute().as_posix()
+)  # Add radio/ to root path
+
+from benchmarks.fakes import FakeHLSOrigin
+from utils import http
+
+
+def test_one_session_per_host(monkeypatch):
+    monkeypatch.setattr(http, "sessions", {})
+    monkeypatch.setattr(http, "pool_maxsize", http.POOL_MAXSIZE)
+
+    session = http.get_session("https://cdn.example.com/voh/playlist.m3u8")
+    assert http.get_session("https://cdn.example.com/voh/0.ts") is session
+    assert http.get_session("https://other.example.com/voh/0.ts") is not session
+
+    # Retries with backoff on the transient errors of GET and HEAD
+    adapter = session.get_adapter("https://cdn.example.com/")
+    assert session.get_adapter("http://cdn.example.com/") is adapter
+    retry = adapter.max_retries
+    assert (retry.total, retry.backoff_factor) == (3, 0.5)
+    assert set(retry.status_forcelist) == {429, 500, 502, 503, 504}
+    assert set(retry.allowed_methods) == {"HEAD", "GET"}
+    assert adapter._pool_maxsize == http.POOL_MAXSIZE
+
+
+def test_pool_maxsize_is_raised_to_the_threads(monkeypatch):
+    monkeypatch.setattr(http, "sessions", {})
+    monkeypatch.setattr(http, "pool_maxsize", http.POOL_MAXSIZE)
+
+    # Never below HTTP_POOL_MAXSIZE, and only for the new sessions
+    http.set_pool_maxsize(1)
+    session = http.get_session("https://cdn.example.com/")
+    assert (
+        session.get_adapter("https://cdn.example.com/")._pool_maxsize
+        == http.POOL_MAXSIZE
+    )
+    http.set_pool_maxsize(64)
+    assert (
+        session.get_adapter("https://cdn.example.com/")._pool_maxsize
+        == http.POOL_MAXSIZE
+    )
+    session = http.get_session("https://other.example.com/")
+    assert session.get_adapter("https://other.example.com/")._pool_maxsize == 64
+
+
+def test_connections_are_reused(monkeypatch):
+    monkeypatch.setattr(http, "sessions", {})
+
+    with FakeHLSOrigin([b"audio"], ["voh"]) as origin:
+        for _ in range(3):
+            http.get_session(origin.url).get(origin.url_of("voh")).raise_for_status()
+        host = origin.url.split("//")[1]
+        assert http.connection_stats() == {host: {"requests": 3, "connections": 1}}
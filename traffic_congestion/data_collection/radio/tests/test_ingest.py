@@ -0,0 +1,112 @@
+import asyncio
+import os
+import signal
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from types import SimpleNamespace
+
+sys.path.append(
+    Path(__file__).parent.parent.absolute().as_posix()
+)  # Add radio/ to root path
+
+import ingest
+
+
+def test_slow_channel_does_not_stall_the_others(tmp_path, monkeypatch):
+    release = threading.Event()
+    polls, alerts = [], []
+
+    def list_new_segments(poller, index):
+        polls.append(poller.url)
+        return [
+            SimpleNamespace(playlist="chunklist", sequence=len(polls) * 10 + i)
+            for i in range(4)
+        ]
+
+    def download(segment, channel, *args):
+        if channel == "slow":
+            release.wait()
+        raise Exception(f"{channel} {segment.sequence}")
+
+    monkeypatch.setattr(ingest, "STATE_DIR", str(tmp_path))
+    monkeypatch.setattr(ingest, "is_running_hours", lambda: True)
+    monkeypatch.setattr(ingest, "seed_freshness", lambda channel: None)
+    monkeypatch.setattr(ingest, "list_new_segments", list_new_segments)
+    monkeypatch.setattr(ingest, "download_file_and_upload_to_aws", download)
+    monkeypatch.setattr(
+        ingest,
+        "PlaylistPoller",
+        lambda url, freq: SimpleNamespace(
+            url=url, verify_ssl=True, next_delay=lambda: 0.05
+        ),
+    )
+    monkeypatch.setattr(
+        ingest, "alert_if_stale", lambda channel, alert, ex: alerts.append(str(ex))
+    )
+
+    async def run() -> None:
+        executor = ThreadPoolExecutor(max_workers=4)
+        poll_executor = ThreadPoolExecutor(max_workers=2)
+        inflight = asyncio.Semaphore(4)
+        channels = [
+            ingest.run_channel(
+                channel=channel,
+                url=channel,
+                freq=1,
+                alert=10,
+                executor=executor,
+                poll_executor=poll_executor,
+                inflight=inflight,
+                channel_workers=2,
+            )
+            for channel in ["slow", "fast"]
+        ]
+        try:
+            await asyncio.wait_for(asyncio.gather(*channels), timeout=0.5)
+        except asyncio.TimeoutError:
+            pass
+        release.set()
+        executor.shutdown()
+        poll_executor.shutdown()
+
+    asyncio.run(run())
+    # The slow channel holds 2 threads, the fast one keeps polling and every
+    # failed download is alerted, not only one per poll
+    assert polls.count("fast") > 2
+    fast = [alert for alert in alerts if alert.startswith("fast")]
+    assert len(set(fast)) > polls.count("fast")
+
+
+def test_sigterm_flushes_the_pending_chunks(monkeypatch):
+    flushed = []
+    stop_compaction = threading.Event()
+
+    async def run_channel(**kwrgs):
+        await asyncio.sleep(60)
+
+    monkeypatch.setattr(ingest, "run_channel", run_channel)
+    monkeypatch.setattr(
+        ingest, "start_incremental", lambda channels, running_hours: stop_compaction
+    )
+    monkeypatch.setattr(
+        ingest,
+        "make_coalescer",
+        lambda chunk_seconds: SimpleNamespace(flush=lambda: flushed.append(True)),
+    )
+
+    async def run() -> None:
+        # Stopped as a container by docker stop
+        asyncio.get_running_loop().call_later(0.1, os.kill, os.getpid(), signal.SIGTERM)
+        await ingest.run_all_channels(
+            channels={"voh": "voh"},
+            freq=60,
+            alert=10,
+            workers=2,
+            persistent_ffmpeg=False,
+        )
+
+    asyncio.run(run())
+    assert flushed == [True]
+    assert stop_compaction.is_set()
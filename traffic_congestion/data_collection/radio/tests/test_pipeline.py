@@ -0,0 +1,44 @@
+import sys
+import threading
+import time
+from pathlib import Path
+
+sys.path.append(
+    Path(__file__).parent.parent.absolute().as_posix()
+)  # Add radio/ to root path
+
+from utils.pipeline import DownloadPipeline
+
+
+def test_pipeline_bounds_inflight_tasks():
+    pipeline = DownloadPipeline(max_workers=2, max_inflight=2)
+    release = threading.Event()
+
+    pipeline.submit(release.wait)
+    pipeline.submit(release.wait)
+
+    # The third submit has to wait for a free slot
+    submitter = threading.Thread(target=pipeline.submit, args=(time.sleep, 0))
+    submitter.start()
+    submitter.join(timeout=0.2)
+    assert submitter.is_alive()
+
+    release.set()
+    submitter.join(timeout=1)
+    assert not submitter.is_alive()
+    pipeline.shutdown()
+
+
+def test_pipeline_collects_errors():
+    def fail(message):
+        raise Exception(message)
+
+    pipeline = DownloadPipeline(max_workers=4)
+    for i in range(3):
+        pipeline.submit(fail, f"segment {i}")
+    pipeline.submit(time.sleep, 0)
+    pipeline.shutdown()
+
+    errors = pipeline.collect_errors()
+    assert sorted(str(ex) for ex in errors) == ["segment 0", "segment 1", "segment 2"]
+    assert pipeline.collect_errors() == []
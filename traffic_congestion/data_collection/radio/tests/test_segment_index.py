@@ -0,0 +1,55 @@
+import sys
+from pathlib import Path
+
+sys.path.append(
+    Path(__file__).parent.parent.absolute().as_posix()
+)  # Add radio/ to root path
+
+from utils.segment_index import SegmentIndex
+
+
+def test_segment_index_skips_downloaded_segments():
+    index = SegmentIndex()
+    index.observe("0", 100, 102)
+    assert [index.claim("0", seq) for seq in (100, 101, 102)] == [True, True, True]
+
+    # In-flight segments are not claimed twice
+    assert not index.claim("0", 101)
+
+    index.complete("0", 100)
+    index.complete("0", 102)
+    index.release("0", 101)  # failed, retried on the next poll
+
+    index.observe("0", 101, 103)
+    assert [index.claim("0", seq) for seq in (101, 102, 103)] == [True, False, True]
+
+
+def test_segment_index_memory_is_bounded():
+    index = SegmentIndex(window=8)
+    index.observe("0", 0, 0)
+    for seq in range(1, 1000, 2):  # every even sequence is missing
+        index.claim("0", seq)
+        index.complete("0", seq)
+    assert len(index.playlists["0"]["done"]) <= 8
+    assert len(index.inflight) == 0
+
+
+def test_segment_index_resumes_from_checkpoint(tmp_path):
+    path = (tmp_path / "channel.index.json").as_posix()
+    index = SegmentIndex(path=path)
+    index.observe("0", 1000, 1002)
+    for seq in (1000, 1001, 1002):
+        index.claim("0", seq)
+        index.complete("0", seq)
+
+    restarted = SegmentIndex(path=path)
+    restarted.observe("0", 1001, 1003)
+    assert [restarted.claim("0", seq) for seq in (1001, 1002, 1003)] == [
+        False,
+        False,
+        True,
+    ]
+
+    # The stream restarted with new media sequences
+    restarted.observe("0", 0, 2)
+    assert restarted.claim("0", 0)
@@ -0,0 +1,137 @@
+import sys
+import threading
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.append(
+    Path(__file__).parent.parent.absolute().as_posix()
+)  # Add radio/ to root path
+
+from utils import transcode
+from utils.transcode import ChannelTranscoder, adts_duration, split_adts_frames
+
+
+def adts_frame(payload: bytes, sampling_index: int = 8) -> bytes:
+    """ADTS frame of mono AAC-LC audio, 16 kHz by default."""
+    length = 7 + len(payload)
+    header = bytes(
+        [
+            0xFF,
+            0xF1,
+            (1 << 6) | (sampling_index << 2),
+            (1 << 6) | (length >> 11),
+            (length >> 3) & 0xFF,
+            ((length & 0x07) << 5) | 0x1F,
+            0xFC,
+        ]
+    )
+    return header + payload
+
+
+def test_split_adts_frames_keeps_the_partial_frame():
+    frames = [adts_frame(b"a" * 10), adts_frame(b"b" * 300)]
+    buf = bytearray(b"\x00\x01" + frames[0] + frames[1] + frames[0][:5])
+
+    # Garbage before the first header is dropped, the partial frame is kept
+    assert split_adts_frames(buf) == frames
+    assert buf == frames[0][:5]
+    buf.extend(frames[0][5:])
+    assert split_adts_frames(buf) == [frames[0]] and not buf
+
+
+def test_adts_duration_counts_1024_samples_per_frame():
+    audio = b"".join(adts_frame(b"a" * 20) for _ in range(50))
+    assert adts_duration(audio) == pytest.approx(50 * 1024 / 16000)
+    assert adts_duration(b"\x00" + adts_frame(b"a", sampling_index=3)) == 1024 / 48000
+    assert adts_duration(b"\xff\xf1\x00") == 0
+
+
+def test_cut_returns_the_frames_of_the_segment_duration():
+    transcoder = ChannelTranscoder("voh", timeout=5, idle=0.2)
+
+    def emit(count: int) -> None:
+        for _ in range(count):
+            time.sleep(0.001)
+            with transcoder.output:
+                transcoder.frames.append(b"f")
+                transcoder.emitted += 1
+                transcoder.output.notify_all()
+
+    # 2 seconds are 31.25 frames, the last second is held back by the demuxer
+    threading.Thread(target=emit, args=(16,)).start()
+    assert transcoder._cut(2.0) == b"f" * 16
+
+    # and comes with the next segment
+    threading.Thread(target=emit, args=(31,)).start()
+    assert transcoder._cut(2.0) == b"f" * 31
+
+    # A stalled ffmpeg is cut once idle
+    threading.Thread(target=emit, args=(5,)).start()
+    assert transcoder._cut(2.0) == b"f" * 5
+
+
+class FakeProcess:
+    def __init__(self, fed: list):
+        self.stdin = SimpleNamespace(write=fed.append, flush=lambda: None)
+
+    def poll(self):
+        return None
+
+
+def fake_transcoder(timeout: float = 5):
+    transcoder = ChannelTranscoder("voh", timeout=timeout)
+    fed, starts = [], []
+
+    def start() -> None:
+        starts.append(transcoder.last_sequence)
+        transcoder.process = FakeProcess(fed)
+
+    transcoder.start = start
+    transcoder._cut = lambda duration: b""
+    return transcoder, fed, starts
+
+
+def test_transcoder_feeds_the_segments_in_sequence_order():
+    transcoder, fed, starts = fake_transcoder()
+    for sequence in (10, 11, 12):
+        transcoder.schedule(sequence)
+
+    # The order starts from the lowest scheduled segment, not the first done
+    threads = [
+        threading.Thread(target=transcoder.transcode, args=(sequence, sequence, 1))
+        for sequence in (12, 11)
+    ]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.1)
+    assert fed == []
+    transcoder.transcode(10, 10, 1)
+    for thread in threads:
+        thread.join(5)
+    assert fed == [10, 11, 12] and starts == [None]
+
+    # The stream is restarted after a gap
+    transcoder.transcode(14, 14, 1)
+    assert fed[-1] == 14 and starts == [None, 12]
+
+
+def test_transcoder_gives_up_on_a_missing_segment(monkeypatch):
+    transcoder, fed, starts = fake_transcoder(timeout=0.1)
+    monkeypatch.setattr(transcode, "transcode_stream", lambda chunks, cmd: b"alone")
+    transcoder.schedule(1)
+    transcoder.schedule(2)
+
+    # 1 is given up on, it is transcoded alone instead of fed out of order
+    transcoder.transcode(2, 2, 1)
+    assert transcoder.transcode(1, 1, 1) == b"alone"
+    assert fed == [2]
+
+    # A failed segment gives the turn to the next one
+    transcoder.schedule(3)
+    transcoder.schedule(4)
+    transcoder.skip(3)
+    transcoder.transcode(4, 4, 1)
+    assert fed == [2, 4] and starts == [None, 2]
@@ -0,0 +1,175 @@
+import datetime
+import json
+import logging
+import tarfile
+from typing import BinaryIO, Iterator, List, Optional
+
+from utils.aws import read_blob_range
+from utils.codec import ARCHIVE_CODEC, ArchiveCodec, compress_frame, decompress_frame
+
+# Logger
+logger = logging.getLogger("fetch_hls_stream")
+
+# Sidecar index of an archive: object_name + INDEX_SUFFIX
+INDEX_SUFFIX = ".index.json"
+
+NUL = b"\0"
+
+
+def parse_timestamp(key: str) -> float:
+    """Returns the UTC timestamp of a segment key (channel/YYYY/MM/DD/HH_MM_SS_...)."""
+    _, year, month, day, filename = key.rsplit("/", 4)
+    hour, minute, second = filename.split("_")[:3]
+    return (
+        datetime.datetime(
+            int(year),
+            int(month),
+            int(day),
+            int(hour),
+            int(minute),
+            int(second),
+            tzinfo=datetime.timezone.utc,
+        )
+    ).timestamp()
+
+
+class SeekableArchive:
+    """Tar file of an hour block written as one compressed frame per segment.
+
+    The concatenated frames are still a valid .tar, .tar.gz or .tar.zst, and
+    the index records the byte range of the frame of each segment with its
+    timestamp and duration, so a reader can fetch a single segment with a
+    Range GET instead of the whole block.
+    """
+
+    def __init__(self, fileobj: BinaryIO, codec: ArchiveCodec = ARCHIVE_CODEC):
+        self.fileobj = fileobj
+        self.codec = codec
+        self.offset = 0  # bytes written to fileobj
+        self.tar_offset = 0  # bytes of the uncompressed tar
+        self.segments = []
+
+    def add(self, name: str, data: bytes, timestamp: float, duration: float) -> None:
+        """Appends a segment in its own frame."""
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = int(timestamp)
+        header = info.tobuf(tarfile.DEFAULT_FORMAT, "utf-8", "surrogateescape")
+        member = header + data + NUL * (-len(data) % tarfile.BLOCKSIZE)
+        frame = compress_frame(member, self.codec)
+        self.fileobj.write(frame)
+
+        self.segments.append(
+            {
+                "name": name,
+                "offset": self.offset,
+                "length": len(frame),
+                "header": len(header),
+                "size": len(data),
+                "timestamp": timestamp,
+                "duration": duration,
+            }
+        )
+        self.offset += len(frame)
+        self.tar_offset += len(member)
+
+    def close(self) -> None:
+        """Writes the end of the tar file."""
+        end = NUL * (2 * tarfile.BLOCKSIZE)
+        end += NUL * (-(self.tar_offset + len(end)) % tarfile.RECORDSIZE)
+        frame = compress_frame(end, self.codec)
+        self.fileobj.write(frame)
+        self.offset += len(frame)
+
+    def index(self) -> bytes:
+        """Returns the sidecar index of the archive."""
+        return json.dumps({"codec": self.codec.name, "segments": self.segments}).encode(
+            "utf-8"
+        )
+
+    def __enter__(self) -> "SeekableArchive":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is None:
+            self.close()
+
+
+class ArchiveReader:
+    """Reads segments of a seekable hour block from S3 with Range GETs.
+
+    The sidecar index is fetched once, then each run of consecutive segments
+    costs a single Range GET of their frames, e.g. a few minutes of audio
+    transfer kilobytes instead of the whole hour.
+    """
+
+    def __init__(
+        self,
+        bucket_name: str,
+        object_name: str,
+        backend: str = "seaweedfs",
+        s3_hosts: List[str] = ["seaweedfs"],
+    ):
+        self.bucket_name = bucket_name
+        self.object_name = object_name
+        self.backend = backend
+        self.s3_hosts = s3_hosts
+        self.index = None
+
+    def _read_range(self, object_name: str, start: int, end: Optional[int]) -> bytes:
+        return read_blob_range(
+            self.bucket_name,
+            object_name,
+            start,
+            end,
+            backend=self.backend,
+            s3_hosts=self.s3_hosts,
+        )
+
+    def load_index(self) -> dict:
+        if self.index is None:
+            self.index = json.loads(
+                self._read_range(self.object_name + INDEX_SUFFIX, 0, None)
+            )
+        return self.index
+
+    def segments(
+        self, start: Optional[float] = None, end: Optional[float] = None
+    ) -> List[dict]:
+        """Returns the index entries of the segments overlapping the UTC
+        timestamps from start to end."""
+        return [
+            segment
+            for segment in self.load_index()["segments"]
+            if (start is None or segment["timestamp"] + segment["duration"] > start)
+            and (end is None or segment["timestamp"] < end)
+        ]
+
+    def read(self, segments: List[dict]) -> Iterator[bytes]:
+        """Yields the audio of the segments, fetching consecutive frames with
+        one Range GET."""
+        codec = ArchiveCodec(self.load_index()["codec"])
+        runs = []
+        for segment in sorted(segments, key=lambda segment: segment["offset"]):
+            if runs and runs[-1][-1]["offset"] + runs[-1][-1]["length"] == (
+                segment["offset"]
+            ):
+                runs[-1].append(segment)
+            else:
+                runs.append([segment])
+
+        for run in runs:
+            start = run[0]["offset"]
+            data = self._read_range(
+                self.object_name, start, run[-1]["offset"] + run[-1]["length"]
+            )
+            for segment in run:
+                offset = segment["offset"] - start
+                member = decompress_frame(
+                    data[offset : offset + segment["length"]], codec
+                )
+                yield member[segment["header"] : segment["header"] + segment["size"]]
+
+    def clip(self, start: float, end: float) -> bytes:
+        """Returns the ADTS audio of the segments from start to end."""
+        return b"".join(self.read(self.segments(start, end)))
@@ -1,13 +1,22 @@
+import datetime
+import heapq
 import io
 import logging
 import os
+import queue
 import random
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing, nullcontext
 from pathlib import Path
-from typing import List, Optional
+from typing import Callable, ContextManager, Iterator, List, NamedTuple, Optional, Tuple
 
 import boto3
+from botocore.config import Config
 from botocore.exceptions import ClientError
+from botocore.response import StreamingBody
 
 sys.path.append(
     Path(__file__).parent.parent.absolute().as_posix()
@@ -18,13 +27,29 @@ from configs import S3Configuration
 # Logger
 logger = logging.getLogger("fetch_hls_stream")
 
+# S3 clients
+MAX_POOL_CONNECTIONS = int(os.getenv("S3_MAX_POOL_CONNECTIONS", 50))
+RETRIES = {"max_attempts": 5, "mode": "standard"}
 
-def create_client(
+# Endpoint of every backend instead of the hosts, e.g. the local S3 stand-in of
+# the benchmarks
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL")
+
+# Concurrent writes of the seaweedfs_cluster replicas
+replication_pool = ThreadPoolExecutor(max_workers=16)
+
+# Clients are thread-safe and shared, resources are cached per thread
+clients = {}
+clients_lock = threading.Lock()
+resources = threading.local()
+
+
+def build_client(
     service_type: str = "client",
     backend: str = "seaweedfs",
     s3_host: Optional[str] = "seaweedfs",
 ) -> boto3.Session.client:
-    """Returns S3 clients depends on the backend option."""
+    """Builds a new S3 client depends on the backend option."""
 
     if backend == "seaweedfs":
         kwrgs = {
@@ -39,6 +64,9 @@ def create_client(
         }
     else:
         raise NotImplementedError
+    if S3_ENDPOINT_URL:
+        kwrgs["endpoint_url"] = S3_ENDPOINT_URL
+    kwrgs["config"] = Config(max_pool_connections=MAX_POOL_CONNECTIONS, retries=RETRIES)
 
     if service_type == "client":
         return boto3.client("s3", **kwrgs)
@@ -48,28 +76,134 @@ def create_client(
         raise NotImplementedError
 
 
-def write_file_to_s3(
-    bucket_name: str,
-    file_name: str,
+def create_client(
+    service_type: str = "client",
+    backend: str = "seaweedfs",
+    s3_host: Optional[str] = "seaweedfs",
+) -> boto3.Session.client:
+    """Returns S3 clients depends on the backend option. Clients are built once
+    per backend and host and shared by all threads, resources are not
+    thread-safe so they are built once per thread."""
+    key = (service_type, backend, s3_host)
+    if service_type == "resource":
+        cache = getattr(resources, "cache", None)
+        if cache is None:
+            cache = resources.cache = {}
+    else:
+        cache = clients
+
+    client = cache.get(key)
+    if client is None:
+        # The default boto3 session is not thread-safe
+        with clients_lock:
+            client = cache.get(key)
+            if client is None:
+                client = build_client(
+                    service_type=service_type, backend=backend, s3_host=s3_host
+                )
+                cache[key] = client
+    return client
+
+
+def replicate(
+    upload: Callable[[boto3.Session.client], None],
     object_name: str,
     backend: str = "seaweedfs",
     s3_hosts: List[str] = ["seaweedfs"],
-    **kwrgs,
-) -> None:
-    """Writes data to S3, either on SeaweedFS or AWS."""
+    quorum: Optional[int] = None,
+    on_done: Optional[Callable[[], None]] = None,
+) -> List[dict]:
+    """Runs upload with the client of each replica. On the seaweedfs_cluster
+    backend, replicas are written concurrently and it returns once quorum of
+    them succeeded (all of them by default), the stragglers complete in the
+    background. Raises the last error if the quorum is not met. on_done is
+    called once every replica finished, e.g. to remove the uploaded file.
+    Returns the report (host, latency, outcome) of each replica finished so
+    far."""
     if backend == "seaweedfs_cluster":
-        clients = [
-            create_client(backend="seaweedfs", s3_host=s3_host) for s3_host in s3_hosts
+        replicas = [
+            (s3_host, create_client(backend="seaweedfs", s3_host=s3_host))
+            for s3_host in s3_hosts
         ]
     else:
-        clients = [create_client(backend=backend)]
+        replicas = [(backend, create_client(backend=backend))]
+    quorum = len(replicas) if quorum is None else min(quorum, len(replicas))
 
-    for client in clients:
+    reports = []
+    finished = threading.Condition()
+
+    def run(host: str, client: boto3.Session.client) -> None:
+        start = time.perf_counter()
+        error = None
         try:
-            _ = client.upload_file(file_name, bucket_name, object_name, **kwrgs)
-            logger.info(f"UPLOADED {object_name} to S3 [{backend}]")
-        except ClientError as ex:
-            logger.exception(ex)
+            upload(client)
+        except Exception as ex:
+            error = ex
+        report = {
+            "host": host,
+            "latency": time.perf_counter() - start,
+            "ok": error is None,
+            "error": error,
+        }
+        if error is None:
+            logger.info(
+                "UPLOADED {} to S3 [{}] in {:.2f}s".format(
+                    object_name, host, report["latency"]
+                )
+            )
+        else:
+            logger.error(
+                "FAILED TO UPLOAD {} to S3 [{}]".format(object_name, host),
+                exc_info=error,
+            )
+        with finished:
+            reports.append(report)
+            done = len(reports) == len(replicas)
+            finished.notify_all()
+        if done and on_done is not None:
+            on_done()
+
+    if len(replicas) == 1:
+        run(*replicas[0])
+    else:
+        for host, client in replicas:
+            replication_pool.submit(run, host, client)
+
+    with finished:
+        finished.wait_for(
+            lambda: sum(report["ok"] for report in reports) >= quorum
+            or len(reports) == len(replicas)
+        )
+        reports = list(reports)
+
+    if sum(report["ok"] for report in reports) < quorum:
+        raise [report["error"] for report in reports if not report["ok"]][-1]
+    return reports
+
+
+def write_file_to_s3(
+    bucket_name: str,
+    file_name: str,
+    object_name: str,
+    backend: str = "seaweedfs",
+    s3_hosts: List[str] = ["seaweedfs"],
+    quorum: Optional[int] = None,
+    on_done: Optional[Callable[[], None]] = None,
+    **kwrgs,
+) -> List[dict]:
+    """Writes data to S3, either on SeaweedFS or AWS. With a quorum lower than
+    the number of hosts, the stragglers still read the file after it returns,
+    it is removed by on_done instead."""
+    return replicate(
+        upload=lambda client: client.upload_file(
+            file_name, bucket_name, object_name, **kwrgs
+        ),
+        object_name=object_name,
+        backend=backend,
+        s3_hosts=s3_hosts,
+        quorum=quorum,
+        on_done=on_done,
+    )
 
 
 def write_buf_to_s3(
@@ -78,8 +212,165 @@ def write_buf_to_s3(
     object_name: str,
     backend: str = "seaweedfs",
     s3_hosts: List[str] = ["seaweedfs"],
-) -> None:
+    quorum: Optional[int] = None,
+) -> List[dict]:
     """Writes buffer to S3, either on SeaweedFS or AWS."""
+    # Each replica reads its own buffer from the start
+    return replicate(
+        upload=lambda client: client.upload_fileobj(
+            io.BytesIO(contents), bucket_name, object_name
+        ),
+        object_name=object_name,
+        backend=backend,
+        s3_hosts=s3_hosts,
+        quorum=quorum,
+    )
+
+
+def s3_targets(
+    backend: str = "seaweedfs", s3_hosts: List[str] = ["seaweedfs"], **kwrgs
+) -> List[Tuple[str, boto3.Session.client, dict]]:
+    """Returns the (host, client, extra args) of each replica of a backend,
+    to be written by a MultipartWriter."""
+    if backend == "seaweedfs_cluster":
+        return [
+            (s3_host, create_client(backend="seaweedfs", s3_host=s3_host), kwrgs)
+            for s3_host in s3_hosts
+        ]
+    return [(backend, create_client(backend=backend), kwrgs)]
+
+
+class MultipartWriter:
+    """File-like object which streams its writes to S3 multipart uploads of
+    several targets at once, so an archive is never staged on local disk. At
+    most one part of part_size bytes is buffered.
+
+    The multipart uploads are only created when the first part is full, and
+    close() returns False without uploading anything if less than min_size
+    bytes were written. abort() cancels the uploads. slots (e.g. a semaphore)
+    is held while a part is uploaded to a target.
+    """
+
+    def __init__(
+        self,
+        bucket_name: str,
+        object_name: str,
+        targets: List[Tuple[str, boto3.Session.client, dict]],
+        part_size: int = 2**24,
+        min_size: int = 0,
+        slots: Optional[ContextManager] = None,
+    ):
+        self.bucket_name = bucket_name
+        self.object_name = object_name
+        self.targets = targets
+        self.part_size = max(part_size, 5 * 2**20)  # S3 minimum part size
+        self.min_size = min_size
+        self.slots = slots if slots is not None else nullcontext()
+        self.buf = bytearray()
+        self.size = 0
+        self.uploads = None  # upload id and parts of each target
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data: bytes) -> int:
+        self.buf.extend(data)
+        self.size += len(data)
+        while len(self.buf) >= self.part_size:
+            part = bytes(self.buf[: self.part_size])
+            del self.buf[: self.part_size]
+            self._upload_part(part)
+        return len(data)
+
+    def _start(self) -> None:
+        self.uploads = []
+        for host, client, extra_args in self.targets:
+            response = client.create_multipart_upload(
+                Bucket=self.bucket_name, Key=self.object_name, **extra_args
+            )
+            self.uploads.append({"upload_id": response["UploadId"], "parts": []})
+
+    def _upload_part(self, part: bytes) -> None:
+        if self.uploads is None:
+            self._start()
+
+        def upload(target: tuple, state: dict) -> None:
+            _, client, _ = target
+            part_number = len(state["parts"]) + 1
+            with self.slots:
+                response = client.upload_part(
+                    Bucket=self.bucket_name,
+                    Key=self.object_name,
+                    UploadId=state["upload_id"],
+                    PartNumber=part_number,
+                    Body=part,
+                )
+            state["parts"].append({"PartNumber": part_number, "ETag": response["ETag"]})
+
+        # Targets receive the same part concurrently
+        futures = [
+            replication_pool.submit(upload, target, state)
+            for target, state in zip(self.targets, self.uploads)
+        ]
+        for future in futures:
+            future.result()
+
+    def close(self) -> bool:
+        """Uploads the last part and completes the uploads. Returns False if
+        the object is smaller than min_size and was not uploaded."""
+        if self.size < self.min_size:
+            self.abort()
+            return False
+        if self.buf or self.uploads is None:
+            part, self.buf = bytes(self.buf), bytearray()
+            self._upload_part(part)
+        for (host, client, _), upload in zip(self.targets, self.uploads):
+            client.complete_multipart_upload(
+                Bucket=self.bucket_name,
+                Key=self.object_name,
+                UploadId=upload["upload_id"],
+                MultipartUpload={"Parts": upload["parts"]},
+            )
+            logger.info(f"UPLOADED {self.object_name} to S3 [{host}]")
+        return True
+
+    def abort(self) -> None:
+        """Cancels the uploads, their parts are discarded."""
+        self.buf = bytearray()
+        if self.uploads is None:
+            return
+        for (_, client, _), upload in zip(self.targets, self.uploads):
+            try:
+                client.abort_multipart_upload(
+                    Bucket=self.bucket_name,
+                    Key=self.object_name,
+                    UploadId=upload["upload_id"],
+                )
+            except ClientError as ex:
+                logger.exception(ex)
+        self.uploads = None
+
+
+class Blob(NamedTuple):
+    """Listed object, without the overhead of a boto3 ObjectSummary."""
+
+    key: str
+    size: int
+    last_modified: datetime.datetime
+
+
+def iter_blobs(
+    bucket_name: str,
+    prefix: str,
+    backend: str = "seaweedfs",
+    s3_hosts: List[str] = ["seaweedfs"],
+    start_after: Optional[str] = None,
+    page_size: int = 1000,
+) -> Iterator[Blob]:
+    """Lists the blobs inside a bucket with prefix page by page, in key order.
+    start_after resumes the listing after a key. On the seaweedfs_cluster
+    backend, the listings of the hosts are merged and each key is yielded once,
+    including the keys missing on some hosts after a quorum write."""
     if backend == "seaweedfs_cluster":
         clients = [
             create_client(backend="seaweedfs", s3_host=s3_host) for s3_host in s3_hosts
@@ -87,49 +378,151 @@ def write_buf_to_s3(
     else:
         clients = [create_client(backend=backend)]
 
-    # Write bytes content to buffer
-    buf = io.BytesIO()
-    buf.write(contents)
-    buf.seek(0)
+    kwrgs = {
+        "Bucket": bucket_name,
+        "Prefix": prefix,
+        "PaginationConfig": {"PageSize": page_size},
+    }
+    if start_after:
+        kwrgs["StartAfter"] = start_after
 
-    for client in clients:
-        try:
-            _ = client.upload_fileobj(buf, bucket_name, object_name)
-            logger.info(f"UPLOADED {object_name} to S3 [{backend}]")
-        except ClientError as ex:
-            logger.exception(ex)
+    def list_host(client: boto3.Session.client) -> Iterator[Blob]:
+        for page in client.get_paginator("list_objects_v2").paginate(**kwrgs):
+            for content in page.get("Contents", []):
+                yield Blob(content["Key"], content["Size"], content["LastModified"])
+
+    last_key = None
+    for blob in heapq.merge(*map(list_host, clients), key=lambda blob: blob.key):
+        if blob.key != last_key:
+            last_key = blob.key
+            yield blob
 
 
-def list_blob(
+def list_prefixes(
     bucket_name: str,
     prefix: str,
+    depth: int = 1,
     backend: str = "seaweedfs",
     s3_hosts: List[str] = ["seaweedfs"],
-) -> Optional[list]:
-    """Lists the blobs inside a bucket with prefix."""
-    if backend == "seaweedfs_cluster":
-        s3s = [
-            create_client(service_type="resource", backend="seaweedfs", s3_host=s3_host)
-            for s3_host in s3_hosts
+) -> List[str]:
+    """Splits prefix into its sub-prefixes depth "/" levels below, e.g. the
+    days of a channel with depth=3 (channel/YYYY/MM/DD/)."""
+    client = create_client(
+        backend="seaweedfs" if backend == "seaweedfs_cluster" else backend,
+        s3_host=s3_hosts[0] if backend == "seaweedfs_cluster" else "seaweedfs",
+    )
+    paginator = client.get_paginator("list_objects_v2")
+    prefixes = [prefix if prefix.endswith("/") else prefix + "/"]
+    for _ in range(depth):
+        prefixes = [
+            common_prefix["Prefix"]
+            for parent in prefixes
+            for page in paginator.paginate(
+                Bucket=bucket_name, Prefix=parent, Delimiter="/"
+            )
+            for common_prefix in page.get("CommonPrefixes", [])
         ]
-    else:
-        s3s = [create_client(service_type="resource", backend=backend)]
+    return sorted(prefixes)
 
-    blobs = []
-    files_not_found = True
-    for s3 in s3s:
-        bucket = s3.Bucket(name=bucket_name)
 
-        for blob in bucket.objects.filter(Prefix=prefix):
-            blobs.append(blob)
-            files_not_found = False
-        if files_not_found:
-            print("ALERT", "No file in {0}/{1} {2}".format(bucket, prefix, backend))
+def iter_blobs_partitioned(
+    bucket_name: str,
+    prefixes: List[str],
+    backend: str = "seaweedfs",
+    s3_hosts: List[str] = ["seaweedfs"],
+    max_workers: int = 8,
+    max_pages: int = 16,
+) -> Iterator[Blob]:
+    """Lists disjoint prefixes in parallel and yields their blobs as pages
+    arrive, so the order is only kept within a prefix. At most max_pages pages
+    are buffered, which keeps the memory flat on large channels."""
+    pages = queue.Queue(maxsize=max_pages)
+    done = object()
+    stopped = threading.Event()
+
+    def put(item) -> None:
+        # Give up if the consumer stopped early, instead of blocking forever
+        while not stopped.is_set():
+            try:
+                pages.put(item, timeout=1)
+                return
+            except queue.Full:
+                pass
 
-    if blobs:
-        return blobs
+    def list_prefix(prefix: str) -> None:
+        try:
+            page = []
+            for blob in iter_blobs(bucket_name, prefix, backend, s3_hosts):
+                if stopped.is_set():
+                    return
+                page.append(blob)
+                if len(page) == 1000:
+                    put(page)
+                    page = []
+            put(page)
+        except Exception as ex:
+            put(ex)
+
+    def list_all() -> None:
+        with ThreadPoolExecutor(max_workers) as p:
+            list(p.map(list_prefix, prefixes))
+        put(done)
+
+    threading.Thread(target=list_all, daemon=True).start()
+    try:
+        while True:
+            page = pages.get()
+            if page is done:
+                break
+            if isinstance(page, Exception):
+                raise page
+            yield from page
+    finally:
+        stopped.set()
+
+
+def open_blob(
+    bucket_name: str, object_name: str, backend: str = "seaweedfs"
+) -> Tuple[int, StreamingBody]:
+    """Returns the size and the streaming body of a blob on S3."""
+    response = create_client(backend=backend).get_object(
+        Bucket=bucket_name, Key=object_name
+    )
+    return response["ContentLength"], response["Body"]
+
+
+def read_blob_range(
+    bucket_name: str,
+    object_name: str,
+    start: int = 0,
+    end: Optional[int] = None,
+    backend: str = "seaweedfs",
+    s3_hosts: List[str] = ["seaweedfs"],
+) -> bytes:
+    """Reads the bytes from start to end (excluded, the end of the blob if
+    None) of a blob with a Range GET, from a random node of the SeaweedFS
+    cluster."""
+    if backend == "seaweedfs_cluster":
+        clients = [
+            create_client(backend="seaweedfs", s3_host=s3_host)
+            for s3_host in random.sample(s3_hosts, len(s3_hosts))
+        ]
     else:
-        return
+        clients = [create_client(backend=backend)]
+
+    for i, client in enumerate(clients):
+        try:
+            response = client.get_object(
+                Bucket=bucket_name,
+                Key=object_name,
+                Range=f"bytes={start}-{end - 1 if end is not None else ''}",
+            )
+            with closing(response["Body"]) as body:
+                return body.read()
+        except Exception as ex:
+            if i == len(clients) - 1:
+                raise
+            logger.exception(ex)
 
 
 def download_blob(
@@ -178,3 +571,69 @@ def delete_blob(
             client.delete_object(Bucket=bucket_name, Key=object_name)
         except ClientError as ex:
             logger.exception(ex)
+
+
+def delete_blobs(
+    bucket_name: str,
+    object_names: List[str],
+    backend: str = "seaweedfs",
+    s3_hosts: List[str] = ["seaweedfs"],
+    batch_size: int = 1000,
+    max_workers: int = 4,
+    dry_run: bool = False,
+) -> dict:
+    """Deletes blobs on S3 with DeleteObjects batches of batch_size keys (at
+    most 1000), sending the batches concurrently. Returns the error of each key
+    which could not be deleted."""
+    if backend == "seaweedfs_cluster":
+        clients = [
+            create_client(backend="seaweedfs", s3_host=s3_host) for s3_host in s3_hosts
+        ]
+    else:
+        clients = [create_client(backend=backend)]
+
+    batch_size = min(batch_size, 1000)
+    batches = [
+        object_names[i : i + batch_size]
+        for i in range(0, len(object_names), batch_size)
+    ]
+    if dry_run:
+        logger.info(
+            "DRY RUN: would delete {} blobs in {} batches".format(
+                len(object_names), len(batches) * len(clients)
+            )
+        )
+        for object_name in object_names:
+            logger.debug(f"DRY RUN: would delete {object_name}")
+        return {}
+
+    def delete_batch(client: boto3.Session.client, batch: List[str]) -> dict:
+        try:
+            response = client.delete_objects(
+                Bucket=bucket_name,
+                Delete={"Objects": [{"Key": key} for key in batch], "Quiet": True},
+            )
+        except ClientError as ex:
+            logger.exception(ex)
+            return {key: str(ex) for key in batch}
+        return {
+            error["Key"]: "{}: {}".format(error.get("Code"), error.get("Message"))
+            for error in response.get("Errors", [])
+        }
+
+    failures = {}
+    with ThreadPoolExecutor(max_workers) as p:
+        for errors in p.map(
+            lambda args: delete_batch(*args),
+            [(client, batch) for client in clients for batch in batches],
+        ):
+            failures.update(errors)
+
+    logger.info(
+        "DELETED {} blobs, {} failures".format(
+            len(object_names) - len(failures), len(failures)
+        )
+    )
+    for key, error in failures.items():
+        logger.warning(f"Cannot delete {key}: {error}")
+    return failures
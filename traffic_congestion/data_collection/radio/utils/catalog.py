@@ -0,0 +1,202 @@
+import datetime
+import logging
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Iterable, List, Optional, Set, Tuple
+
+# Logger
+logger = logging.getLogger("fetch_hls_stream")
+
+# Catalog of the uploaded segments, shared by the containers of the host
+CATALOG_PATH = os.getenv("CATALOG_PATH", "/home/radio/state/catalog.db")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS segments (
+    key TEXT PRIMARY KEY,
+    channel TEXT NOT NULL,
+    hour TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    uploaded_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS segments_channel_hour ON segments (channel, hour);
+CREATE INDEX IF NOT EXISTS segments_channel_uploaded_at
+    ON segments (channel, uploaded_at);
+CREATE TABLE IF NOT EXISTS rebuilds (
+    channel TEXT PRIMARY KEY,
+    rebuilt_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS archives (
+    block TEXT PRIMARY KEY,
+    channel TEXT NOT NULL,
+    object_name TEXT,
+    size INTEGER NOT NULL,
+    archived_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS archives_channel ON archives (channel);
+"""
+
+
+def parse_key(key: str) -> Tuple[str, str]:
+    """Returns the channel and the hour block (YYYY/MM/DD/HH) of a segment key
+    (channel/YYYY/MM/DD/HH_MM_SS_...)."""
+    channel, year, month, day, filename = key.rsplit("/", 4)
+    return channel, "/".join([year, month, day, filename.split("_")[0]])
+
+
+class SegmentCatalog:
+    """Local SQLite catalog of the segments uploaded to SeaweedFS.
+
+    The fetcher records every object it writes, so compaction and the alert
+    check query the hour blocks and the latest upload of a channel from
+    indexes instead of listing the bucket. Compaction checkpoints the hour
+    blocks it archived in the archives manifest. The database is in WAL mode so the
+    readers never block the writers. Connections are opened per thread.
+    """
+
+    def __init__(self, path: str = CATALOG_PATH):
+        self.path = path
+        self.local = threading.local()
+
+    def connect(self) -> sqlite3.Connection:
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(SCHEMA)
+            self.local.conn = conn
+        return conn
+
+    def add(self, key: str, size: int, uploaded_at: Optional[float] = None) -> None:
+        """Records an uploaded segment."""
+        channel, hour = parse_key(key)
+        self.connect().execute(
+            "INSERT OR REPLACE INTO segments VALUES (?, ?, ?, ?, ?)",
+            (key, channel, hour, size, uploaded_at or time.time()),
+        )
+
+    def has(self, channel: str) -> bool:
+        """Checks whether the catalog knows any segment of the channel."""
+        row = (
+            self.connect()
+            .execute("SELECT 1 FROM segments WHERE channel = ? LIMIT 1", (channel,))
+            .fetchone()
+        )
+        return row is not None
+
+    def rebuilt(self, channel: str) -> bool:
+        """Checks whether the catalog holds every segment of the channel, i.e.
+        it was rebuilt from a full listing since the database was created."""
+        row = (
+            self.connect()
+            .execute("SELECT 1 FROM rebuilds WHERE channel = ?", (channel,))
+            .fetchone()
+        )
+        return row is not None
+
+    def rebuild(self, channel: str, blobs: Iterable, complete: bool = True) -> int:
+        """Records the listed blobs (key, size, last_modified) of a channel
+        when the catalog is missing. complete marks a listing of the whole
+        channel. Returns the number of segments."""
+        conn = self.connect()
+        count = 0
+        conn.execute("BEGIN")
+        try:
+            for blob in blobs:
+                try:
+                    key_channel, hour = parse_key(blob.key)
+                except ValueError:
+                    logger.warning(f"Unexpected key {blob.key}")
+                    continue
+                if key_channel != channel:
+                    continue
+                conn.execute(
+                    "INSERT OR REPLACE INTO segments VALUES (?, ?, ?, ?, ?)",
+                    (
+                        blob.key,
+                        channel,
+                        hour,
+                        blob.size,
+                        blob.last_modified.timestamp(),
+                    ),
+                )
+                count += 1
+            if complete:
+                conn.execute(
+                    "INSERT OR REPLACE INTO rebuilds VALUES (?, ?)",
+                    (channel, time.time()),
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        logger.info(f"Rebuilt the catalog of {channel} with {count} segments")
+        return count
+
+    def hours(self, channel: str) -> List[str]:
+        """Returns the hour blocks (YYYY/MM/DD/HH) of the channel."""
+        return [
+            hour
+            for (hour,) in self.connect().execute(
+                "SELECT DISTINCT hour FROM segments WHERE channel = ? ORDER BY hour",
+                (channel,),
+            )
+        ]
+
+    def keys(self, channel: str, hour: str) -> List[str]:
+        """Returns the segment keys of an hour block."""
+        return [
+            key
+            for (key,) in self.connect().execute(
+                "SELECT key FROM segments WHERE channel = ? AND hour = ? ORDER BY key",
+                (channel, hour),
+            )
+        ]
+
+    def latest(self, channel: str) -> Optional[datetime.datetime]:
+        """Returns the upload time of the latest segment of the channel."""
+        (uploaded_at,) = (
+            self.connect()
+            .execute(
+                "SELECT MAX(uploaded_at) FROM segments WHERE channel = ?", (channel,)
+            )
+            .fetchone()
+        )
+        if uploaded_at is None:
+            return None
+        return datetime.datetime.fromtimestamp(uploaded_at, tz=datetime.timezone.utc)
+
+    def remove(self, keys: Iterable[str]) -> None:
+        """Forgets the deleted segments."""
+        conn = self.connect()
+        conn.execute("BEGIN")
+        try:
+            conn.executemany(
+                "DELETE FROM segments WHERE key = ?", ((key,) for key in keys)
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def add_archive(self, block: str, object_name: Optional[str], size: int) -> None:
+        """Checkpoints a compacted hour block (channel|YYYY|MM|DD|HH) in the
+        manifest. object_name is None if the block was too small to be
+        archived."""
+        self.connect().execute(
+            "INSERT OR REPLACE INTO archives VALUES (?, ?, ?, ?, ?)",
+            (block, block.split("|")[0], object_name, size, time.time()),
+        )
+
+    def archived(self, channel: str) -> Set[str]:
+        """Returns the compacted hour blocks of the channel."""
+        return {
+            block
+            for (block,) in self.connect().execute(
+                "SELECT block FROM archives WHERE channel = ?", (channel,)
+            )
+        }
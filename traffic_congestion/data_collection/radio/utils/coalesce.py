@@ -0,0 +1,106 @@
+import datetime
+import logging
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable
+
+# Logger
+logger = logging.getLogger("fetch_hls_stream")
+
+
+class SegmentCoalescer:
+    """Appends the consecutive transcoded segments of each playlist into rolling
+    chunks of ADTS audio before uploading them, so one object holds e.g. 1 or 5
+    minutes of audio instead of 10 seconds.
+
+    A chunk is uploaded when it reaches chunk_seconds of audio or max_bytes,
+    when the UTC hour changes (hour blocks of compaction stay exact), when no
+    segment was appended for chunk_seconds (flush_expired) and on shutdown
+    (flush). add() returns the future of the chunk upload.
+    """
+
+    def __init__(
+        self,
+        upload: Callable[[bytes, str], None],
+        chunk_seconds: float = 60,
+        max_bytes: int = 2**23,
+    ):
+        self.upload = upload
+        self.chunk_seconds = chunk_seconds
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.chunks = {}
+
+    def add(
+        self, key: str, object_name: str, sequence: int, audio: bytes, duration: float
+    ) -> Future:
+        """Appends the audio of a segment to the chunk of key. object_name is
+        used if the segment starts a new chunk."""
+        hour = datetime.datetime.utcnow().strftime("%Y%m%d%H")
+        to_upload = []
+        with self.lock:
+            chunk = self.chunks.get(key)
+            if chunk is not None and chunk["hour"] != hour:
+                to_upload.append(self.chunks.pop(key))
+                chunk = None
+            if chunk is None:
+                chunk = {
+                    "object_name": object_name,
+                    "hour": hour,
+                    "parts": [],
+                    "duration": 0.0,
+                    "size": 0,
+                    "future": Future(),
+                }
+                self.chunks[key] = chunk
+            chunk["parts"].append((sequence, audio))
+            chunk["duration"] += duration
+            chunk["size"] += len(audio)
+            chunk["updated"] = time.monotonic()
+            if (
+                chunk["duration"] >= self.chunk_seconds
+                or chunk["size"] >= self.max_bytes
+            ):
+                to_upload.append(self.chunks.pop(key))
+
+        for chunk_to_upload in to_upload:
+            self._upload(chunk_to_upload)
+        return chunk["future"]
+
+    def flush_expired(self) -> None:
+        """Uploads the chunks of the playlists which stopped advancing or which
+        belong to a past hour."""
+        hour = datetime.datetime.utcnow().strftime("%Y%m%d%H")
+        with self.lock:
+            expired = [
+                key
+                for key, chunk in self.chunks.items()
+                if chunk["hour"] != hour
+                or time.monotonic() - chunk["updated"] > self.chunk_seconds
+            ]
+            to_upload = [self.chunks.pop(key) for key in expired]
+        for chunk in to_upload:
+            self._upload(chunk)
+
+    def flush(self) -> None:
+        """Uploads all the chunks, e.g. on shutdown."""
+        with self.lock:
+            to_upload, self.chunks = list(self.chunks.values()), {}
+        for chunk in to_upload:
+            self._upload(chunk)
+
+    def _upload(self, chunk: dict) -> None:
+        # Segments may finish out of order, the media sequence restores it
+        audio = b"".join(audio for _, audio in sorted(chunk["parts"]))
+        try:
+            self.upload(audio, chunk["object_name"])
+            logger.debug(
+                "COALESCED {} segments ({:.0f}s) INTO {}".format(
+                    len(chunk["parts"]), chunk["duration"], chunk["object_name"]
+                )
+            )
+            chunk["future"].set_result(None)
+        except Exception as ex:
+            logger.exception(ex)
+            chunk["future"].set_exception(ex)
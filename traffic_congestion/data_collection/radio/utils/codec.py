@@ -0,0 +1,81 @@
+import gzip
+import os
+from typing import NamedTuple
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class ArchiveCodec(NamedTuple):
+    """Compression of the tar files of hour blocks.
+
+    name is one of "none" (plain tar), "gz" or "zstd". level is the compression
+    level of the codec, threads the number of zstd worker threads (0 compresses
+    in the calling thread, -1 uses one thread per CPU).
+    """
+
+    name: str = "gz"
+    level: int = 9
+    threads: int = 0
+
+    @property
+    def extension(self) -> str:
+        return {"none": ".tar", "gz": ".tar.gz", "zstd": ".tar.zst"}[self.name]
+
+    def validate(self) -> None:
+        """Checks that the codec is known and installed, so a misconfigured
+        deployment fails at startup instead of on every block."""
+        if self.name not in ("none", "gz", "zstd"):
+            raise NotImplementedError(f"Unknown archive codec {self.name}")
+        if self.name == "zstd" and zstandard is None:
+            raise ImportError("The zstd archive codec requires zstandard")
+
+
+# Codec of the deployment, e.g. ARCHIVE_CODEC=zstd ARCHIVE_LEVEL=3
+ARCHIVE_CODEC = ArchiveCodec(
+    name=os.getenv("ARCHIVE_CODEC", "gz"),
+    level=int(os.getenv("ARCHIVE_LEVEL", 9)),
+    threads=int(os.getenv("ARCHIVE_THREADS", 0)),
+)
+
+EXTENSIONS = [".tar.gz", ".tar.zst", ".tar"]
+
+
+def strip_extension(key: str) -> str:
+    """Removes the archive extension of a key, whatever the codec."""
+    for extension in EXTENSIONS:
+        if key.endswith(extension):
+            return key[: -len(extension)]
+    return key
+
+
+def compress_frame(data: bytes, codec: ArchiveCodec = ARCHIVE_CODEC) -> bytes:
+    """Compresses data into a standalone frame of the codec. Concatenated
+    frames decompress as a whole, as gzip members and zstd frames do."""
+    if codec.name == "none":
+        return data
+    elif codec.name == "gz":
+        return gzip.compress(data, compresslevel=codec.level, mtime=0)
+    elif codec.name == "zstd":
+        if zstandard is None:
+            raise ImportError("The zstd archive codec requires zstandard")
+        compressor = zstandard.ZstdCompressor(level=codec.level, threads=codec.threads)
+        return compressor.compress(data)
+    else:
+        raise NotImplementedError(f"Unknown archive codec {codec.name}")
+
+
+def decompress_frame(frame: bytes, codec: ArchiveCodec = ARCHIVE_CODEC) -> bytes:
+    """Decompresses a frame written by compress_frame."""
+    if codec.name == "none":
+        return frame
+    elif codec.name == "gz":
+        return gzip.decompress(frame)
+    elif codec.name == "zstd":
+        if zstandard is None:
+            raise ImportError("The zstd archive codec requires zstandard")
+        return zstandard.ZstdDecompressor().decompress(frame)
+    else:
+        raise NotImplementedError(f"Unknown archive codec {codec.name}")
@@ -0,0 +1,37 @@
+import threading
+import time
+from typing import Dict, Optional
+
+
+class FreshnessTracker:
+    """Heartbeats of the channels, fed by the successful uploads.
+
+    The alert check reads the last upload of a channel from memory instead of
+    listing S3. A channel which never uploaded since the tracker started is
+    measured from the start, so a collector which fails from the first segment
+    is alerted after the same interval.
+    """
+
+    def __init__(self, started_at: Optional[float] = None):
+        self.started_at = started_at or time.time()
+        self.lock = threading.Lock()
+        self.heartbeats: Dict[str, float] = {}
+
+    def beat(self, channel: str, timestamp: Optional[float] = None) -> None:
+        """Records an upload of the channel."""
+        timestamp = timestamp or time.time()
+        with self.lock:
+            if timestamp > self.heartbeats.get(channel, 0):
+                self.heartbeats[channel] = timestamp
+
+    def last(self, channel: str) -> float:
+        """Returns the timestamp of the last upload of the channel."""
+        with self.lock:
+            return self.heartbeats.get(channel, self.started_at)
+
+    def is_stale(
+        self, channel: str, interval: float, now: Optional[float] = None
+    ) -> bool:
+        """Checks whether the channel uploaded nothing in the last interval
+        seconds."""
+        return (now or time.time()) - self.last(channel) > interval
@@ -0,0 +1,149 @@
+import logging
+import random
+from typing import List, NamedTuple, Optional, Tuple
+
+import m3u8
+from requests.exceptions import HTTPError, RetryError, SSLError
+
+from utils.http import get_session
+
+# Logger
+logger = logging.getLogger("fetch_hls_stream")
+
+
+class Segment(NamedTuple):
+    """Media segment of a playlist, identified by its media sequence."""
+
+    uri: str
+    filename: str
+    playlist: str
+    sequence: int
+    duration: float
+
+
+class PlaylistPoller:
+    """Polls the media playlists of a HLS stream.
+
+    The master playlist is resolved once and its variant uris are cached until
+    a variant fails, including after the retries of a 5xx. Variants are fetched with If-None-Match/If-Modified-Since
+    so an unchanged playlist costs a 304, and next_delay() derives the polling
+    interval from EXT-X-TARGETDURATION, backing off while the stream does not
+    advance.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        freq: float = 10,
+        max_delay: float = 60,
+        verify_ssl: bool = True,
+        timeout: float = 10,
+    ):
+        self.url = url
+        self.freq = freq
+        self.max_delay = max_delay
+        self.verify_ssl = verify_ssl
+        self.timeout = timeout
+        self.variants = None  # (playlist key, uri, filename separator)
+        self.state = {}
+
+    def _get(self, uri: str, state: dict) -> Optional[m3u8.M3U8]:
+        """Fetches a playlist, returns None if it is not modified."""
+        headers = {}
+        if state.get("etag"):
+            headers["If-None-Match"] = state["etag"]
+        if state.get("last_modified"):
+            headers["If-Modified-Since"] = state["last_modified"]
+
+        try:
+            response = get_session(uri).get(
+                uri, headers=headers, verify=self.verify_ssl, timeout=self.timeout
+            )
+        except SSLError as ex:
+            if not self.verify_ssl:
+                raise
+            # Retry without SSL verification
+            logger.exception(ex)
+            self.verify_ssl = False
+            response = get_session(uri).get(
+                uri, headers=headers, verify=self.verify_ssl, timeout=self.timeout
+            )
+
+        if response.status_code == 304:
+            return None
+        response.raise_for_status()
+
+        state["etag"] = response.headers.get("ETag")
+        state["last_modified"] = response.headers.get("Last-Modified")
+        return m3u8.loads(response.text, uri=response.url)
+
+    def _resolve(self) -> List[Tuple[str, m3u8.M3U8, str]]:
+        """Resolves the variants of the master playlist. If the url is already
+        a media playlist, returns it as the first poll."""
+        self.state = {}
+        dynamic_playlist = self._get(self.url, {})
+        if len(dynamic_playlist.playlists) > 0:
+            # Variant uris may contain a session id so they are keyed by position
+            self.variants = [
+                (str(i), playlist.absolute_uri, "_")
+                for i, playlist in enumerate(dynamic_playlist.playlists)
+            ]
+            return []
+
+        # Dynamic playlist file is also a playlist
+        self.variants = [("-", self.url, "/")]
+        self.state["-"] = {"unchanged": 0}
+        self._update(self.state["-"], dynamic_playlist)
+        return [("-", dynamic_playlist, "/")]
+
+    def _update(self, state: dict, playlist: m3u8.M3U8) -> None:
+        state["target_duration"] = playlist.target_duration
+        sequence = (playlist.media_sequence or 0) + len(playlist.segments)
+        if sequence == state.get("sequence"):
+            state["unchanged"] += 1
+        else:
+            state["unchanged"] = 0
+        state["sequence"] = sequence
+
+    def poll(self) -> List[Tuple[str, m3u8.M3U8, str]]:
+        """Returns the (playlist key, playlist, filename separator) of the
+        media playlists which changed since the last poll."""
+        playlists = self._resolve() if self.variants is None else []
+        polled = set(key for key, _, _ in playlists)
+
+        for playlist_key, uri, sep in self.variants:
+            if playlist_key in polled:
+                continue
+            state = self.state.setdefault(playlist_key, {"unchanged": 0})
+            try:
+                playlist = self._get(uri, state)
+            except (HTTPError, RetryError):
+                # Resolve the master playlist again on the next poll, without
+                # the validators of the failed variants
+                self.variants = None
+                self.state = {}
+                raise
+
+            if playlist is None:
+                state["unchanged"] += 1
+            else:
+                self._update(state, playlist)
+                playlists.append((playlist_key, playlist, sep))
+        return playlists
+
+    def next_delay(self) -> float:
+        """Returns the seconds until the next poll: half of the target duration,
+        doubled for each poll in which the stream did not advance beyond the
+        expected cadence, up to max_delay, with a 10% jitter."""
+        states = list(self.state.values())
+        if not states:
+            return self.freq
+
+        target_duration = min(
+            state.get("target_duration") or self.freq for state in states
+        )
+        unchanged = min(state["unchanged"] for state in states)
+        delay = min(
+            target_duration / 2 * 2 ** min(max(unchanged - 2, 0), 16), self.max_delay
+        )
+        return delay * random.uniform(0.9, 1.1)
@@ -0,0 +1,87 @@
+import logging
+import os
+import threading
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Logger
+logger = logging.getLogger("fetch_hls_stream")
+
+# Keep-alive connections of each host, raised to the threads of the process by
+# set_pool_maxsize()
+POOL_MAXSIZE = int(os.getenv("HTTP_POOL_MAXSIZE", 10))
+pool_maxsize = POOL_MAXSIZE
+
+# Retries with exponential backoff: 0.5s, 1s, 2s
+RETRIES = 3
+BACKOFF_FACTOR = 0.5
+
+sessions = {}
+sessions_lock = threading.Lock()
+
+
+def set_pool_maxsize(threads: int) -> None:
+    """Keeps up to threads connections per host, at least HTTP_POOL_MAXSIZE,
+    so concurrent fetches of channels sharing a host are not discarded from
+    the pool. Applies to the sessions created afterwards."""
+    global pool_maxsize
+    pool_maxsize = max(POOL_MAXSIZE, threads)
+
+
+def get_session(url: str) -> requests.Session:
+    """Returns the keep-alive session shared by all requests to the host of url,
+    so playlist and segment fetches reuse their DNS, TCP and TLS handshakes."""
+    host = urlsplit(url).netloc
+    with sessions_lock:
+        session = sessions.get(host)
+        if session is None:
+            retry = Retry(
+                total=RETRIES,
+                backoff_factor=BACKOFF_FACTOR,
+                status_forcelist=[429, 500, 502, 503, 504],
+                allowed_methods=["HEAD", "GET"],
+            )
+            adapter = HTTPAdapter(
+                pool_connections=1, pool_maxsize=pool_maxsize, max_retries=retry
+            )
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            sessions[host] = session
+    return session
+
+
+def connection_stats() -> dict:
+    """Returns the number of requests and opened connections of each host."""
+    with sessions_lock:
+        host_sessions = list(sessions.items())
+
+    stats = {}
+    for host, session in host_sessions:
+        num_requests, num_connections = 0, 0
+        for adapter in set(session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in list(pools.keys()):
+                pool = pools.get(key)
+                if pool is not None:
+                    num_requests += pool.num_requests
+                    num_connections += pool.num_connections
+        stats[host] = {"requests": num_requests, "connections": num_connections}
+    return stats
+
+
+def log_connection_stats() -> None:
+    """Logs the connection reuse of each host."""
+    for host, stats in connection_stats().items():
+        if stats["requests"] > 0:
+            logger.info(
+                "HTTP {}: {} requests over {} connections ({:.1%} reused)".format(
+                    host,
+                    stats["requests"],
+                    stats["connections"],
+                    1 - stats["connections"] / stats["requests"],
+                )
+            )
@@ -1,5 +1,11 @@
+import logging
+import os
+import queue
 import sys
+import threading
+import time
 from pathlib import Path
+from typing import Callable, Dict
 
 import requests
 
@@ -9,22 +15,107 @@ sys.path.append(
 
 from configs import TeleBotConfiguration
 
+# Logger
+logger = logging.getLogger("fetch_hls_stream")
 
-def telebot_send_message(bot_message: str):
+# At most one Telegram message every ALERT_INTERVAL seconds, and one alert of
+# the same key every ALERT_DEDUP_SECONDS seconds
+ALERT_INTERVAL = int(os.getenv("ALERT_INTERVAL", 30))
+ALERT_DEDUP_SECONDS = int(os.getenv("ALERT_DEDUP_SECONDS", 900))
+
+
+def telebot_send_message(bot_message: str, timeout: float = 10):
     bot_token = TeleBotConfiguration.BOT_TOKEN
     bot_chatID = TeleBotConfiguration.BOT_CHATID
 
-    send_text = (
-        "https://api.telegram.org/bot"
-        + bot_token
-        + "/sendMessage?chat_id="
-        + bot_chatID
-        + "&parse_mode=Markdown&text="
-        + bot_message
+    # The text is encoded as a query parameter, # or & are kept in the message
+    response = requests.get(
+        "https://api.telegram.org/bot" + bot_token + "/sendMessage",
+        params={"chat_id": bot_chatID, "parse_mode": "Markdown", "text": bot_message},
+        timeout=timeout,
     )
-    response = requests.get(send_text)
     return response.json()
 
 
+def send_alert(bot_message: str) -> dict:
+    """Sends a Telegram message, raises if Telegram did not accept it."""
+    response = telebot_send_message(bot_message)
+    if not response.get("ok"):
+        raise RuntimeError(
+            "Telegram did not send the alert: {}".format(response.get("description"))
+        )
+    return response
+
+
+class AlertSender:
+    """Delivers the alerts from a background thread.
+
+    send() only enqueues, so the collectors never wait on Telegram. The
+    thread merges the pending alerts of all channels into one message at most
+    every interval seconds, keeps the latest alert of each key and drops the
+    keys already alerted in the last dedup_seconds. A failed delivery, e.g.
+    not accepted by Telegram, is logged and dropped, the next alert of the key
+    goes through.
+    """
+
+    def __init__(
+        self,
+        send: Callable[[str], object] = send_alert,
+        interval: float = ALERT_INTERVAL,
+        dedup_seconds: float = ALERT_DEDUP_SECONDS,
+        maxsize: int = 1000,
+    ):
+        self.send_message = send
+        self.interval = interval
+        self.dedup_seconds = dedup_seconds
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.sent: Dict[str, float] = {}
+        self.last_batch = 0.0
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def send(self, key: str, message: str) -> None:
+        """Enqueues an alert, e.g. key is the channel."""
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+        try:
+            self.queue.put_nowait((key, message))
+        except queue.Full:
+            logger.warning(f"Alert queue is full, dropped: {message}")
+
+    def run(self) -> None:
+        while True:
+            batch = dict([self.queue.get()])
+
+            # Rate limit, the alerts of the other channels join the batch
+            time.sleep(max(0, self.last_batch + self.interval - time.monotonic()))
+            while True:
+                try:
+                    key, message = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                batch[key] = message
+            self.deliver(batch)
+
+    def deliver(self, batch: Dict[str, str]) -> None:
+        now = time.monotonic()
+        fresh = {
+            key: message
+            for key, message in batch.items()
+            if now - self.sent.get(key, -self.dedup_seconds) >= self.dedup_seconds
+        }
+        if not fresh:
+            return
+
+        self.last_batch = now
+        try:
+            self.send_message("\n".join(fresh.values()))
+            self.sent.update({key: now for key in fresh})
+        except Exception as ex:
+            logger.exception(ex)
+
+
 if __name__ == "__main__":
     test = telebot_send_message("Test message.")
@@ -0,0 +1,50 @@
+import logging
+import queue
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, List, Optional
+
+# Logger
+logger = logging.getLogger("fetch_hls_stream")
+
+
+class DownloadPipeline:
+    """Runs tasks on a thread pool with a bounded number of in-flight tasks.
+
+    submit() blocks while the pool is saturated (backpressure) and the errors
+    of the finished tasks are collected to be handled later by the caller,
+    so one slow or failed task never stalls the submission of the next ones.
+    """
+
+    def __init__(self, max_workers: int = 4, max_inflight: Optional[int] = None):
+        self.pool = ThreadPoolExecutor(max_workers=max_workers)
+        self.slots = threading.BoundedSemaphore(max_inflight or 2 * max_workers)
+        self.errors = queue.SimpleQueue()
+
+    def submit(self, fn: Callable, *args, **kwargs) -> Future:
+        """Submits a task, waiting for a free slot if the pipeline is full."""
+        self.slots.acquire()
+        try:
+            future = self.pool.submit(fn, *args, **kwargs)
+        except Exception:
+            self.slots.release()
+            raise
+        future.add_done_callback(self._on_done)
+        return future
+
+    def _on_done(self, future: Future) -> None:
+        self.slots.release()
+        if not future.cancelled() and future.exception() is not None:
+            self.errors.put(future.exception())
+
+    def collect_errors(self) -> List[Exception]:
+        """Returns and clears the errors of the tasks finished so far."""
+        errors = []
+        while True:
+            try:
+                errors.append(self.errors.get_nowait())
+            except queue.Empty:
+                return errors
+
+    def shutdown(self, wait: bool = True) -> None:
+        self.pool.shutdown(wait=wait)
@@ -0,0 +1,127 @@
+import json
+import logging
+import os
+import threading
+from concurrent.futures import Future
+from functools import partial
+from pathlib import Path
+from typing import Optional
+
+# Logger
+logger = logging.getLogger("fetch_hls_stream")
+
+
+class SegmentIndex:
+    """Remembers the downloaded segments of a channel by EXT-X-MEDIA-SEQUENCE.
+
+    For each playlist, it keeps a high-water mark (every sequence up to it is
+    downloaded) and a small window of the downloaded sequences above it, so the
+    memory stays constant for the life of the collector. The index is
+    checkpointed to a small JSON file after each download so a restarted
+    collector resumes where it left off.
+    """
+
+    def __init__(self, path: Optional[str] = None, window: int = 64):
+        self.path = path
+        self.window = window
+        self.lock = threading.Lock()
+        self.playlists = {}
+        self.inflight = set()
+
+        if path is not None and os.path.exists(path):
+            try:
+                with open(path, "r") as f:
+                    for playlist, state in json.load(f).items():
+                        self.playlists[playlist] = {
+                            "hwm": state["hwm"],
+                            "done": set(state["done"]),
+                        }
+            except Exception as ex:
+                logger.exception(ex)
+
+    def observe(self, playlist: str, first: int, last: int) -> None:
+        """Updates the playlist state with the sequences currently listed in
+        the playlist, from first to last."""
+        with self.lock:
+            state = self.playlists.get(playlist)
+            if state is not None and last < state["hwm"] - self.window:
+                # The stream was restarted with new media sequences
+                logger.warning(f"Media sequence of {playlist} went back to {last}")
+                state = None
+            if state is None:
+                self.playlists[playlist] = {"hwm": first - 1, "done": set()}
+            elif first - 1 > state["hwm"]:
+                # Missed segments are no longer in the playlist
+                self._advance(state, first - 1)
+
+    def claim(self, playlist: str, sequence: int) -> bool:
+        """Returns True and marks the segment as in flight if it is neither
+        downloaded nor in flight yet."""
+        with self.lock:
+            state = self.playlists.get(playlist)
+            if state is not None and (
+                sequence <= state["hwm"] or sequence in state["done"]
+            ):
+                return False
+            if (playlist, sequence) in self.inflight:
+                return False
+            self.inflight.add((playlist, sequence))
+            return True
+
+    def complete(self, playlist: str, sequence: int) -> None:
+        """Marks the segment as downloaded and checkpoints the index."""
+        with self.lock:
+            self.inflight.discard((playlist, sequence))
+            state = self.playlists.setdefault(
+                playlist, {"hwm": sequence - 1, "done": set()}
+            )
+            if sequence > state["hwm"]:
+                state["done"].add(sequence)
+                self._advance(state, state["hwm"])
+            self._checkpoint()
+
+    def release(self, playlist: str, sequence: int) -> None:
+        """Releases a failed segment so it is retried while still listed."""
+        with self.lock:
+            self.inflight.discard((playlist, sequence))
+
+    def on_done(self, playlist: str, sequence: int, future: Future) -> None:
+        """Completes or releases the segment from the future of its download.
+        If the download returns the future of a coalesced upload, the segment
+        is completed once that upload is done."""
+        if future.cancelled() or future.exception() is not None:
+            self.release(playlist, sequence)
+        elif isinstance(future.result(), Future):
+            future.result().add_done_callback(partial(self.on_done, playlist, sequence))
+        else:
+            self.complete(playlist, sequence)
+
+    def _advance(self, state: dict, hwm: int) -> None:
+        done = state["done"]
+        while hwm + 1 in done:
+            hwm += 1
+        if len(done) > self.window:
+            # Give up on the oldest gap to keep the window bounded
+            hwm = max(hwm, sorted(done)[len(done) - self.window - 1])
+            while hwm + 1 in done:
+                hwm += 1
+        state["hwm"] = hwm
+        state["done"] = {sequence for sequence in done if sequence > hwm}
+
+    def _checkpoint(self) -> None:
+        if self.path is None:
+            return
+        try:
+            Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(
+                    {
+                        playlist: {"hwm": state["hwm"], "done": sorted(state["done"])}
+                        for playlist, state in self.playlists.items()
+                    },
+                    f,
+                )
+            os.replace(tmp_path, self.path)
+        except Exception as ex:
+            logger.exception(ex)
@@ -0,0 +1,314 @@
+import logging
+import os
+import threading
+import time
+from typing import Iterable, List
+
+import ffmpeg
+
+# Logger
+logger = logging.getLogger("fetch_hls_stream")
+
+# Static ffmpeg build of the radio image
+FFMPEG_CMD = os.getenv("FFMPEG_CMD", "/home/radio/johnvansickle/ffmpeg")
+
+
+def transcode_stream(chunks: Iterable[bytes], cmd: str = FFMPEG_CMD) -> bytes:
+    """Pipes the chunks of an audio segment through ffmpeg stdin and returns
+    the mono 16 kHz ADTS audio read from its stdout, without temporary files."""
+    process = (
+        ffmpeg.input("pipe:")
+        .output("pipe:", format="adts", ar=16000, ac=1)
+        .run_async(cmd=cmd, pipe_stdin=True, pipe_stdout=True)
+    )
+
+    def feed() -> None:
+        try:
+            for chunk in chunks:
+                process.stdin.write(chunk)
+        except BrokenPipeError:
+            # ffmpeg exited early, its return code tells why
+            pass
+        except Exception as ex:
+            logger.exception(ex)
+            process.kill()
+        finally:
+            try:
+                process.stdin.close()
+            except BrokenPipeError:
+                pass
+
+    # Write stdin from another thread so ffmpeg never blocks on a full stdout
+    feeder = threading.Thread(target=feed, daemon=True)
+    feeder.start()
+    audio = process.stdout.read()
+    process.wait()
+    feeder.join()
+
+    if process.returncode != 0:
+        raise ffmpeg.Error(cmd, audio, None)
+    return audio
+
+
+def is_mpegts(data: bytes) -> bool:
+    """Checks the MPEG-TS sync bytes of a segment."""
+    return len(data) > 376 and data[0] == data[188] == data[376] == 0x47
+
+
+def split_adts_frames(buf: bytearray) -> List[bytes]:
+    """Pops the complete ADTS frames from the beginning of buf."""
+    frames = []
+    while len(buf) >= 7:
+        if buf[0] != 0xFF or buf[1] & 0xF0 != 0xF0:
+            # Resynchronize on the next ADTS header
+            sync = buf.find(b"\xff", 1)
+            del buf[: sync if sync > 0 else len(buf)]
+            continue
+        frame_length = ((buf[3] & 0x03) << 11) | (buf[4] << 3) | (buf[5] >> 5)
+        if frame_length < 7 or len(buf) < frame_length:
+            break
+        frames.append(bytes(buf[:frame_length]))
+        del buf[:frame_length]
+    return frames
+
+
+ADTS_SAMPLE_RATES = [96000, 88200, 64000, 48000, 44100, 32000, 24000, 22050]
+ADTS_SAMPLE_RATES += [16000, 12000, 11025, 8000, 7350]
+
+
+def adts_duration(data: bytes) -> float:
+    """Returns the duration in seconds of ADTS audio (1024 samples per frame)."""
+    duration, position = 0.0, 0
+    while position + 7 <= len(data):
+        if data[position] != 0xFF or data[position + 1] & 0xF0 != 0xF0:
+            position += 1
+            continue
+        sampling_index = (data[position + 2] >> 2) & 0x0F
+        frame_length = (
+            ((data[position + 3] & 0x03) << 11)
+            | (data[position + 4] << 3)
+            | (data[position + 5] >> 5)
+        )
+        if sampling_index >= len(ADTS_SAMPLE_RATES) or frame_length < 7:
+            position += 1
+            continue
+        duration += 1024 / ADTS_SAMPLE_RATES[sampling_index]
+        position += frame_length
+    return duration
+
+
+class ChannelTranscoder:
+    """Long-lived ffmpeg process which transcodes the continuous MPEG-TS stream
+    of one playlist into mono 16 kHz ADTS.
+
+    Segments are fed to ffmpeg stdin in media sequence order and the ADTS frames
+    read from stdout are cut by the duration of each segment (1 frame is 1024
+    samples), so the process startup is paid once per channel instead of once
+    per segment. A dead process is restarted on the next segment, and so is
+    the process of a stream with a gap. A segment given up on is transcoded
+    alone when it arrives late.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        cmd: str = FFMPEG_CMD,
+        timeout: float = 10,
+        idle: float = 0.5,
+        sample_rate: int = 16000,
+    ):
+        self.name = name
+        self.cmd = cmd
+        self.timeout = timeout
+        self.idle = idle
+        self.sample_rate = sample_rate
+        self.process = None
+        self.lock = threading.Lock()
+        self.turn = threading.Condition()
+        self.output = threading.Condition()
+        self.scheduled = set()  # segments to feed, in sequence order
+        self.floor = None  # lowest sequence which can still be fed in order
+        self.last_sequence = None  # last segment fed to ffmpeg
+        self.frames = []
+        self.emitted = 0  # frames read from ffmpeg
+        self.expected = 0.0  # frames of the segments fed to ffmpeg
+        self.restarts = 0
+
+    def alive(self) -> bool:
+        return self.process is not None and self.process.poll() is None
+
+    def start(self) -> None:
+        """Starts the ffmpeg process and the reader of its stdout."""
+        if self.process is not None:
+            self.restarts += 1
+            logger.warning(f"Restarting the ffmpeg transcoder of {self.name}")
+            self.close()
+
+        process = (
+            ffmpeg.input("pipe:", format="mpegts")
+            .output(
+                "pipe:",
+                format="adts",
+                ar=self.sample_rate,
+                ac=1,
+                flush_packets=1,
+            )
+            .global_args("-loglevel", "error")
+            .run_async(cmd=self.cmd, pipe_stdin=True, pipe_stdout=True)
+        )
+        with self.output:
+            self.process = process
+            self.frames = []
+            self.emitted = 0
+            self.expected = 0.0
+        threading.Thread(target=self._read, args=(process,), daemon=True).start()
+
+    def _read(self, process) -> None:
+        buf = bytearray()
+        while True:
+            chunk = process.stdout.read1(2**16)
+            if not chunk:
+                break
+            buf.extend(chunk)
+            frames = split_adts_frames(buf)
+            if frames:
+                with self.output:
+                    if self.process is not process:
+                        break
+                    self.frames.extend(frames)
+                    self.emitted += len(frames)
+                    self.output.notify_all()
+
+    def close(self) -> None:
+        """Stops the ffmpeg process, the frames which are not cut yet are lost."""
+        process, self.process = self.process, None
+        if process is not None:
+            try:
+                process.stdin.close()
+            except BrokenPipeError:
+                pass
+            try:
+                process.wait(timeout=self.timeout)
+            except Exception:
+                process.kill()
+                process.wait()
+
+    def schedule(self, sequence: int) -> None:
+        """Reserves the turn of a segment before it is downloaded, so the order
+        starts from the lowest sequence of a playlist poll."""
+        with self.turn:
+            if self.floor is None or sequence >= self.floor:
+                self.scheduled.add(sequence)
+
+    def _wait_turn(self, sequence: int) -> bool:
+        # Wait until the lower scheduled segments are fed, or give up on them
+        # after timeout. False if the segment is late, a higher one was fed.
+        deadline = time.monotonic() + self.timeout
+        with self.turn:
+            if self.floor is not None and sequence < self.floor:
+                return False
+            self.scheduled.add(sequence)
+            while min(self.scheduled) < sequence:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    lost = sorted(s for s in self.scheduled if s < sequence)
+                    logger.warning(
+                        f"Gave up waiting for the segments {lost} of {self.name}"
+                    )
+                    self.scheduled.difference_update(lost)
+                    break
+                self.turn.wait(remaining)
+            self.floor = sequence
+            return True
+
+    def transcode(self, sequence: int, data: bytes, duration: float) -> bytes:
+        """Feeds one segment to ffmpeg and returns the ADTS audio of its duration."""
+        if not self._wait_turn(sequence):
+            logger.warning(
+                f"Segment {sequence} of {self.name} is late, transcoded alone"
+            )
+            return transcode_stream([data], cmd=self.cmd)
+        try:
+            with self.lock:
+                # The stream is not continuous after a gap, the frames of the
+                # previous segment not cut yet are lost
+                gap = (
+                    self.last_sequence is not None
+                    and sequence != self.last_sequence + 1
+                )
+                if not self.alive() or gap:
+                    self.start()
+                self.last_sequence = sequence
+                try:
+                    self.process.stdin.write(data)
+                    self.process.stdin.flush()
+                except BrokenPipeError:
+                    self.start()
+                    self.process.stdin.write(data)
+                    self.process.stdin.flush()
+                return self._cut(duration)
+        finally:
+            with self.turn:
+                self.scheduled.discard(sequence)
+                self.turn.notify_all()
+
+    def skip(self, sequence: int) -> None:
+        """Gives the turn to the next segment when a segment failed."""
+        with self.turn:
+            self.scheduled.discard(sequence)
+            self.turn.notify_all()
+
+    def _cut(self, duration: float) -> bytes:
+        # The demuxer keeps the last packet of a segment until the next one is
+        # fed, so wait for the expected frames minus 1 second, or for ffmpeg to
+        # be idle.
+        slack = self.sample_rate / 1024
+        deadline = time.monotonic() + self.timeout
+        with self.output:
+            self.expected += duration * self.sample_rate / 1024
+            emitted = self.emitted
+            while self.emitted < self.expected - slack:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.output.wait(min(self.idle, remaining))
+                if self.emitted == emitted and self.emitted > 0:
+                    break  # idle
+                emitted = self.emitted
+            frames, self.frames = self.frames, []
+        return b"".join(frames)
+
+
+class TranscoderPool:
+    """Warm transcoders of the playlists, created on first use."""
+
+    def __init__(self, cmd: str = FFMPEG_CMD):
+        self.cmd = cmd
+        self.lock = threading.Lock()
+        self.transcoders = {}
+
+    def get(self, name: str) -> ChannelTranscoder:
+        with self.lock:
+            transcoder = self.transcoders.get(name)
+            if transcoder is None:
+                transcoder = ChannelTranscoder(name=name, cmd=self.cmd)
+                self.transcoders[name] = transcoder
+            return transcoder
+
+    def check(self) -> None:
+        """Restarts the transcoders whose ffmpeg process died."""
+        with self.lock:
+            transcoders = list(self.transcoders.values())
+        for transcoder in transcoders:
+            if transcoder.process is not None and not transcoder.alive():
+                with transcoder.lock:
+                    if not transcoder.alive():
+                        transcoder.start()
+
+    def close(self) -> None:
+        """Stops all the transcoders, e.g. outside the running hours."""
+        with self.lock:
+            transcoders, self.transcoders = list(self.transcoders.values()), {}
+        for transcoder in transcoders:
+            with transcoder.lock:
+                transcoder.close()
@@ -1,15 +1,21 @@
-import io
+import argparse
 import logging
 import os
 import random
+import socket
 import sqlite3
+import threading
 import time
-from typing import List, Optional
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from typing import Dict, List, Optional, Tuple
 
 import boto3
 from botocore.config import Config
 from botocore.exceptions import ClientError
+
 from configs import S3Configuration
+from transfer import TransferEngine
 
 # AWS
 BUCKET_NAME = "radio-project"
@@ -17,8 +23,37 @@ BUCKET_NAME = "radio-project"
 # SeaweedFS Cluster
 SEAWEEDFS_HOSTS = ["11.11.1.89", "11.11.1.90"]
 
-# Cloudflare R2
-LIMIT = 1
+# Cloudflare R2, a cache of the most recently requested objects within LIMIT Gb
+LIMIT = float(os.getenv("R2_LIMIT", 1))
+
+# The worker syncs when a request is enqueued on SYNC_SOCKET, and polls every
+# POLL_INTERVAL seconds for requests written to objects.db directly
+SYNC_SOCKET = os.getenv("SYNC_SOCKET", "milkrun.sock")
+POLL_INTERVAL = int(os.getenv("POLL_INTERVAL", 600))
+
+# Requests pending on an unknown size or a failed transfer are retried every
+# RETRY_INTERVAL seconds
+RETRY_INTERVAL = int(os.getenv("RETRY_INTERVAL", 60))
+
+# Cached object sizes are revalidated with their ETag after SIZE_TTL seconds
+SIZE_TTL = int(os.getenv("SIZE_TTL", 3600))
+
+# Concurrent transfers to R2, each buffers at most one part in memory
+TRANSFER_WORKERS = int(os.getenv("TRANSFER_WORKERS", 8))
+TRANSFER_PART_SIZE = int(os.getenv("TRANSFER_PART_SIZE", 2**23))
+
+# S3 clients
+MAX_POOL_CONNECTIONS = int(os.getenv("S3_MAX_POOL_CONNECTIONS", 50))
+RETRIES = {"max_attempts": 5, "mode": "standard"}
+
+# Endpoint of every backend instead of the hosts, e.g. the local S3 stand-in of
+# the radio benchmarks
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL")
+
+# Clients are thread-safe and shared, resources are cached per thread
+clients = {}
+clients_lock = threading.Lock()
+resources = threading.local()
 
 # Logger
 logger = logging.getLogger("milk_run")
@@ -35,28 +70,32 @@ def setuplog(verbose: bool = True):
         logger.setLevel(logging.INFO)
 
 
-def create_client(
+def build_client(
     service_type: str = "client",
     backend: str = "seaweedfs",
     s3_host: Optional[str] = "seaweedfs",
 ) -> boto3.Session.client:
-    """Returns S3 clients depends on the backend option."""
+    """Builds a new S3 client depends on the backend option."""
 
+    config = Config(max_pool_connections=MAX_POOL_CONNECTIONS, retries=RETRIES)
     if backend == "seaweedfs":
         kwrgs = {
             "endpoint_url": f"http://{s3_host}:8333",
             "aws_access_key_id": S3Configuration.AWS_SEAWEEDFS_KEY_ID,
             "aws_secret_access_key": S3Configuration.AWS_SEAWEEDFS_SECRET,
+            "config": config,
         }
     elif backend == "r2":
         kwrgs = {
             "endpoint_url": f"https://{S3Configuration.AWS_R2_ACCOUNT_ID}.r2.cloudflarestorage.com",
             "aws_access_key_id": S3Configuration.AWS_R2_KEY_ID,
             "aws_secret_access_key": S3Configuration.AWS_R2_SECRET,
-            "config": Config(region_name="auto"),
+            "config": config.merge(Config(region_name="auto")),
         }
     else:
         raise NotImplementedError
+    if S3_ENDPOINT_URL:
+        kwrgs["endpoint_url"] = S3_ENDPOINT_URL
 
     if service_type == "client":
         return boto3.client("s3", **kwrgs)
@@ -66,6 +105,35 @@ def create_client(
         raise NotImplementedError
 
 
+def create_client(
+    service_type: str = "client",
+    backend: str = "seaweedfs",
+    s3_host: Optional[str] = "seaweedfs",
+) -> boto3.Session.client:
+    """Returns S3 clients depends on the backend option. Clients are built once
+    per backend and host and shared by all threads, resources are not
+    thread-safe so they are built once per thread."""
+    key = (service_type, backend, s3_host)
+    if service_type == "resource":
+        cache = getattr(resources, "cache", None)
+        if cache is None:
+            cache = resources.cache = {}
+    else:
+        cache = clients
+
+    client = cache.get(key)
+    if client is None:
+        # The default boto3 session is not thread-safe
+        with clients_lock:
+            client = cache.get(key)
+            if client is None:
+                client = build_client(
+                    service_type=service_type, backend=backend, s3_host=s3_host
+                )
+                cache[key] = client
+    return client
+
+
 def list_objects(from_side: str) -> set:
     """Retrieves a list of active objects from the specified data source."""
     if from_side == "client":
@@ -80,108 +148,526 @@ def list_objects(from_side: str) -> set:
         raise NotImplementedError
 
 
-def validate_size(objects: List[str], limit: float = 5) -> bool:
-    """Validates whether the total size of requested objects is within limit in Gb."""
-    s3 = create_client(service_type="client", backend="seaweedfs", s3_host="11.11.1.89")
-    total_size = (
-        sum(
-            [
-                s3.get_object(Bucket=BUCKET_NAME, Key=object_key).get("ContentLength")
-                for object_key in objects
-            ]
+# Every write to the requests appends the keys it touches to the change log
+NOW = "(julianday('now') - 2440587.5) * 86400.0"
+CHANGE_TRIGGERS = f"""
+DROP TRIGGER IF EXISTS objects_insert;
+CREATE TRIGGER objects_insert AFTER INSERT ON objects BEGIN
+    INSERT INTO changes(object_key, changed_at) VALUES (NEW.dst, {NOW});
+    INSERT INTO cache_events
+        SELECT CASE WHEN EXISTS (SELECT 1 FROM mirror WHERE object_key = NEW.dst)
+            THEN 'hit' ELSE 'miss' END, NEW.dst, {NOW}
+        WHERE NEW.active = 1;
+    INSERT OR REPLACE INTO access
+        SELECT NEW.dst, {NOW} WHERE NEW.active = 1;
+END;
+DROP TRIGGER IF EXISTS objects_update;
+CREATE TRIGGER objects_update AFTER UPDATE ON objects BEGIN
+    INSERT INTO changes(object_key, changed_at) VALUES (OLD.dst, {NOW});
+    INSERT INTO changes(object_key, changed_at)
+        SELECT NEW.dst, {NOW} WHERE NEW.dst IS NOT OLD.dst;
+END;
+DROP TRIGGER IF EXISTS objects_delete;
+CREATE TRIGGER objects_delete AFTER DELETE ON objects BEGIN
+    INSERT INTO changes(object_key, changed_at) VALUES (OLD.dst, {NOW});
+END;
+"""
+
+
+def source_client(source: str) -> boto3.Session.client:
+    """Returns the client of the backend an object is requested from."""
+    if source == "seaweedfs":
+        return create_client(
+            backend="seaweedfs",
+            service_type="client",
+            s3_host=random.choice(SEAWEEDFS_HOSTS),
         )
-        / 2**30
-    )
-    return total_size < limit
+    return create_client(backend=source, service_type="client")
 
 
-def seaweedfs_to_r2() -> None:
-    """Synchronizes objects between SeaweedFS and Cloudflare R2 based on requests in SQLite."""
-    # Get current status of objects
-    requested_objects = list_objects(from_side="client")
-    requested_object_keys = set([obj[2] for obj in requested_objects])
-    existing_object_keys = list_objects(from_side="r2")
+def init_db() -> None:
+    """Creates the tables of objects.db, the requests and the size catalog."""
+    with sqlite3.connect("objects.db") as con:
+        con.execute(
+            "CREATE TABLE IF NOT EXISTS objects(id INTEGER PRIMARY KEY, src TEXT, dst TEXT, active INTEGER)"
+        )
+        con.execute("CREATE INDEX IF NOT EXISTS objects_active ON objects(active, dst)")
+        con.execute("CREATE INDEX IF NOT EXISTS objects_dst ON objects(dst)")
+        con.execute(
+            "CREATE TABLE IF NOT EXISTS sizes(object_key TEXT PRIMARY KEY, etag TEXT, size INTEGER, checked_at REAL)"
+        )
 
-    # Validate the size of requested objects
-    assert validate_size(
-        objects=requested_object_keys, limit=LIMIT
-    ), f"Over the free quota of Cloudflare R2, {LIMIT} Gb"
-
-    # Infer the list of download and remove objects
-    download_objects = [
-        {"source": obj[1], "object_key": obj[2]}
-        for obj in requested_objects
-        if obj[2] not in existing_object_keys
-    ]
-    logger.info("Need to download {} objects".format(len(download_objects)))
-    remove_object_keys = [
-        object_key
-        for object_key in existing_object_keys
-        if object_key not in requested_object_keys
-    ]
-    logger.info("Need to remove {} objects".format(len(remove_object_keys)))
+        # Local mirror of the keys on R2 and the change log of the requests
+        con.execute("CREATE TABLE IF NOT EXISTS mirror(object_key TEXT PRIMARY KEY)")
+        con.execute(
+            "CREATE TABLE IF NOT EXISTS changes(version INTEGER PRIMARY KEY AUTOINCREMENT, object_key TEXT, changed_at REAL)"
+        )
+        con.execute(
+            "CREATE TABLE IF NOT EXISTS watermarks(name TEXT PRIMARY KEY, version INTEGER)"
+        )
+        con.execute(
+            "CREATE TABLE IF NOT EXISTS availability(object_key TEXT, requested_at REAL, available_at REAL)"
+        )
 
-    # Execution
-    dst_client = create_client(backend="r2", service_type="client")
-    for obj in download_objects:
-        if obj["source"] == "seaweedfs":
-            src_client = create_client(
-                backend=obj["source"],
-                service_type="client",
-                s3_host=random.choice(SEAWEEDFS_HOSTS),
-            )
-        else:
-            src_client = create_client(backend=obj["source"], service_type="client")
+        # Last request of each object and the hits, misses and evictions of R2
+        con.execute(
+            "CREATE TABLE IF NOT EXISTS access(object_key TEXT PRIMARY KEY, accessed_at REAL)"
+        )
+        con.execute(
+            "CREATE TABLE IF NOT EXISTS cache_events(kind TEXT, object_key TEXT, at REAL)"
+        )
+        con.execute("CREATE INDEX IF NOT EXISTS cache_events_at ON cache_events(at)")
+        con.executescript(CHANGE_TRIGGERS)
+        con.commit()
+
+
+def head_size(source: str, object_key: str, etag: Optional[str]) -> Optional[tuple]:
+    """Returns the (etag, size) of an object with a HEAD request, None if it is
+    unchanged since etag."""
+    kwrgs = {"IfNoneMatch": etag} if etag else {}
+    try:
+        response = source_client(source).head_object(
+            Bucket=BUCKET_NAME, Key=object_key, **kwrgs
+        )
+    except ClientError as ex:
+        if ex.response.get("Error", {}).get("Code") == "304":
+            return None
+        raise
+    return response.get("ETag"), response["ContentLength"]
 
-        # Download object to mem
-        obj_body = src_client.get_object(Bucket=BUCKET_NAME, Key=obj["object_key"])[
-            "Body"
-        ].read()
 
-        # Write bytes content to buffer
-        buf = io.BytesIO()
-        buf.write(obj_body)
-        buf.seek(0)
+def refresh_sizes(ttl: float = SIZE_TTL) -> int:
+    """Caches the sizes of the requested objects in objects.db. Unknown objects
+    are resolved with a HEAD request, known ones are revalidated every ttl
+    seconds and only updated when their ETag changed. Returns the number of
+    requested objects whose size is still unknown, e.g. not uploaded yet."""
+    now = time.time()
+    with sqlite3.connect("objects.db") as con:
+        rows = con.execute(
+            "SELECT o.dst, o.src, s.etag FROM objects o "
+            "LEFT JOIN sizes s ON s.object_key = o.dst "
+            "WHERE o.active = 1 AND (s.checked_at IS NULL OR s.checked_at < ?)",
+            (now - ttl,),
+        ).fetchall()
+    stale = {row[0]: row[1] for row in rows}
+    etags = {row[0]: row[2] for row in rows}
+    if not stale:
+        return 0
 
-        # Upload object from buffer to R2
+    def check(object_key: str) -> Optional[tuple]:
         try:
-            _ = dst_client.upload_fileobj(buf, BUCKET_NAME, obj["object_key"])
-            logger.info(
-                "TRANSFERRED {} from S3 [{}] to R2".format(
-                    obj["object_key"], obj["source"]
+            return head_size(stale[object_key], object_key, etags[object_key])
+        except ClientError as ex:
+            logger.warning(f"Cannot resolve the size of {object_key}: {ex}")
+            return False
+
+    with ThreadPoolExecutor(TRANSFER_WORKERS) as p:
+        results = dict(zip(stale, p.map(check, stale)))
+
+    with sqlite3.connect("objects.db") as con:
+        for object_key, result in results.items():
+            if result is None:
+                # Unchanged, the cached size stays valid
+                con.execute(
+                    "UPDATE sizes SET checked_at = ? WHERE object_key = ?",
+                    (now, object_key),
                 )
+            elif result:
+                con.execute(
+                    "INSERT OR REPLACE INTO sizes VALUES (?, ?, ?, ?)",
+                    (object_key, *result, now),
+                )
+        con.commit()
+    unknown = sum(1 for result in results.values() if result is False)
+    logger.info(
+        "Resolved the size of {} objects, {} unknown".format(
+            len(stale) - unknown, unknown
+        )
+    )
+    return unknown
+
+
+# Requested objects ranked by their last request, with the running total of
+# their sizes. Objects of unknown size wait until refresh_sizes resolves them.
+RANKED = """
+WITH requested AS (
+    SELECT o.dst AS object_key, MIN(o.src) AS source, s.size AS size,
+        COALESCE(a.accessed_at, 0) AS accessed_at
+    FROM objects o
+    LEFT JOIN sizes s ON s.object_key = o.dst
+    LEFT JOIN access a ON a.object_key = o.dst
+    WHERE o.active = 1 GROUP BY o.dst
+), ranked AS (
+    SELECT *, SUM(size) OVER (
+        ORDER BY accessed_at DESC, object_key ROWS UNBOUNDED PRECEDING
+    ) AS total
+    FROM requested WHERE size IS NOT NULL
+)
+"""
+
+
+def plan_cache(
+    limit: float, watermark: int
+) -> Tuple[Dict[str, Tuple[str, float]], List[str], List[str]]:
+    """Returns the changes of R2 which keep the most recently requested objects
+    within limit bytes: the objects to download with their source and last
+    request time, the mirrored objects to evict and the ones to remove as
+    their requests changed after watermark and none is left. The LRU cut is
+    computed by SQLite, only the keys to touch are read. Mirrored objects of
+    unknown size are kept until their size is resolved."""
+    with sqlite3.connect("objects.db") as con:
+        downloads = con.execute(
+            RANKED + "SELECT object_key, source, accessed_at FROM ranked "
+            "WHERE total <= ? AND object_key NOT IN (SELECT object_key FROM mirror)",
+            (limit,),
+        ).fetchall()
+        evictions = con.execute(
+            RANKED + "SELECT k.object_key FROM ranked k "
+            "JOIN mirror m ON m.object_key = k.object_key WHERE k.total > ?",
+            (limit,),
+        ).fetchall()
+        removals = con.execute(
+            "SELECT DISTINCT c.object_key FROM changes c "
+            "JOIN mirror m ON m.object_key = c.object_key "
+            "WHERE c.version > ? AND NOT EXISTS ("
+            "SELECT 1 FROM objects o WHERE o.dst = c.object_key AND o.active = 1)",
+            (watermark,),
+        ).fetchall()
+        (out_of_budget,) = con.execute(
+            RANKED + "SELECT COUNT(*) FROM requested r "
+            "LEFT JOIN ranked k ON k.object_key = r.object_key "
+            "WHERE k.total IS NULL OR k.total > ?",
+            (limit,),
+        ).fetchone()
+
+    if out_of_budget:
+        logger.info(
+            "{} requested objects are out of the R2 budget of {} Gb".format(
+                out_of_budget, LIMIT
             )
-        except ClientError as ex:
-            logger.exception(ex)
+        )
+    return (
+        {row[0]: (row[1], row[2]) for row in downloads},
+        [row[0] for row in evictions],
+        [row[0] for row in removals],
+    )
+
+
+def cache_stats(since: float) -> dict:
+    """Returns the hits, misses and evictions of R2 after since, with the hit
+    and eviction rates per request."""
+    with sqlite3.connect("objects.db") as con:
+        counts = dict(
+            con.execute(
+                "SELECT kind, COUNT(*) FROM cache_events WHERE at >= ? GROUP BY kind",
+                (since,),
+            ).fetchall()
+        )
+    hits, misses = counts.get("hit", 0), counts.get("miss", 0)
+    evictions = counts.get("eviction", 0)
+    requests = max(hits + misses, 1)
+    return {
+        "hits": hits,
+        "misses": misses,
+        "evictions": evictions,
+        "hit_rate": hits / requests,
+        "eviction_rate": evictions / requests,
+    }
+
+
+def bootstrap() -> None:
+    """Seeds the mirror with one full listing of R2 and queues every known
+    object, once before the first incremental sync."""
+    existing_object_keys = list_objects(from_side="r2")
+    with sqlite3.connect("objects.db") as con:
+        con.execute("DELETE FROM mirror")
+        con.executemany(
+            "INSERT INTO mirror VALUES (?)", [(key,) for key in existing_object_keys]
+        )
+        con.execute(
+            f"INSERT INTO changes(object_key, changed_at) SELECT DISTINCT dst, {NOW} FROM objects"
+        )
+        con.executemany(
+            f"INSERT INTO changes(object_key, changed_at) VALUES (?, {NOW})",
+            [(key,) for key in existing_object_keys],
+        )
+        con.execute("INSERT OR REPLACE INTO watermarks VALUES ('r2', 0)")
+        con.commit()
+    logger.info("Mirrored {} objects of R2".format(len(existing_object_keys)))
+
+
+def read_watermark() -> Optional[int]:
+    with sqlite3.connect("objects.db") as con:
+        row = con.execute("SELECT version FROM watermarks WHERE name = 'r2'").fetchone()
+    return row[0] if row else None
+
+
+def read_changes(watermark: int) -> Tuple[int, Dict[str, float]]:
+    """Returns the last version of the change log and the objects changed
+    after watermark, with the time of their first change."""
+    with sqlite3.connect("objects.db") as con:
+        rows = con.execute(
+            "SELECT MAX(version), object_key, MIN(changed_at) FROM changes "
+            "WHERE version > ? GROUP BY object_key",
+            (watermark,),
+        ).fetchall()
+    version = max([row[0] for row in rows], default=watermark)
+    return version, {row[1]: row[2] for row in rows}
+
+
+def commit_changes(
+    version: int,
+    transferred: Dict[str, float],
+    removed: List[str],
+    evicted: List[str],
+    failed: Dict[str, float],
+) -> None:
+    """Applies a sync cycle to the mirror and moves the watermark to version.
+    transferred and failed map the objects to the time they were requested,
+    failed objects are queued again for the next cycle with that time."""
+    now = time.time()
+    with sqlite3.connect("objects.db") as con:
+        con.executemany(
+            "INSERT OR IGNORE INTO mirror VALUES (?)", [(key,) for key in transferred]
+        )
+        con.executemany(
+            "INSERT INTO availability VALUES (?, ?, ?)",
+            [(key, requested_at, now) for key, requested_at in transferred.items()],
+        )
+        con.executemany(
+            "DELETE FROM mirror WHERE object_key = ?",
+            [(key,) for key in removed + evicted],
+        )
+        con.executemany(
+            "INSERT INTO cache_events VALUES ('eviction', ?, ?)",
+            [(key, now) for key in evicted],
+        )
+        con.executemany(
+            "INSERT INTO changes(object_key, changed_at) VALUES (?, ?)",
+            list(failed.items()),
+        )
+        con.execute("UPDATE watermarks SET version = ? WHERE name = 'r2'", (version,))
+        con.commit()
 
-    for object_key in remove_object_keys:
+
+def seaweedfs_to_r2(poll: bool = False) -> bool:
+    """Synchronizes objects between SeaweedFS and Cloudflare R2 based on the
+    requests changed in SQLite since the last cycle. A poll plans the cache
+    even without changes, so the requests of unknown size are picked up once
+    they are resolved. Returns True if requests are left pending."""
+    watermark = read_watermark()
+    if watermark is None:
+        bootstrap()
+        watermark = 0
+
+    # Get the objects changed since the watermark
+    version, changes = read_changes(watermark)
+    if not changes and not poll:
+        return False
+
+    # Keep the most recently requested objects within the budget of R2
+    unknown = refresh_sizes()
+    cached, evict_object_keys, remove_object_keys = plan_cache(
+        limit=LIMIT * 2**30, watermark=watermark
+    )
+    sources = {object_key: source for object_key, (source, _) in cached.items()}
+    logger.info("Need to download {} objects".format(len(sources)))
+    logger.info("Need to evict {} objects".format(len(evict_object_keys)))
+    logger.info("Need to remove {} objects".format(len(remove_object_keys)))
+
+    def requested_at(object_key: str) -> float:
+        if object_key in changes:
+            return changes[object_key]
+        return cached.get(object_key, (None, time.time()))[1]
+
+    # Execution, the space is released before the objects are streamed
+    # concurrently to R2
+    dst_client = create_client(backend="r2", service_type="client")
+    removed, evicted, failed = [], [], {}
+    unrequested = set(remove_object_keys)
+    for object_key in remove_object_keys + evict_object_keys:
         # Remove object on R2
         try:
             _ = dst_client.delete_object(Bucket=BUCKET_NAME, Key=object_key)
-            logger.info(f"REMOVED {object_key} on R2")
+            if object_key in unrequested:
+                removed.append(object_key)
+                logger.info(f"REMOVED {object_key} on R2")
+            else:
+                evicted.append(object_key)
+                logger.info(f"EVICTED {object_key} on R2")
         except ClientError as ex:
+            failed[object_key] = requested_at(object_key)
             logger.exception(ex)
 
+    engine = TransferEngine(
+        dst_client=dst_client,
+        bucket_name=BUCKET_NAME,
+        max_workers=TRANSFER_WORKERS,
+        part_size=TRANSFER_PART_SIZE,
+    )
+    errors = engine.copy_all(
+        list(sources.keys()), lambda object_key: source_client(sources[object_key])
+    )
+    transferred = {
+        object_key: requested_at(object_key)
+        for object_key, ex in errors.items()
+        if ex is None
+    }
+    for object_key, ex in errors.items():
+        if ex is not None:
+            failed[object_key] = requested_at(object_key)
+
+    commit_changes(version, transferred, removed, evicted, failed)
+    for object_key, requested_at in transferred.items():
+        logger.info(
+            "AVAILABLE {} on R2 {:.1f}s after its request".format(
+                object_key, time.time() - requested_at
+            )
+        )
+    if failed:
+        logger.warning("{} objects are left for the next run".format(len(failed)))
+    return bool(failed) or unknown > 0
+
+
+def notify() -> None:
+    """Wakes the sync worker up, the requests are already in objects.db so a
+    stopped worker picks them up when it starts."""
+    with closing(socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)) as sock:
+        try:
+            sock.sendto(b"sync", SYNC_SOCKET)
+        except (FileNotFoundError, ConnectionRefusedError):
+            logger.warning(f"No sync worker listens on {SYNC_SOCKET}")
+
+
+def request_object(source: str, object_key: str) -> None:
+    """Requests an object on R2, or refreshes its access time."""
+    with sqlite3.connect("objects.db") as con:
+        if not con.execute(
+            "SELECT 1 FROM objects WHERE dst = ? AND active = 1", (object_key,)
+        ).fetchone():
+            con.execute(
+                "INSERT INTO objects(src, dst, active) VALUES (?, ?, 1)",
+                (source, object_key),
+            )
+        else:
+            # Requested again, a hit if it is on R2, and the new access time
+            # may bring it back within the budget
+            hit = con.execute(
+                "SELECT 1 FROM mirror WHERE object_key = ?", (object_key,)
+            ).fetchone()
+            now = time.time()
+            con.execute(
+                "INSERT INTO cache_events VALUES (?, ?, ?)",
+                ("hit" if hit else "miss", object_key, now),
+            )
+            con.execute(
+                "INSERT OR REPLACE INTO access VALUES (?, ?)", (object_key, now)
+            )
+            if not hit:
+                con.execute(
+                    "INSERT INTO changes(object_key, changed_at) VALUES (?, ?)",
+                    (object_key, now),
+                )
+        con.commit()
+    notify()
+
+
+def release_object(object_key: str) -> None:
+    """Releases the requests of an object, it is removed from R2."""
+    with sqlite3.connect("objects.db") as con:
+        con.execute(
+            "UPDATE objects SET active = 0 WHERE dst = ? AND active = 1", (object_key,)
+        )
+        con.commit()
+    notify()
+
+
+def availability_stats(since: float) -> dict:
+    """Returns the time-to-available on R2 of the objects transferred after
+    since, in seconds."""
+    with sqlite3.connect("objects.db") as con:
+        latencies = [
+            row[0]
+            for row in con.execute(
+                "SELECT available_at - requested_at FROM availability "
+                "WHERE available_at >= ? ORDER BY 1",
+                (since,),
+            )
+        ]
+    if not latencies:
+        return {"count": 0}
+    return {
+        "count": len(latencies),
+        "p50": latencies[len(latencies) // 2],
+        "p95": latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+        "max": latencies[-1],
+    }
+
+
+def run_worker() -> None:
+    """Syncs whenever a request is enqueued, and every POLL_INTERVAL seconds
+    as a safety net for requests written to objects.db directly, or every
+    RETRY_INTERVAL seconds while requests are pending."""
+    if os.path.exists(SYNC_SOCKET):
+        os.remove(SYNC_SOCKET)
+    with closing(socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)) as sock:
+        sock.bind(SYNC_SOCKET)
+        poll, pending = True, False
+        while True:
+            try:
+                # Sync SeaweedFS and Cloudflare R2
+                pending = seaweedfs_to_r2(poll=poll)
+            except Exception as ex:
+                logger.exception(ex)
+                pending = True
+
+            sock.settimeout(RETRY_INTERVAL if pending else POLL_INTERVAL)
+            try:
+                sock.recv(64)
+                poll = False
+            except socket.timeout:
+                poll = True
+                continue
+
+            # Coalesce the burst of requests into one sync
+            sock.settimeout(0)
+            try:
+                while True:
+                    sock.recv(64)
+            except BlockingIOError:
+                pass
+
 
 def main() -> None:
+    parser = argparse.ArgumentParser(description="Syncs requested objects to R2.")
+    commands = parser.add_subparsers(dest="command")
+    commands.add_parser("worker", help="Run the sync worker (default)")
+    request = commands.add_parser("request", help="Request an object on R2")
+    request.add_argument("object_key")
+    request.add_argument("--source", default="seaweedfs")
+    release = commands.add_parser("release", help="Remove an object from R2")
+    release.add_argument("object_key")
+    stats = commands.add_parser(
+        "stats", help="Print the time-to-available and the cache rates of R2"
+    )
+    stats.add_argument("--hours", type=float, default=24)
+    args = parser.parse_args()
+
     # Init the objects.db database
-    if not os.path.exists("objects.db"):
-        with sqlite3.connect("objects.db") as con:
-            cur = con.cursor()
-            cur.execute(
-                "CREATE TABLE objects(id INTEGER PRIMARY KEY, src TEXT, dst TEXT, active INTEGER)"
-            )
-            con.commit()
+    init_db()
 
     setuplog(verbose=True)
 
-    while True:
-        try:
-            # Sync SeaweedFS and Cloudflare R2
-            seaweedfs_to_r2()
-            time.sleep(60)
-        except Exception as ex:
-            logger.exception(ex)
+    if args.command == "request":
+        request_object(args.source, args.object_key)
+    elif args.command == "release":
+        release_object(args.object_key)
+    elif args.command == "stats":
+        since = time.time() - args.hours * 3600
+        print(availability_stats(since))
+        print(cache_stats(since))
+    else:
+        run_worker()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,17 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.append(
+    Path(__file__).parent.parent.absolute().as_posix()
+)  # Add milkrun/ to root path
+
+from tests.fakes import FakeS3
+
+
+@pytest.fixture
+def fake():
+    """In-memory S3 of the SeaweedFS and R2 backends."""
+    with FakeS3() as fake:
+        yield fake
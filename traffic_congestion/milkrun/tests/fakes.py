@@ -0,0 +1,330 @@
+"""
+In-memory stand-in of the S3 backends of milkrun, SeaweedFS and R2 are told
+apart by their access key.
+"""
+
+import datetime
+import hashlib
+import re
+import threading
+import time
+import uuid
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional, Tuple
+from urllib.parse import parse_qs, unquote, urlparse
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+
+
+class Server:
+    """Threaded HTTP server on a free port of localhost."""
+
+    handler = BaseHTTPRequestHandler
+
+    def start(self) -> "Server":
+        handler = type("Handler", (self.handler,), {"fake": self})
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    @property
+    def url(self) -> str:
+        return "http://127.0.0.1:{}".format(self.httpd.server_address[1])
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self) -> "Server":
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.stop()
+
+
+class S3Object:
+    def __init__(self, data: bytes, etag: Optional[str] = None):
+        self.data = data
+        self.etag = etag or '"{}"'.format(hashlib.md5(data).hexdigest())
+        self.last_modified = datetime.datetime.utcnow()
+
+
+def decode_aws_chunked(body: bytes) -> bytes:
+    """Decodes a body in aws-chunked encoding (size;extensions CRLF data CRLF,
+    then trailers)."""
+    data, offset = [], 0
+    while True:
+        end = body.index(b"\r\n", offset)
+        size = int(body[offset:end].split(b";")[0], 16)
+        if size == 0:
+            return b"".join(data)
+        data.append(body[end + 2 : end + 2 + size])
+        offset = end + 2 + size + 2
+
+
+class S3Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body are separate writes on keep-alive connections
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+    def parse(self) -> Tuple[str, str, str, dict]:
+        url = urlparse(self.path)
+        bucket, _, key = url.path.lstrip("/").partition("/")
+        query = {name: values[0] for name, values in parse_qs(url.query, True).items()}
+        # Backends are told apart by their access key
+        match = re.search(r"Credential=([^/]+)/", self.headers.get("Authorization", ""))
+        namespace = match.group(1) if match else "anonymous"
+        return namespace, unquote(bucket), unquote(key), query
+
+    def read_body(self) -> bytes:
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if "aws-chunked" in self.headers.get("Content-Encoding", "") or (
+            self.headers.get("x-amz-content-sha256", "").startswith("STREAMING-")
+        ):
+            body = decode_aws_chunked(body)
+        return body
+
+    def reply(self, status: int, body: bytes = b"", headers: dict = {}) -> None:
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        if self.command != "HEAD" or "Content-Length" not in headers:
+            self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def error(self, status: int, code: str) -> None:
+        self.reply(
+            status,
+            f"<Error><Code>{code}</Code><Message>{code}</Message></Error>".encode(),
+            {"Content-Type": "application/xml"},
+        )
+
+    def xml(self, body: str) -> None:
+        self.reply(
+            200,
+            ('<?xml version="1.0" encoding="UTF-8"?>' + body).encode(),
+            {"Content-Type": "application/xml"},
+        )
+
+    def do_HEAD(self) -> None:
+        self.do_GET()
+
+    def do_GET(self) -> None:
+        namespace, bucket_name, key, query = self.parse()
+        fake = self.fake
+        bucket = fake.bucket(namespace, bucket_name)
+        if not key:
+            return self.list_objects(namespace, bucket, query)
+        if "uploadId" in query:
+            return self.list_parts(namespace, key, query)
+
+        obj = bucket.get(key)
+        fake.count(namespace, "get")
+        if obj is None:
+            return self.error(404, "NoSuchKey")
+        if self.headers.get("If-None-Match") == obj.etag:
+            return self.reply(304, headers={"ETag": obj.etag})
+        if self.headers.get("If-Match") not in (None, obj.etag):
+            return self.error(412, "PreconditionFailed")
+
+        data, status = obj.data, 200
+        headers = {
+            "ETag": obj.etag,
+            "Last-Modified": obj.last_modified.strftime("%a, %d %b %Y %H:%M:%S GMT"),
+            "Content-Type": "binary/octet-stream",
+        }
+        match = re.fullmatch(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        if match:
+            start = int(match.group(1))
+            end = int(match.group(2)) if match.group(2) else len(data) - 1
+            if start >= len(data):
+                return self.error(416, "InvalidRange")
+            end = min(end, len(data) - 1)
+            headers["Content-Range"] = f"bytes {start}-{end}/{len(data)}"
+            data, status = data[start : end + 1], 206
+        if self.command == "HEAD":
+            headers["Content-Length"] = str(len(data))
+            return self.reply(status, headers=headers)
+        fake.count(namespace, "bytes_out", len(data))
+        self.reply(status, data, headers)
+
+    def list_objects(self, namespace: str, bucket: dict, query: dict) -> None:
+        self.fake.count(namespace, "list")
+        prefix = query.get("prefix", "")
+        delimiter = query.get("delimiter", "")
+        max_keys = int(query.get("max-keys", 1000))
+        start_after = query.get("continuation-token") or query.get(
+            "start-after", query.get("marker", "")
+        )
+
+        contents, prefixes, truncated, last = [], [], False, ""
+        for key in sorted(bucket):
+            if not key.startswith(prefix) or key <= start_after:
+                continue
+            if len(contents) + len(prefixes) >= max_keys:
+                truncated = True
+                break
+            if delimiter and delimiter in key[len(prefix) :]:
+                common = key[: key.index(delimiter, len(prefix)) + len(delimiter)]
+                if common not in prefixes:
+                    prefixes.append(common)
+                # The next page starts after every key of the common prefix
+                last = common + "\uffff"
+                continue
+            contents.append(key)
+            last = key
+
+        items = "".join(
+            "<Contents><Key>{}</Key><LastModified>{}</LastModified><ETag>{}</ETag>"
+            "<Size>{}</Size><StorageClass>STANDARD</StorageClass></Contents>".format(
+                escape(key),
+                bucket[key].last_modified.strftime("%Y-%m-%dT%H:%M:%S.000Z"),
+                escape(bucket[key].etag),
+                len(bucket[key].data),
+            )
+            for key in contents
+        ) + "".join(
+            f"<CommonPrefixes><Prefix>{escape(common)}</Prefix></CommonPrefixes>"
+            for common in prefixes
+        )
+        if query.get("list-type") == "2":
+            token = (
+                f"<NextContinuationToken>{escape(last)}</NextContinuationToken>"
+                if truncated
+                else ""
+            )
+            extra = f"<KeyCount>{len(contents) + len(prefixes)}</KeyCount>{token}"
+        else:
+            extra = f"<NextMarker>{escape(last)}</NextMarker>" if truncated else ""
+        self.xml(
+            "<ListBucketResult><Prefix>{}</Prefix><MaxKeys>{}</MaxKeys>"
+            "<IsTruncated>{}</IsTruncated>{}{}</ListBucketResult>".format(
+                escape(prefix), max_keys, str(truncated).lower(), extra, items
+            )
+        )
+
+    def list_parts(self, namespace: str, key: str, query: dict) -> None:
+        upload = self.fake.uploads.get(query["uploadId"])
+        if upload is None:
+            return self.error(404, "NoSuchUpload")
+        parts = "".join(
+            f"<Part><PartNumber>{number}</PartNumber><ETag>{escape(obj.etag)}</ETag>"
+            f"<Size>{len(obj.data)}</Size></Part>"
+            for number, obj in sorted(upload["parts"].items())
+        )
+        self.xml(
+            f"<ListPartsResult><Key>{escape(key)}</Key><UploadId>{query['uploadId']}"
+            f"</UploadId><IsTruncated>false</IsTruncated>{parts}</ListPartsResult>"
+        )
+
+    def do_PUT(self) -> None:
+        namespace, bucket_name, key, query = self.parse()
+        fake = self.fake
+        body = self.read_body()
+        fake.count(namespace, "bytes_in", len(body))
+        obj = S3Object(body)
+        if "uploadId" in query:
+            upload = fake.uploads.get(query["uploadId"])
+            if upload is None:
+                return self.error(404, "NoSuchUpload")
+            upload["parts"][int(query["partNumber"])] = obj
+        else:
+            fake.count(namespace, "put")
+            fake.store(namespace, bucket_name, key, obj)
+        self.reply(200, headers={"ETag": obj.etag})
+
+    def do_POST(self) -> None:
+        namespace, bucket_name, key, query = self.parse()
+        fake = self.fake
+        body = self.read_body()
+        if "delete" in query:
+            bucket = fake.bucket(namespace, bucket_name)
+            deleted = []
+            for element in ElementTree.fromstring(body).iter():
+                if element.tag.endswith("Key"):
+                    bucket.pop(element.text, None)
+                    deleted.append(
+                        f"<Deleted><Key>{escape(element.text)}</Key></Deleted>"
+                    )
+            fake.count(namespace, "delete", len(deleted))
+            return self.xml(f"<DeleteResult>{''.join(deleted)}</DeleteResult>")
+
+        if "uploads" in query:
+            upload_id = uuid.uuid4().hex
+            fake.uploads[upload_id] = {"parts": {}}
+            return self.xml(
+                f"<InitiateMultipartUploadResult><Bucket>{escape(bucket_name)}</Bucket>"
+                f"<Key>{escape(key)}</Key><UploadId>{upload_id}</UploadId>"
+                "</InitiateMultipartUploadResult>"
+            )
+
+        if "uploadId" in query:
+            upload = fake.uploads.pop(query["uploadId"], None)
+            if upload is None:
+                return self.error(404, "NoSuchUpload")
+            numbers = [
+                int(element.text)
+                for element in ElementTree.fromstring(body).iter()
+                if element.tag.endswith("PartNumber")
+            ]
+            parts = [upload["parts"][number] for number in numbers]
+            digest = hashlib.md5(
+                b"".join(bytes.fromhex(part.etag.strip('"')) for part in parts)
+            ).hexdigest()
+            obj = S3Object(
+                b"".join(part.data for part in parts), f'"{digest}-{len(parts)}"'
+            )
+            fake.count(namespace, "put")
+            fake.store(namespace, bucket_name, key, obj)
+            return self.xml(
+                f"<CompleteMultipartUploadResult><Key>{escape(key)}</Key>"
+                f"<ETag>{escape(obj.etag)}</ETag></CompleteMultipartUploadResult>"
+            )
+        self.error(400, "InvalidRequest")
+
+    def do_DELETE(self) -> None:
+        namespace, bucket_name, key, query = self.parse()
+        if "uploadId" in query:
+            self.fake.uploads.pop(query["uploadId"], None)
+        else:
+            self.fake.count(namespace, "delete", 1)
+            self.fake.bucket(namespace, bucket_name).pop(key, None)
+        self.reply(204)
+
+
+class FakeS3(Server):
+    """In-memory S3-compatible server with the API used by milkrun: objects
+    with Range and conditional requests, listings, DeleteObjects and multipart
+    uploads. Each access key gets its own buckets.
+    """
+
+    handler = S3Handler
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets: Dict[str, Dict[str, Dict[str, S3Object]]] = defaultdict(dict)
+        self.uploads = {}
+        self.counters = defaultdict(lambda: defaultdict(int))
+        self.written_at: Dict[Tuple[str, str], float] = {}
+
+    def bucket(self, namespace: str, bucket_name: str) -> Dict[str, S3Object]:
+        with self.lock:
+            return self.buckets[namespace].setdefault(bucket_name, {})
+
+    def store(self, namespace: str, bucket_name: str, key: str, obj: S3Object) -> None:
+        bucket = self.bucket(namespace, bucket_name)
+        with self.lock:
+            bucket[key] = obj
+            self.written_at.setdefault((namespace, key), time.time())
+
+    def count(self, namespace: str, counter: str, value: int = 1) -> None:
+        with self.lock:
+            self.counters[namespace][counter] += value
@@ -0,0 +1,138 @@
+import queue
+import sqlite3
+import sys
+import threading
+from pathlib import Path
+
+import boto3
+from botocore.config import Config
+
+sys.path.append(
+    Path(__file__).parent.parent.absolute().as_posix()
+)  # Add milkrun/ to root path
+
+import r2_syncer
+from tests.fakes import FakeS3, S3Object
+
+
+def client(fake: FakeS3, key_id: str):
+    return boto3.client(
+        "s3",
+        endpoint_url=fake.url,
+        aws_access_key_id=key_id,
+        aws_secret_access_key="secret",
+        region_name="us-east-1",
+        config=Config(retries={"max_attempts": 1}),
+    )
+
+
+def test_plan_cache_keeps_the_most_recent_requests(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    r2_syncer.init_db()
+    with sqlite3.connect("objects.db") as con:
+        for i, key in enumerate(["a", "b", "c", "d", "e"]):
+            con.execute(
+                "INSERT INTO objects(src, dst, active) VALUES ('seaweedfs', ?, 1)",
+                (key,),
+            )
+            con.execute("INSERT OR REPLACE INTO access VALUES (?, ?)", (key, i))
+            con.execute("INSERT INTO sizes VALUES (?, NULL, 40, 0)", (key,))
+        con.execute("DELETE FROM sizes WHERE object_key = 'e'")  # unknown size
+        con.executemany(
+            "INSERT INTO mirror VALUES (?)",
+            [("a",), ("c",), ("d",), ("e",), ("gone",)],
+        )
+        con.execute("INSERT INTO changes(object_key, changed_at) VALUES ('gone', 0)")
+        (watermark,) = con.execute("SELECT MAX(version) FROM changes").fetchone()
+        con.execute("UPDATE objects SET active = 0 WHERE dst = 'd'")
+
+    # d is released, c and b fit within 100 bytes, a falls out of the budget
+    # and e is kept until its size is known
+    cached, evicted, removed = r2_syncer.plan_cache(limit=100, watermark=watermark)
+    assert cached == {"b": ("seaweedfs", 1)}
+    assert evicted == ["a"]
+    assert removed == ["d"]
+
+    # Changes before the watermark were already applied
+    cached, evicted, removed = r2_syncer.plan_cache(limit=100, watermark=0)
+    assert sorted(removed) == ["d", "gone"]
+
+
+def test_sync_retries_the_objects_of_unknown_size(tmp_path, monkeypatch, fake):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(
+        r2_syncer,
+        "create_client",
+        lambda service_type="client", backend="seaweedfs", s3_host=None: client(
+            fake, backend
+        ),
+    )
+    r2_syncer.init_db()
+    with sqlite3.connect("objects.db") as con:
+        con.execute("INSERT INTO watermarks VALUES ('r2', 0)")
+    r2_syncer.request_object("seaweedfs", "voh/03.tar")
+
+    # Not uploaded yet, the HEAD request fails and the request stays pending
+    assert r2_syncer.seaweedfs_to_r2() is True
+    assert "voh/03.tar" not in fake.bucket("r2", "radio-project")
+
+    # The change log is empty, the poll resolves the size and copies it
+    fake.store("seaweedfs", "radio-project", "voh/03.tar", S3Object(b"data"))
+    assert r2_syncer.seaweedfs_to_r2() is False
+    assert r2_syncer.seaweedfs_to_r2(poll=True) is False
+    assert fake.bucket("r2", "radio-project")["voh/03.tar"].data == b"data"
+
+
+def test_changes_are_logged_by_triggers_until_committed(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    r2_syncer.init_db()
+    with sqlite3.connect("objects.db") as con:
+        con.execute("INSERT INTO watermarks VALUES ('r2', 0)")
+        con.execute("INSERT INTO objects(src, dst, active) VALUES ('aws', 'a', 1)")
+        con.execute("INSERT INTO objects(src, dst, active) VALUES ('aws', 'b', 1)")
+
+    # Inserts are logged by the triggers, with their first change time
+    version, changes = r2_syncer.read_changes(r2_syncer.read_watermark())
+    assert version == 2 and sorted(changes) == ["a", "b"]
+
+    # The watermark moves past the applied changes, failed ones are queued again
+    r2_syncer.commit_changes(version, {"a": changes["a"]}, [], [], {"b": 1.0})
+    assert r2_syncer.read_watermark() == 2
+    assert r2_syncer.read_changes(2) == (3, {"b": 1.0})
+
+    # Updates log the released object
+    with sqlite3.connect("objects.db") as con:
+        con.execute("UPDATE objects SET active = 0 WHERE dst = 'a'")
+    version, changes = r2_syncer.read_changes(3)
+    assert version == 4 and list(changes) == ["a"]
+
+
+def test_notify_wakes_the_worker_up(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(r2_syncer, "POLL_INTERVAL", 60)
+    syncs, polls = queue.Queue(), []
+
+    def seaweedfs_to_r2(poll: bool = False) -> bool:
+        polls.append(poll)
+        syncs.put(poll)
+        if len(polls) == 3:
+            raise KeyboardInterrupt
+        return False
+
+    def run_worker() -> None:
+        try:
+            r2_syncer.run_worker()
+        except KeyboardInterrupt:
+            pass
+
+    monkeypatch.setattr(r2_syncer, "seaweedfs_to_r2", seaweedfs_to_r2)
+    worker = threading.Thread(target=run_worker, daemon=True)
+    worker.start()
+
+    # The worker polls on start, then syncs the changes on each request
+    assert syncs.get(timeout=5) is True
+    for _ in range(2):
+        r2_syncer.notify()
+        assert syncs.get(timeout=5) is False
+    worker.join(5)
+    assert not worker.is_alive()
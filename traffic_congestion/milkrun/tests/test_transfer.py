@@ -0,0 +1,89 @@
+import sys
+from pathlib import Path
+
+import boto3
+import pytest
+from botocore.config import Config
+
+sys.path.append(
+    Path(__file__).parent.parent.absolute().as_posix()
+)  # Add milkrun/ to root path
+
+from tests.fakes import FakeS3, S3Object
+from transfer import TransferEngine
+
+PART_SIZE = 5 * 2**20
+
+
+def client(fake: FakeS3, key_id: str):
+    return boto3.client(
+        "s3",
+        endpoint_url=fake.url,
+        aws_access_key_id=key_id,
+        aws_secret_access_key="secret",
+        region_name="us-east-1",
+        config=Config(retries={"max_attempts": 1}),
+    )
+
+
+class CrashingClient:
+    """R2 client which crashes before uploading a part."""
+
+    def __init__(self, client, part_number: int):
+        self.client = client
+        self.part_number = part_number
+
+    def upload_part(self, **kwrgs):
+        if kwrgs["PartNumber"] == self.part_number:
+            raise RuntimeError("crash")
+        return self.client.upload_part(**kwrgs)
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+
+def test_transfer_resumes_after_a_crash(tmp_path, fake):
+    data = bytes(range(256)) * (17 * 2**12)  # 17 MiB, 4 parts
+    fake.store("seaweedfs", "radio-project", "voh/03.tar", S3Object(data))
+    src, dst = client(fake, "seaweedfs"), client(fake, "r2")
+    state_path = str(tmp_path / "objects.db")
+
+    engine = TransferEngine(
+        CrashingClient(dst, 3), "radio-project", 1, PART_SIZE, state_path
+    )
+    with pytest.raises(RuntimeError):
+        engine.copy(src, "voh/03.tar")
+    assert len(fake.uploads) == 1
+
+    # The restarted engine only reads and uploads the missing parts
+    bytes_out = fake.counters["seaweedfs"]["bytes_out"]
+    engine = TransferEngine(dst, "radio-project", 1, PART_SIZE, state_path)
+    assert engine.copy_all(["voh/03.tar"], lambda key: src) == {"voh/03.tar": None}
+    assert (
+        fake.counters["seaweedfs"]["bytes_out"] - bytes_out == len(data) - 2 * PART_SIZE
+    )
+    obj = fake.bucket("r2", "radio-project")["voh/03.tar"]
+    assert obj.data == data and obj.etag.endswith('-4"')
+    assert engine._load("voh/03.tar") is None
+
+
+def test_transfer_starts_over_when_the_source_changed(tmp_path, fake):
+    data = b"a" * 11 * 2**20
+    fake.store("seaweedfs", "radio-project", "voh/03.tar", S3Object(data))
+    src, dst = client(fake, "seaweedfs"), client(fake, "r2")
+    state_path = str(tmp_path / "objects.db")
+
+    engine = TransferEngine(
+        CrashingClient(dst, 2), "radio-project", 1, PART_SIZE, state_path
+    )
+    with pytest.raises(RuntimeError):
+        engine.copy(src, "voh/03.tar")
+
+    # The parts of the old version are discarded
+    data = b"b" * 11 * 2**20
+    fake.store("seaweedfs", "radio-project", "voh/03.tar", S3Object(data))
+    TransferEngine(dst, "radio-project", 1, PART_SIZE, state_path).copy(
+        src, "voh/03.tar"
+    )
+    assert fake.bucket("r2", "radio-project")["voh/03.tar"].data == data
+    assert fake.uploads == {}
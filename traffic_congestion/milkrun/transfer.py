@@ -0,0 +1,194 @@
+import logging
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from typing import Callable, Dict, List, Optional
+
+import boto3
+from botocore.exceptions import ClientError
+
+# Logger
+logger = logging.getLogger("milk_run")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS transfers (
+    object_key TEXT PRIMARY KEY,
+    upload_id TEXT NOT NULL,
+    etag TEXT,
+    part_size INTEGER NOT NULL,
+    updated_at REAL NOT NULL
+)
+"""
+
+
+class TransferEngine:
+    """Copies objects from SeaweedFS to R2 concurrently.
+
+    Each body is streamed from the source into a multipart upload part by
+    part, so at most max_workers parts of part_size bytes are in memory. The
+    upload id of each multipart transfer is checkpointed in the state
+    database, so after a crash the transfer asks R2 for the parts it already
+    has and resumes with a Range GET after them.
+    """
+
+    def __init__(
+        self,
+        dst_client: boto3.Session.client,
+        bucket_name: str,
+        max_workers: int = 8,
+        part_size: int = 2**23,
+        state_path: str = "objects.db",
+    ):
+        self.dst_client = dst_client
+        self.bucket_name = bucket_name
+        self.max_workers = max_workers
+        self.part_size = max(part_size, 5 * 2**20)  # S3 minimum part size
+        self.state_path = state_path
+        with closing(self.connect()) as con:
+            con.execute(SCHEMA)
+            con.commit()
+
+    def connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.state_path, timeout=30)
+
+    def copy_all(
+        self,
+        object_keys: List[str],
+        source: Callable[[str], boto3.Session.client],
+    ) -> Dict[str, Optional[Exception]]:
+        """Copies the objects, source returns the client of an object. Returns
+        the error of each object, None if it was transferred."""
+
+        def run(object_key: str) -> Optional[Exception]:
+            try:
+                self.copy(source(object_key), object_key)
+            except Exception as ex:
+                logger.exception(ex)
+                return ex
+
+        with ThreadPoolExecutor(self.max_workers) as p:
+            return dict(zip(object_keys, p.map(run, object_keys)))
+
+    def copy(self, src_client: boto3.Session.client, object_key: str) -> None:
+        """Copies one object, resuming its multipart upload if it was started."""
+        start = time.perf_counter()
+        state = self._load(object_key)
+        if state is not None:
+            try:
+                self._resume(src_client, object_key, *state)
+                return
+            except ClientError as ex:
+                # The upload expired or the source changed, start over
+                logger.warning(f"Cannot resume {object_key}: {ex}")
+                self._abort(object_key, state[0])
+
+        response = src_client.get_object(Bucket=self.bucket_name, Key=object_key)
+        with closing(response["Body"]) as body:
+            if response["ContentLength"] <= self.part_size:
+                self.dst_client.put_object(
+                    Bucket=self.bucket_name, Key=object_key, Body=body.read()
+                )
+            else:
+                upload_id = self.dst_client.create_multipart_upload(
+                    Bucket=self.bucket_name, Key=object_key
+                )["UploadId"]
+                self._save(object_key, upload_id, response.get("ETag"))
+                self._upload_parts(body, object_key, upload_id, [])
+        logger.info(
+            "TRANSFERRED {} to R2 in {:.2f}s".format(
+                object_key, time.perf_counter() - start
+            )
+        )
+
+    def _resume(
+        self,
+        src_client: boto3.Session.client,
+        object_key: str,
+        upload_id: str,
+        etag: Optional[str],
+        part_size: int,
+    ) -> None:
+        # Keep the leading parts which R2 has with the expected size
+        parts = []
+        paginator = self.dst_client.get_paginator("list_parts")
+        for page in paginator.paginate(
+            Bucket=self.bucket_name, Key=object_key, UploadId=upload_id
+        ):
+            for part in page.get("Parts", []):
+                if part["PartNumber"] != len(parts) + 1 or part["Size"] != part_size:
+                    break
+                parts.append({"PartNumber": part["PartNumber"], "ETag": part["ETag"]})
+
+        kwrgs = {"IfMatch": etag} if etag else {}
+        response = src_client.get_object(
+            Bucket=self.bucket_name,
+            Key=object_key,
+            Range=f"bytes={len(parts) * part_size}-",
+            **kwrgs,
+        )
+        logger.info(f"RESUMING {object_key} after {len(parts)} parts")
+        with closing(response["Body"]) as body:
+            self._upload_parts(body, object_key, upload_id, parts, part_size)
+
+    def _upload_parts(
+        self,
+        body,
+        object_key: str,
+        upload_id: str,
+        parts: List[dict],
+        part_size: Optional[int] = None,
+    ) -> None:
+        part_size = part_size or self.part_size
+        while True:
+            data = body.read(part_size)
+            if not data and parts:
+                break
+            part_number = len(parts) + 1
+            response = self.dst_client.upload_part(
+                Bucket=self.bucket_name,
+                Key=object_key,
+                UploadId=upload_id,
+                PartNumber=part_number,
+                Body=data,
+            )
+            parts.append({"PartNumber": part_number, "ETag": response["ETag"]})
+            if len(data) < part_size:
+                break
+
+        self.dst_client.complete_multipart_upload(
+            Bucket=self.bucket_name,
+            Key=object_key,
+            UploadId=upload_id,
+            MultipartUpload={"Parts": parts},
+        )
+        self._delete(object_key)
+
+    def _abort(self, object_key: str, upload_id: str) -> None:
+        try:
+            self.dst_client.abort_multipart_upload(
+                Bucket=self.bucket_name, Key=object_key, UploadId=upload_id
+            )
+        except ClientError as ex:
+            logger.exception(ex)
+        self._delete(object_key)
+
+    def _load(self, object_key: str) -> Optional[tuple]:
+        with closing(self.connect()) as con:
+            return con.execute(
+                "SELECT upload_id, etag, part_size FROM transfers WHERE object_key = ?",
+                (object_key,),
+            ).fetchone()
+
+    def _save(self, object_key: str, upload_id: str, etag: Optional[str]) -> None:
+        with closing(self.connect()) as con:
+            con.execute(
+                "INSERT OR REPLACE INTO transfers VALUES (?, ?, ?, ?, ?)",
+                (object_key, upload_id, etag, self.part_size, time.time()),
+            )
+            con.commit()
+
+    def _delete(self, object_key: str) -> None:
+        with closing(self.connect()) as con:
+            con.execute("DELETE FROM transfers WHERE object_key = ?", (object_key,))
+            con.commit()